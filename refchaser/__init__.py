@@ -7,4 +7,4 @@
 __author__ = "Dingqi Zhang"
 __version__ = "0.0.3"
 __license__ = "MIT"
-__all__ = ["massdownlit", "bibparser", "refchaser", "bioreader", "querydatabase"]
\ No newline at end of file
+__all__ = ["massdownlit", "bibparser", "refchaser", "bioreader", "querydatabase", "citationcache", "deduplicate", "cerminepool", "citationgraph", "ranking", "downloader", "journal", "pdfcheck", "pdfstore", "pipeline", "metrics", "benchmark"]
\ No newline at end of file
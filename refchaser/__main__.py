@@ -1,5 +1,5 @@
-from refchaser import bibparser, bioreader, massdownlit, querydatabase, refchaser
-import argparse
+from refchaser import bibparser, bioreader, massdownlit, querydatabase, refchaser, ranking, pipeline, metrics
+import argparse, os
 from tkinter import filedialog as fd
 
 parser = argparse.ArgumentParser()
@@ -10,13 +10,24 @@ mode_help = '''
 what do you want refchaser to do?
 A: download full text articles
 B: extract references
+C: rank records by relevance to included articles
+D: run queries against a local snapshot of bibliographic files
+E: download, extract references and write queries in one pipelined run
 '''
 
 parser.add_argument("mode", help=mode_help, choices=mode_choices)
 parser.add_argument("-p", "--path", help="path to source files")
 parser.add_argument("-t", "--to", help="path to save results to")
 parser.add_argument("-x", "--extra", help="additional arguments", nargs="*")
-args = parser.parse_args()
+parser.add_argument("-w", "--workers", help="number of CERMINE processes to run at once in modes B and E", type=int, default=1)
+parser.add_argument("-c", "--chunked", help="in mode B, split queries that are too long for the database into numbered files",
+                    action="store_true")
+parser.add_argument("-n", "--downloads", help="number of full texts to download at once in mode E", type=int, default=8)
+parser.add_argument("-q", "--queue", help="number of PDFs or CERMINE outputs waiting between two stages of mode E",
+                    type=int, default=32)
+parser.add_argument("-m", "--metrics", help="folder to write the counters and timings of the run to, as "
+                    "refchaser_metrics.json and a Prometheus textfile refchaser_metrics.prom")
+parser.add_argument("--progress", help="show counters and rates of every stage while running", action="store_true")
 
 
 def mode_a():
@@ -73,33 +84,172 @@ def mode_b():
         forw_database = args.extra[0]
         back_database = args.extra[1]
 
-    cermine_parse = refchaser.RefChaser(pdf_path)
+    cermine_parse = refchaser.RefChaser(pdf_path, workers=args.workers, lazy=True)
+    for n, article in enumerate(cermine_parse.iter_articles(), 1):
+        print('%d: %s (%d references)' % (n, article.title, len(article.ref_list)))
+    if args.chunked:
+        for name, queries in [("forw_query", cermine_parse.forw_query(forw_database, chunked=True)),
+                              ("back_query", cermine_parse.back_query(back_database, chunked=True))]:
+            for n, query in enumerate(queries, 1):
+                with open(save_query_to + "/{}_{:03d}.txt".format(name, n), "w", encoding="utf-8") as query_file:
+                    query_file.write(query)
+            print("{}: {} queries".format(name, len(queries)))
+        return
     with open(save_query_to + "/forw_query.txt", "w", encoding="utf-8") as forw:
         forw.write(cermine_parse.forw_query(forw_database))
     with open(save_query_to + "/back_query.txt", "w", encoding="utf-8") as back:
         back.write(cermine_parse.back_query(back_database))
 
 
-if args.mode in ['1', 'A', 'a']:
-    mode_a()
+def mode_c():
+    """
+    API.
+    Rank the records of all bibliographic files in a directory by relevance to included articles,
+    given as a bibliographic file or a directory of them,
+    save a ranked screening list to a designated folder.
+    """
+    if not args.path:
+        records_path = fd.askdirectory(title="Please select a folder that contain the bibliographic files to rank")
+        print("You selected:" + records_path)
+    else:
+        records_path = args.path
+    if not args.to:
+        save_ranking_to = fd.askdirectory(title="Please select a folder you want to save the ranked list to")
+        print("You selected:" + save_ranking_to)
+    else:
+        save_ranking_to = args.to
+    if not args.extra:
+        seeds_path = fd.askopenfilename(title="Please select a bibliographic file of the included articles")
+        print("You selected:" + seeds_path)
+        method = 'bm25'
+    else:
+        seeds_path = args.extra[0]
+        method = args.extra[1] if len(args.extra) > 1 else 'bm25'
+
+    if os.path.isdir(seeds_path):
+        seeds = [x for file_path, member in bibparser.find_bibliographies(seeds_path)
+                 for x in bibparser.BibFile(file_path, member=member).parse()]
+    else:
+        seeds = bibparser.BibFile(seeds_path).parse()
+    ranker = ranking.Ranker()
+    if os.path.isdir(records_path):
+        ranker.add_directory(records_path)
+    else:
+        ranker.add_file(records_path)
+    ranker.vocabulary.save()
+    print('Ranking %d records against %d included articles' % (len(ranker), len(seeds)))
+    ranking.write_ranking(ranker, ranker.rank(seeds, method), save_ranking_to)
+
+
+def mode_d():
+    """
+    API.
+    Index all bibliographic files in a directory as a local snapshot (kept as refchaser_index.rqi in that directory),
+    run query files against it,
+    save the hits of each query, without duplicates, to a designated folder.
+    """
+    if not args.path:
+        snapshot_path = fd.askdirectory(title="Please select a folder that contain the bibliographic files to search")
+        print("You selected:" + snapshot_path)
+    else:
+        snapshot_path = args.path
+    if not args.to:
+        save_hits_to = fd.askdirectory(title="Please select a folder you want to save the hits to")
+        print("You selected:" + save_hits_to)
+    else:
+        save_hits_to = args.to
+    if not args.extra:
+        query_files = fd.askopenfilenames(title="Please select the query files")
+    else:
+        query_files = args.extra
+
+    index = querydatabase.LocalIndex(os.path.join(snapshot_path, 'refchaser_index.rqi'))
+    added = index.add_directory(snapshot_path)
+    if added:
+        index.save()
+    print('%d records in the local index, %d new' % (len(index), added))
+    if not os.path.exists(save_hits_to):
+        os.makedirs(save_hits_to)
+    for query_file in query_files:
+        with open(query_file, 'r', encoding='utf-8') as read_query:
+            hits = index.unique(index.search(read_query.read()))
+        name = os.path.splitext(os.path.basename(query_file))[0]
+        with open(os.path.join(save_hits_to, name + '_hits.ris'), 'w', encoding='utf-8') as write_hits:
+            bibparser.write_citations((index.citation(x) for x in hits), write_hits, 'ris')
+        print('%s: %d records' % (name, len(hits)))
+
+
+def mode_e():
+    """
+    API.
+    Download full texts of all citations in the bibliographic files in a directory (or in one file),
+    parse each with CERMINE as soon as it is downloaded, extract its references,
+    and stream the forward and backward queries and the reference lists to a designated folder.
+    Full texts are saved to the full_texts folder under it.
+    """
+    if not args.path:
+        bib_path = fd.askdirectory(title="Please select a folder that contain all the bibliographic files")
+        print("You selected:" + bib_path)
+    else:
+        bib_path = args.path
+    if not args.to:
+        save_to = fd.askdirectory(title="Please select a folder you want to save full texts, queries and references to")
+        print("You selected:" + save_to)
+    else:
+        save_to = args.to
+    if not args.extra:
+        database_prompt = '''
+        In which database do you want to use your {} query?
+        1 - WOS - Web of Science
+        2 - PubMed -PubMed
+        3 - EMBASE - EMBASE
+        4 - Scopus - Scopus
+        5 - GS - Google Scholar
+        Please enter a number:
+        '''
+        forw_database = input(database_prompt.format("forward"))
+        back_database = input(database_prompt.format("backward"))
+    else:
+        forw_database = args.extra[0]
+        back_database = args.extra[1]
+
+    run = pipeline.Pipeline(bib_path, os.path.join(save_to, 'full_texts'), save_to, forw_database, back_database,
+                            chunked=args.chunked, download_workers=args.downloads, cermine_workers=args.workers,
+                            queue_size=args.queue)
+    articles = run.run()
+    print('%d index articles in %.1f seconds, queries saved to %s' % (len(articles), run.stats['seconds'], save_to))
+
+
+# worker processes started with "spawn" (the default on Windows) import this module again as __mp_main__,
+# so the command line is only read and dispatched in the main process
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.metrics or args.progress:
+        metrics.enable(progress=args.progress, info={x: y for x, y in vars(args).items() if y is not None})
+
+    if args.mode in ['1', 'A', 'a']:
+        mode_a()
+
+    elif args.mode in ['2', 'B', 'b']:
+        mode_b()
 
-elif args.mode in ['2', 'B', 'b']:
-    mode_b()
+    elif args.mode in ['3', 'C', 'c']:
+        mode_c()
 
-elif args.mode in ['3', 'C', 'c']:
-    pass
+    elif args.mode in ['4', 'D', 'd']:
+        mode_d()
 
-elif args.mode in ['4', 'D', 'd']:
-    pass
+    elif args.mode in ['5', 'E', 'e']:
+        mode_e()
 
-elif args.mode in ['5', 'E', 'e']:
-    pass
+    elif args.mode in ['6', 'F', 'f']:
+        pass
 
-elif args.mode in ['6', 'F', 'f']:
-    pass
+    elif args.mode in ['7', 'G', 'g']:
+        pass
 
-elif args.mode in ['7', 'G', 'g']:
-    pass
+    elif args.mode in ['8', 'H', 'h']:
+        pass
 
-elif args.mode in ['8', 'H', 'h']:
-    pass
+    if metrics.finish(args.metrics) is not None and args.metrics:
+        print('Counters and timings of the run saved to %s' % (args.metrics))
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the main stages on synthetic data: parsing bibliographic exports, extracting CERMINE's JATS output,
+building queries, ranking records by relevance and downloading full texts from a fake local mirror.
+    python -m refchaser.benchmark run --suite quick --out results.json
+    python -m refchaser.benchmark compare baseline.json results.json
+"""
+
+import os, io, sys, json, time, random, shutil, platform, argparse, tempfile, threading, contextlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+import refchaser
+import refchaser.bibparser as bibparser
+import refchaser.downloader as downloader
+import refchaser.massdownlit as massdownlit
+import refchaser.ranking as ranking
+import refchaser.refchaser as refchaser_
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+words = ('analysis', 'association', 'blood', 'cancer', 'care', 'children', 'clinical', 'cohort', 'disease', 'effect',
+         'efficacy', 'evidence', 'factors', 'health', 'hospital', 'impact', 'infection', 'intervention', 'long-term',
+         'meta-analysis', 'mortality', 'outcomes', 'patients', 'prevalence', 'primary', 'randomized', 'risk', 'safety',
+         'study', 'systematic', 'therapy', 'treatment', 'trial', 'adults', 'women', 'pressure', 'diabetes', 'survival',
+         'screening', 'quality', 'review', 'chronic', 'acute', 'surgery', 'mental', 'dose', 'response', 'population')
+surnames = ('Smith', 'Zhang', 'Wang', 'Garcia', 'Mueller', 'Rossi', 'Kim', 'Nguyen', 'Silva', 'Johnson', 'Tanaka',
+            'Kowalski', 'Novak', 'Andersen', 'Dubois', 'Ivanova', 'Okafor', 'Cohen', 'Singh', 'Murphy')
+given_names = ('A', 'B', 'C', 'D', 'E', 'H', 'J', 'K', 'L', 'M', 'P', 'R', 'S', 'T', 'Y')
+journals = tuple('Journal of %s %s' % (x.capitalize(), y.capitalize()) for x in words[:10] for y in words[10:15])
+
+# (name, params) of each case of a suite
+suites = {
+    'quick': [('parse', {'format': x, 'records': 1000}) for x in ('ris', 'ciw', 'nbib', 'bib')] +
+             [('parse', {'format': 'ris', 'records': 10000}),
+              ('extract', {'documents': 200, 'references': 50}),
+              ('query', {'titles': 10000, 'database': 'WOS'}),
+              ('rank', {'records': 20000, 'method': 'both'}),
+              ('download', {'articles': 200, 'latency': 0.02, 'failure_rate': 0.0, 'workers': 8}),
+              ('download', {'articles': 200, 'latency': 0.02, 'failure_rate': 0.1, 'workers': 8})],
+    'full': [('parse', {'format': x, 'records': n}) for x in ('ris', 'ciw', 'nbib', 'bib')
+             for n in (1000, 10000, 100000, 1000000)] +
+            [('extract', {'documents': 2000, 'references': 50}),
+             ('extract', {'documents': 200, 'references': 500}),
+             ('query', {'titles': 100000, 'database': 'WOS'}),
+             ('query', {'titles': 1000000, 'database': 'WOS'}),
+             ('rank', {'records': 200000, 'method': 'bm25'}),
+             ('rank', {'records': 200000, 'method': 'cosine'}),
+             ('download', {'articles': 2000, 'latency': 0.05, 'failure_rate': 0.1, 'workers': 16})],
+}
+
+
+def synthetic_citations(records, seed=0):
+    """
+    Function. Generator. Yields records instances of the citation class with random but reproducible titles, authors,
+    years, journals, DOIs and abstracts: the same seed gives the same citations.
+    """
+    rng = random.Random(seed)
+    for n in range(records):
+        authors = ['%s, %s' % (rng.choice(surnames), rng.choice(given_names)) for _ in range(rng.randint(1, 6))]
+        yield bibparser.Citation(
+            title=' '.join(rng.choice(words) for _ in range(rng.randint(6, 16))).capitalize(),
+            article_type='Journal Article', year=str(rng.randint(1980, 2023)), authors=authors,
+            first_author=authors[0], doi='10.%d/bench.%d.%d' % (1000 + rng.randint(0, 8999), seed, n),
+            journal=rng.choice(journals), abstract=' '.join(rng.choice(words) for _ in range(rng.randint(40, 120))),
+            keywords=rng.sample(words, 4))
+
+
+def write_corpus(file_path, records, format_='ris', seed=0):
+    """
+    Function. Writes a synthetic bibliographic export of records citations (see synthetic_citations) in a format
+    ('ris', 'ciw', 'nbib' or 'bib'), streaming, so a million records need no more memory than a thousand.
+    Returns file_path.
+    """
+    with open(file_path, 'w', encoding='utf-8', buffering=1024 * 1024) as write_str:
+        bibparser.write_citations(synthetic_citations(records, seed), write_str, format_)
+    return file_path
+
+
+def synthetic_jats(references=50, seed=0, paragraphs=20):
+    """
+    Function. Returns the text of a synthetic JATS document as CERMINE writes it, with an index article, paragraphs of
+    body text and references references, each with authors, title, journal, year and DOI.
+    """
+    rng = random.Random(seed)
+    sentence = lambda n: ' '.join(rng.choice(words) for _ in range(n))
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<article><front><article-meta><title-group><article-title>',
+             escape(sentence(12).capitalize()), '</article-title></title-group><article-id pub-id-type="doi">',
+             '10.%d/jats.%d' % (1000 + rng.randint(0, 8999), seed),
+             '</article-id></article-meta></front><body>']
+    for n in range(paragraphs):
+        parts.append('<sec id="sec%d"><title>%s</title><p>%s.</p></sec>' % (n, sentence(3), sentence(120)))
+    parts.append('</body><back><ref-list>')
+    for n in range(references):
+        authors = ''.join('<string-name><given-names>%s</given-names> <surname>%s</surname></string-name>, ' % (
+            rng.choice(given_names), rng.choice(surnames)) for _ in range(rng.randint(1, 4)))
+        parts.append('<ref id="ref%d"><mixed-citation>%s<article-title>%s</article-title>. <source>%s</source>, '
+                     '<year>%d</year>; <pub-id pub-id-type="doi">10.%d/ref.%d.%d</pub-id></mixed-citation></ref>\n' % (
+                         n, authors, escape(sentence(rng.randint(6, 16)).capitalize()), escape(rng.choice(journals)),
+                         rng.randint(1980, 2023), 1000 + rng.randint(0, 8999), seed, n))
+    parts.append('</ref-list></back></article>\n')
+    return ''.join(parts)
+
+
+def synthetic_pdf(doi, pages=2, padding=20000):
+    """
+    Function. Returns the bytes of a small PDF that passes pdfcheck.check_pdf, unique to a DOI.
+    """
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % (3 + x) for x in range(pages)), pages)]
+    objects += [b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>'] * pages
+    pdf = b'%PDF-1.5\n%% ' + str(doi).encode('utf-8', 'replace') + b'\n'
+    offsets = []
+    for n, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (n, body)
+    pdf += b'%' + b'x' * padding + b'\n'
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % x for x in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+
+class FakeMirror:
+    """
+    Class. Local HTTP server standing in for a full-text mirror, for downloader.HTTPBackend. Each request waits latency
+    seconds (give or take jitter), then fails with HTTP 503 at failure_rate, answers HTTP 404 at not_found_rate, and
+    otherwise returns a valid PDF of the DOI (see synthetic_pdf). The rates are reproducible for a seed, not which
+    request fails, as requests arrive from many threads. Use it as a context manager.
+        params:
+        latency -> seconds each request waits. 0.05 by default.
+        failure_rate -> share of requests failing with HTTP 503. 0 by default.
+        not_found_rate -> share of requests answered with HTTP 404. 0 by default.
+        jitter -> the latency varies by up to this share of it either way. 0.5 by default.
+        seed -> seed of the random failures and latencies. 0 by default.
+    """
+
+    def __init__(self, latency=0.05, failure_rate=0.0, not_found_rate=0.0, jitter=0.5, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.not_found_rate = not_found_rate
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with mirror.lock:
+                    mirror.requests += 1
+                    draw = mirror.rng.random()
+                    delay = mirror.latency * (1 + mirror.jitter * (2 * mirror.rng.random() - 1))
+                time.sleep(delay)
+                if draw < mirror.failure_rate:
+                    status, content_type, body = 503, 'text/plain', b'busy'
+                elif draw < mirror.failure_rate + mirror.not_found_rate:
+                    status, content_type, body = 404, 'text/plain', b'not found'
+                else:
+                    status, content_type, body = 200, 'application/pdf', synthetic_pdf(self.path.lstrip('/'))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url_template = 'http://127.0.0.1:%d/{doi}' % (self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+
+class _TimedMassDownLit(massdownlit.MassDownLit):
+    """
+    MassDownLit keeping the time each download took, from its first attempt to its result.
+    """
+
+    def iter_downloads(self, *args, **kwargs):
+        for result in super().iter_downloads(*args, **kwargs):
+            if result.path is not None:
+                self.latencies.append(result.elapsed)
+            yield result
+
+
+def peak_rss():
+    """
+    Function. Returns the peak resident set size of the current process in bytes, or None where it cannot be read.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                (x, ctypes.c_size_t) for x in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                                               'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                                               'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                    ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+def latency_summary(latencies):
+    """
+    Function. Returns the median, 95th percentile and largest of a list of latencies in seconds.
+    """
+    if not latencies:
+        return {'p50': None, 'p95': None, 'max': None}
+    ordered = sorted(latencies)
+    return {'p50': ordered[len(ordered) // 2], 'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max': ordered[-1]}
+
+
+def bench_parse(data_dir, format='ris', records=1000, seed=0):
+    """
+    Function. Times BibFile.parse, without cache, on a synthetic export. Latency is the time of the whole file.
+    """
+    file_path = os.path.join(data_dir, 'corpus_%d_%d.%s' % (records, seed, format))
+    started = time.perf_counter()
+    parsed = len(bibparser.BibFile(file_path).parse())
+    seconds = time.perf_counter() - started
+    return {'records': parsed, 'seconds': seconds, 'latency': latency_summary([seconds])}
+
+
+def bench_extract(data_dir, documents=200, references=50, seed=0):
+    """
+    Function. Times RefChaser.JATS_extract on synthetic JATS files. Records are references; latency is per document.
+    """
+    folder = os.path.join(data_dir, 'jats_%d_%d_%d' % (documents, references, seed))
+    files = sorted(os.path.join(folder, x) for x in os.listdir(folder))
+    chaser = refchaser_.RefChaser(folder, cache=False, lazy=True)
+    latencies = []
+    extracted = 0
+    started = time.perf_counter()
+    for file_path in files:
+        before = time.perf_counter()
+        extracted += len(chaser.JATS_extract(file_path).ref_list)
+        latencies.append(time.perf_counter() - before)
+    return {'records': extracted, 'seconds': time.perf_counter() - started, 'latency': latency_summary(latencies)}
+
+
+def bench_query(data_dir, titles=10000, database='WOS', seed=0):
+    """
+    Function. Times RefChaser.combine_title_list on synthetic titles. Records are titles; latency is the whole query.
+    """
+    title_list = [x.title for x in synthetic_citations(titles, seed)]
+    chaser = refchaser_.RefChaser(data_dir, cache=False, lazy=True)
+    started = time.perf_counter()
+    chaser.combine_title_list(title_list, database)
+    seconds = time.perf_counter() - started
+    return {'records': titles, 'seconds': seconds, 'latency': latency_summary([seconds])}
+
+
+def bench_rank(data_dir, records=20000, method='bm25', seed=0):
+    """
+    Function. Times Ranker.add_file, without cache, and Ranker.rank against 5 seed articles on a synthetic RIS export.
+    Records are ranked records; latency is the ranking alone, without building the term matrix.
+    """
+    file_path = os.path.join(data_dir, 'corpus_%d_%d.ris' % (records, seed))
+    seeds = list(synthetic_citations(5, seed + 1))
+    ranker = ranking.Ranker(ranking.Vocabulary(None), cache=False)
+    started = time.perf_counter()
+    ranker.add_file(file_path)
+    before = time.perf_counter()
+    ranked = len(ranker.rank(seeds, method))
+    seconds = time.perf_counter() - started
+    return {'records': ranked, 'seconds': seconds, 'latency': latency_summary([seconds - (before - started)])}
+
+
+def bench_download(data_dir, articles=200, latency=0.02, failure_rate=0.1, workers=8, seed=0):
+    """
+    Function. Times MassDownLit.down_pdf from a FakeMirror, into an empty folder, with the journal and PDF validation on
+    and the PDF store off. Records are downloaded articles; latency is per downloaded article, retries included.
+    """
+    citations = list(synthetic_citations(articles, seed))
+    save_to = tempfile.mkdtemp(prefix='download_', dir=data_dir)
+    with FakeMirror(latency, failure_rate, seed=seed) as mirror:
+        downloads = _TimedMassDownLit(data_dir, save_to, workers=workers, per_host=workers, cache=False, store=False,
+                                      backend=downloader.HTTPBackend(mirror.url_template), lazy=True)
+        downloads.latencies = []
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloads.down_pdf(citations, save_to)
+        seconds = time.perf_counter() - started
+    return {'records': len(downloads.latencies), 'seconds': seconds, 'latency': latency_summary(downloads.latencies),
+            'failures': len(downloads.Failures), 'requests': mirror.requests}
+
+
+benchmarks = {'parse': bench_parse, 'extract': bench_extract, 'query': bench_query, 'rank': bench_rank,
+              'download': bench_download}
+
+
+def prepare(name, params, data_dir, seed=0):
+    """
+    Function. Writes the input files of a case to data_dir, unless they are there from an earlier case.
+    """
+    if name in ('parse', 'rank'):
+        format_ = params.get('format', 'ris')
+        file_path = os.path.join(data_dir, 'corpus_%d_%d.%s' % (params['records'], seed, format_))
+        if not os.path.exists(file_path):
+            write_corpus(file_path + '.tmp', params['records'], format_, seed)
+            os.replace(file_path + '.tmp', file_path)
+    elif name == 'extract':
+        folder = os.path.join(data_dir, 'jats_%d_%d_%d' % (params['documents'], params['references'], seed))
+        if not os.path.exists(folder):
+            os.makedirs(folder + '.tmp')
+            for n in range(params['documents']):
+                with open(os.path.join(folder + '.tmp', '%06d.cermxml' % (n)), 'w', encoding='utf-8') as write_str:
+                    write_str.write(synthetic_jats(params['references'], seed * 1000003 + n))
+            os.replace(folder + '.tmp', folder)
+
+
+def _run_case(name, params, data_dir, seed):
+    result = benchmarks[name](data_dir, seed=seed, **params)
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def run_case(name, params, data_dir, seed=0, repeat=3):
+    """
+    Function. Runs a case repeat times, each in a new process so its peak memory is its own, and returns its result:
+    the fastest run's time, records per second and latency, and the largest peak RSS in MB.
+    """
+    prepare(name, params, data_dir, seed)
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            runs.append(pool.submit(_run_case, name, params, data_dir, seed).result())
+    best = min(runs, key=lambda x: x['seconds'])
+    peaks = [x['peak_rss'] for x in runs if x['peak_rss'] is not None]
+    result = {'name': name, 'params': params, 'seed': seed, 'repeat': repeat, 'records': best['records'],
+              'seconds': best['seconds'],
+              'records_per_second': best['records'] / best['seconds'] if best['seconds'] > 0 else None,
+              'peak_rss_mb': max(peaks) / 2 ** 20 if peaks else None, 'latency': best['latency']}
+    for key in ('failures', 'requests'):
+        if key in best:
+            result[key] = best[key]
+    return result
+
+
+def run_suite(suite='quick', only=None, data_dir=None, seed=0, repeat=3, out=None):
+    """
+    Function. Runs the cases of a suite (see suites), or only those of the benchmarks named in only, and returns the
+    results with a description of the machine. Saves them as JSON to out if given.
+    params:
+        suite -> 'quick' or 'full', or a list of (name, params) cases. 'quick' by default.
+        only -> names of benchmarks to run, e.g. ['parse', 'query']. All by default.
+        data_dir -> directory for the generated inputs, kept for later runs. A temporary directory, removed after, by default.
+        seed -> seed of the synthetic data. 0 by default.
+        repeat -> runs of each case; the fastest is kept. 3 by default.
+    """
+    cases = suites[suite] if isinstance(suite, str) else suite
+    keep = data_dir is not None
+    data_dir = data_dir or tempfile.mkdtemp(prefix='refchaser_benchmark_')
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'suite': suite if isinstance(suite, str) else 'custom',
+        'refchaser': refchaser.__version__, 'python': platform.python_version(), 'platform': platform.platform(),
+        'cpus': os.cpu_count(), 'results': [],
+    }
+    try:
+        for name, params in cases:
+            if only and name not in only:
+                continue
+            result = run_case(name, params, data_dir, seed, repeat)
+            results['results'].append(result)
+            print('%-9s %-60s %12.0f records/s %8.1f MB' % (
+                name, _params_text(params), result['records_per_second'] or 0, result['peak_rss_mb'] or 0))
+    finally:
+        if not keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    if out:
+        with open(out, 'w', encoding='utf-8') as write_str:
+            json.dump(results, write_str, indent=1)
+    return results
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Function. Compares two sets of results (as returned by run_suite or read from its JSON) case by case.
+    Returns lines (case, measure, baseline, current, relative change, regression) for records per second, peak RSS and
+    95th percentile latency; a regression is a change for the worse by more than tolerance (0.1 is 10%).
+    """
+    key = lambda x: (x['name'], json.dumps(x['params'], sort_keys=True))
+    baseline_cases = {key(x): x for x in baseline['results']}
+    lines = []
+    for case in current['results']:
+        before = baseline_cases.get(key(case))
+        if before is None:
+            continue
+        for measure, higher_is_better in (('records_per_second', True), ('peak_rss_mb', False), ('p95', False)):
+            old = before['latency'][measure] if measure == 'p95' else before[measure]
+            new = case['latency'][measure] if measure == 'p95' else case[measure]
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            lines.append((case['name'] + ' ' + _params_text(case['params']), measure, old, new, change,
+                          worse > tolerance))
+    return lines
+
+
+def _params_text(params):
+    return ' '.join('%s=%s' % (x, params[x]) for x in sorted(params))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m refchaser.benchmark', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run a suite of benchmarks and save the results as JSON')
+    run.add_argument('-s', '--suite', choices=sorted(suites), default='quick')
+    run.add_argument('-o', '--out', help='JSON file to save the results to', default='refchaser_benchmark.json')
+    run.add_argument('--only', nargs='*', choices=sorted(benchmarks), help='benchmarks to run, all by default')
+    run.add_argument('-r', '--repeat', type=int, default=3, help='runs of each case, the fastest is kept')
+    run.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    run.add_argument('--data', help='folder to keep generated inputs in between runs')
+    check = commands.add_parser('compare', help='compare results with a baseline and flag regressions')
+    check.add_argument('baseline', help='JSON results of the baseline')
+    check.add_argument('current', help='JSON results to check')
+    check.add_argument('-t', '--tolerance', type=float, default=0.1,
+                       help='relative change for the worse flagged as a regression, 0.1 (10%%) by default')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run_suite(args.suite, args.only, args.data, args.seed, args.repeat, args.out)
+        print('Results saved to %s' % (args.out))
+        return 0
+    with open(args.baseline, encoding='utf-8') as read_str:
+        baseline = json.load(read_str)
+    with open(args.current, encoding='utf-8') as read_str:
+        current = json.load(read_str)
+    lines = compare(baseline, current, args.tolerance)
+    for case, measure, old, new, change, regression in lines:
+        print('%-70s %-18s %12.4g %12.4g %+7.1f%% %s' % (case, measure, old, new, 100 * change,
+                                                         'REGRESSION' if regression else ''))
+    regressions = sum(1 for x in lines if x[-1])
+    print('%d regressions in %d comparisons' % (regressions, len(lines)))
+    return 1 if regressions else 0
+
+
+# worker processes started with "spawn" import this module again, so only the main process runs the command line
+if __name__ == '__main__':
+    sys.exit(main())
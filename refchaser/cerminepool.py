@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Runs CERMINE on many PDF files at once, with several Java processes working on shards of the files.
+"""
+
+import os, time, shutil, subprocess, tempfile, queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import refchaser.metrics as metrics
+
+cermine_jar = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cermine.jar')
+cermine_version = '1.13'
+
+
+class CerminePool:
+    """
+    Class. Pool of CERMINE workers. PDF files are cut into shards; each of the workers processes one shard at a time in
+    its own staging directory, with its own JVM, and results are handed back as soon as a shard is done.
+    CERMINE's command line tool reads a whole directory and exits, so a worker starts one JVM per shard; shard_size
+    spreads the start-up cost of the JVM over many PDFs.
+    A shard whose JVM runs past its deadline is killed, and the PDFs it had not finished are retried one by one, so a
+    single pathological PDF only costs its own timeout.
+        params:
+        workers -> number of CERMINE processes running at once. One per CPU core by default.
+        timeout -> CERMINE's time limit for one PDF, in seconds. 300 by default.
+        shard_size -> number of PDFs given to a worker at once. 20 by default.
+        staging_dir -> directory under which workers stage their shards. A temporary directory by default.
+        startup -> seconds allowed for a JVM to start, on top of the time limits of the PDFs. 60 by default.
+        results_dir -> directory to save JATS outputs to. Next to each PDF by default.
+    """
+
+    def __init__(self, workers=None, timeout=300, shard_size=20, staging_dir=None, startup=60, java='java',
+                 results_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.shard_size = shard_size
+        self.staging_dir = staging_dir
+        self.startup = startup
+        self.java = java
+        self.results_dir = results_dir
+
+    def run(self, pdf_files):
+        """
+        Method. Generator. Parses PDF files and yields (pdf_file, result_file) as each shard completes, result_file being
+        the path to the JATS output (next to the PDF, or in results_dir), or None if CERMINE failed on it.
+        params:
+            pdf_files -> list of paths to PDF files.
+        """
+        pdf_files = list(pdf_files)
+        shards = [pdf_files[i:i + self.shard_size] for i in range(0, len(pdf_files), self.shard_size)]
+        staging_dir = self.staging_dir or tempfile.mkdtemp(prefix='refchaser_cermine_')
+        free_slots = queue.Queue()
+        for slot in range(self.workers):
+            free_slots.put(os.path.join(staging_dir, 'worker%d' % (slot)))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(self._run_shard, shard, free_slots) for shard in shards]
+                for future in as_completed(futures):
+                    for pdf_file, result_file in future.result():
+                        metrics.count('cermine_pdfs', outcome='ok' if result_file is not None else 'failed')
+                        yield pdf_file, result_file
+        finally:
+            if self.staging_dir is None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _run_shard(self, shard, free_slots):
+        worker_dir = free_slots.get()
+        try:
+            results, timed_out = self._run_cermine(shard, worker_dir)
+        finally:
+            free_slots.put(worker_dir)
+        if timed_out and len(shard) > 1:
+            for i, (pdf_file, result_file) in enumerate(results):
+                if result_file is None:
+                    results[i] = self._run_shard([pdf_file], free_slots)[0]
+        return results
+
+    def _run_cermine(self, shard, worker_dir):
+        """
+        Method. Runs one JVM on a shard staged in worker_dir. Returns a list of (pdf_file, result_file) and whether the JVM was killed.
+        """
+        shutil.rmtree(worker_dir, ignore_errors=True)
+        os.makedirs(worker_dir)
+        staged = []
+        for n, pdf_file in enumerate(shard):
+            # numbered names, because CERMINE names its output after the PDF and shards may mix directories
+            staged_name = '%05d' % (n)
+            _link_or_copy(pdf_file, os.path.join(worker_dir, staged_name + '.pdf'))
+            staged.append(staged_name)
+        timed_out = False
+        started = time.perf_counter()
+        try:
+            subprocess.run([self.java, '-jar', cermine_jar, '-path', worker_dir, '-outputs', 'jats', '-timeout',
+                            str(self.timeout)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=self.startup + self.timeout * len(shard))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        record_shard(len(shard), time.perf_counter() - started, timed_out)
+        results = []
+        for pdf_file, staged_name in zip(shard, staged):
+            output = os.path.join(worker_dir, staged_name + '.cermxml')
+            if os.path.exists(output) and os.path.getsize(output) > 0:
+                if self.results_dir is None:
+                    result_file = os.path.splitext(pdf_file)[0] + '.cermxml'
+                    shutil.move(output, result_file)
+                else:
+                    handle, result_file = tempfile.mkstemp(suffix='.cermxml', dir=self.results_dir)
+                    os.close(handle)
+                    shutil.copyfile(output, result_file)
+                results.append((pdf_file, result_file))
+            else:
+                results.append((pdf_file, None))
+        shutil.rmtree(worker_dir, ignore_errors=True)
+        return results, timed_out
+
+
+def record_shard(pdfs, seconds, timed_out=False):
+    """
+    Function. Records the wall time of a CERMINE run on a shard in the metrics. One JVM parses the whole shard, so each
+    of its PDFs is counted with an equal share of the time, start-up of the JVM included.
+    """
+    if metrics.registry is None or not pdfs:
+        return
+    metrics.observe('cermine_shard_seconds', seconds)
+    for _ in range(pdfs):
+        metrics.observe('cermine_pdf_seconds', seconds / pdfs)
+    if timed_out:
+        metrics.count('cermine_timeouts')
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk caches of parse results: citations of bibliographic files, and CERMINE's JATS output of PDF files,
+so the same files are not parsed again on every run.
+"""
+
+import os, json, time, mmap, struct, hashlib, shutil
+from array import array
+import refchaser.bibparser as bibparser
+import refchaser.cerminepool as cerminepool
+
+CACHE_VERSION = 2
+MAGIC = b'RCCT%04d' % CACHE_VERSION
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.refchaser', 'citation_cache')
+default_jats_cache_dir = os.path.join(os.path.expanduser('~'), '.refchaser', 'jats_cache')
+# errors raised by reading a corrupt or truncated entry
+entry_errors = (OSError, ValueError, KeyError, TypeError, struct.error)
+
+
+class MappedStringPool:
+    """
+    Read-only string pool backed by a memory-mapped cache entry. Strings are decoded only when they are accessed.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class ContentCache:
+    """
+    Class. Base of the on-disk caches: entries are files keyed by the SHA-256 of a source file, listed in an index.json
+    with their size and last use. A source file whose path, size and mtime have not changed is not even hashed again.
+    Least recently used entries are evicted beyond max_bytes. Lookups and new entries only change the index in memory;
+    call save() once a batch of files is done to write it.
+    On Windows, the file of an entry still mapped into memory by a table in use cannot be removed; it leaves the index at
+    once, and its removal is retried on save().
+        params:
+        cache_dir -> directory where entries are kept.
+        max_bytes -> size cap of the cache in bytes.
+    """
+    suffix = ''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as index:
+                self.index = json.load(index)
+        except (OSError, ValueError):
+            self.index = {'entries': {}, 'files': {}}
+        self.dirty = False
+        self.deferred = set()
+
+    def key(self, file_path, member=None):
+        """
+        Method. Returns the cache key of a source file: SHA-256 of a salt (see _salt), of the member name for a file
+        inside a .zip archive, and of the contents. The hash is reused while the file's size and mtime are unchanged.
+        """
+        file_path = os.path.normpath(os.path.abspath(file_path))
+        source = file_path if member is None else file_path + '::' + member
+        stat = os.stat(file_path)
+        known = self.index['files'].get(source)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        sha = hashlib.sha256(self._salt(file_path))
+        if member is not None:
+            sha.update(member.encode('utf-8'))
+        with open(file_path, 'rb') as read_bytes:
+            for chunk in iter(lambda: read_bytes.read(1024 * 1024), b''):
+                sha.update(chunk)
+        key = sha.hexdigest()
+        self.index['files'][source] = [stat.st_size, stat.st_mtime_ns, key]
+        self.dirty = True
+        return key
+
+    def invalidate(self, file_path=None, member=None):
+        """
+        Method. Removes the entry of one source file, or every entry if file_path is None.
+        """
+        if file_path is None:
+            for key in list(self.index['entries']):
+                self._drop(key)
+            self.index['files'] = {}
+        else:
+            file_path = os.path.normpath(os.path.abspath(file_path))
+            source = file_path if member is None else file_path + '::' + member
+            known = self.index['files'].pop(source, None)
+            if known:
+                self._drop(known[2])
+        self._save_index()
+
+    def save(self):
+        """
+        Method. Writes the index if lookups or new entries changed it since it was last written, and removes the files of
+        dropped entries that were still mapped when they were dropped.
+        """
+        for entry_path in list(self.deferred):
+            self._remove(entry_path)
+        if self.dirty:
+            self._save_index()
+
+    def size(self):
+        return sum(entry['size'] for entry in self.index['entries'].values())
+
+    def _salt(self, file_path):
+        return b''
+
+    def _lookup(self, key):
+        """
+        Method. Returns the path to the entry of a key and marks it as used, or None if there is no entry.
+        """
+        entry = self.index['entries'].get(key)
+        entry_path = self._entry_path(key)
+        if entry is None or not os.path.exists(entry_path):
+            if entry is not None:
+                self._drop(key)
+                self.dirty = True
+            return None
+        entry['last_used'] = time.time()
+        self.dirty = True
+        return entry_path
+
+    def _store(self, key, temp_path):
+        """
+        Method. Moves a finished file into the cache as the entry of a key, then evicts. Returns the path to the entry.
+        """
+        entry_path = self._entry_path(key)
+        os.replace(temp_path, entry_path)
+        self.deferred.discard(entry_path)
+        self.index['entries'][key] = {'size': os.path.getsize(entry_path), 'last_used': time.time()}
+        self._evict()
+        self.dirty = True
+        return entry_path
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def _drop(self, key):
+        self.index['entries'].pop(key, None)
+        self._remove(self._entry_path(key))
+
+    def _remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            # Windows does not remove a file while it is mapped; try again on save()
+            if os.path.exists(entry_path):
+                self.deferred.add(entry_path)
+                return
+        self.deferred.discard(entry_path)
+
+    def _evict(self):
+        total = self.size()
+        for key in sorted(self.index['entries'], key=lambda k: self.index['entries'][k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index['entries'][key]['size']
+            self._drop(key)
+        live = set(self.index['entries'])
+        self.index['files'] = {k: v for k, v in self.index['files'].items() if v[2] in live}
+
+    def _save_index(self):
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as index:
+            json.dump(self.index, index)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.dirty = False
+
+
+class CitationCache(ContentCache):
+    """
+    Class. Binary cache of parsed citations, keyed by the content hash of a bibliographic file.
+    Entries are columnar CitationTables written as raw arrays, and are loaded through mmap without copying.
+        params:
+        cache_dir -> directory where entries are kept. ~/.refchaser/citation_cache by default.
+        max_bytes -> size cap of the cache; least recently used entries are evicted beyond it. 256 MB by default.
+    """
+    suffix = '.rcc'
+
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=256 * 1024 * 1024):
+        super().__init__(cache_dir, max_bytes)
+
+    def get(self, file_path, member=None):
+        """
+        Method. Returns a read-only CitationTable of the cached citations of a file, or None if it is not cached. A
+        corrupt entry is dropped.
+        """
+        key = self.key(file_path, member)
+        entry_path = self._lookup(key)
+        if entry_path is None:
+            return None
+        try:
+            return self._load(entry_path)
+        except entry_errors:
+            self._drop(key)
+            self.dirty = True
+            return None
+
+    def put(self, file_path, citations, member=None):
+        """
+        Method. Stores the parsed citations of a file, then evicts least recently used entries beyond max_bytes.
+        params:
+            file_path -> path to the bibliographic file the citations were parsed from.
+            citations -> a CitationTable or a list of instances of the citation class.
+            member -> name of the file inside a .zip archive, if any.
+        """
+        if not isinstance(citations, bibparser.CitationTable) or not isinstance(citations.pool, bibparser.StringPool):
+            citations = bibparser.CitationTable(citations)
+        key = self.key(file_path, member)
+        self._dump(citations, self._entry_path(key) + '.tmp')
+        self._store(key, self._entry_path(key) + '.tmp')
+
+    def _salt(self, file_path):
+        # the parser depends on the extension when content sniffing fails
+        return os.path.splitext(file_path)[1].encode('utf-8')
+
+    def _dump(self, table, entry_path):
+        """
+        Method. Writes a CitationTable as a header followed by 8-byte aligned raw arrays.
+        """
+        sections = pool_sections('pool', table.pool.strings)
+        for field in table.scalar_fields:
+            sections.append(('column:' + field, table.columns[field]))
+        for field in table.list_fields:
+            sections.append(('items:' + field, table.items[field]))
+            sections.append(('offsets:' + field, table.offsets[field]))
+        write_sections(entry_path, MAGIC, {'rows': len(table)}, sections)
+
+    def _load(self, entry_path):
+        """
+        Method. Maps a cache entry into memory and returns a read-only CitationTable whose columns are views of the map.
+        """
+        header, section = map_sections(entry_path, MAGIC)
+        table = bibparser.CitationTable()
+        table.pool = MappedStringPool(section('pool_blob'), section('pool_offsets', 'Q'))
+        table.columns = {field: section('column:' + field, 'L') for field in table.scalar_fields}
+        table.items = {field: section('items:' + field, 'L') for field in table.list_fields}
+        table.offsets = {field: section('offsets:' + field, 'L') for field in table.list_fields}
+        table.ref_lists = [None] * header['rows']
+        return table
+
+
+class JatsCache(ContentCache):
+    """
+    Class. Cache of CERMINE's JATS output, keyed by the SHA-256 of the PDF bytes and the CERMINE version, kept outside
+    the folder of the PDFs. A PDF whose bytes are unchanged is never sent to CERMINE again.
+        params:
+        cache_dir -> directory where entries are kept. ~/.refchaser/jats_cache by default.
+        max_bytes -> size cap of the cache; least recently used entries are evicted beyond it. 1 GB by default.
+    """
+    suffix = '.cermxml'
+
+    def __init__(self, cache_dir=default_jats_cache_dir, max_bytes=1024 * 1024 * 1024):
+        super().__init__(cache_dir, max_bytes)
+
+    def get(self, pdf_file):
+        """
+        Method. Returns the path to the cached JATS output of a PDF file, or None if it is not cached.
+        """
+        return self._lookup(self.key(pdf_file))
+
+    def put(self, pdf_file, jats_file):
+        """
+        Method. Moves the JATS output of a PDF file into the cache. Returns the path to the cached copy.
+        """
+        key = self.key(pdf_file)
+        shutil.copyfile(jats_file, self._entry_path(key) + '.tmp')
+        return self._store(key, self._entry_path(key) + '.tmp')
+
+    def _salt(self, file_path):
+        return ('cermine-' + cerminepool.cermine_version).encode('utf-8')
+
+
+def pool_sections(name, strings):
+    """
+    Function. Returns the sections (name_offsets, name_blob) storing a list of strings for write_sections; read them back
+    with MappedStringPool(section(name + '_blob'), section(name + '_offsets', 'Q')).
+    """
+    blob = bytearray()
+    offsets = array('Q', [0])
+    for string in strings:
+        blob += string.encode('utf-8')
+        offsets.append(len(blob))
+    return [(name + '_offsets', offsets), (name + '_blob', bytes(blob))]
+
+
+def write_sections(file_path, magic, header, sections):
+    """
+    Function. Writes named arrays or bytes as an 8-byte magic, a JSON header and 8-byte aligned raw sections, so the file
+    can be memory-mapped and its arrays used without copying. See map_sections.
+    params:
+        file_path -> path to write to.
+        magic -> 8 bytes identifying the kind and version of the file.
+        header -> dictionary of extra values to keep in the header.
+        sections -> list of (name, array or bytes).
+    """
+    header = dict(header, itemsize=array('L').itemsize, sections={})
+    position = 0
+    for name, data in sections:
+        length = len(data) * data.itemsize if isinstance(data, array) else len(data)
+        header['sections'][name] = [position, length]
+        position += length + (-length) % 8
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * ((-len(header_bytes)) % 8)
+    with open(file_path, 'wb') as write_bytes:
+        write_bytes.write(magic)
+        write_bytes.write(struct.pack('<Q', len(header_bytes)))
+        write_bytes.write(header_bytes)
+        for name, data in sections:
+            raw = data.tobytes() if isinstance(data, array) else data
+            write_bytes.write(raw)
+            write_bytes.write(b'\0' * ((-len(raw)) % 8))
+
+
+def map_sections(file_path, magic):
+    """
+    Function. Maps a file written by write_sections into memory. Returns its header and a function section(name, typecode=None)
+    giving a memoryview of a section, cast to an array typecode if one is given.
+    Raises ValueError if the file is not one of magic or is truncated; the file is then no longer mapped, so it can be removed.
+    The map is closed once the last view of it is released.
+    """
+    with open(file_path, 'rb') as read_bytes:
+        mapped = mmap.mmap(read_bytes.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mapped[:8] != magic:
+            raise ValueError('not a %s file: %s' % (magic[:4].decode('ascii'), file_path))
+        header_length = struct.unpack('<Q', mapped[8:16])[0]
+        header = json.loads(mapped[16:16 + header_length].decode('utf-8'))
+        if header['itemsize'] != array('L').itemsize:
+            raise ValueError('file written on another platform: %s' % (file_path))
+        base = 16 + header_length
+        if any(base + position + length > len(mapped) for position, length in header['sections'].values()):
+            raise ValueError('truncated %s file: %s' % (magic[:4].decode('ascii'), file_path))
+    except (ValueError, KeyError, TypeError, AttributeError, struct.error) as error:
+        mapped.close()
+        if isinstance(error, ValueError):
+            raise
+        raise ValueError('corrupt %s file: %s (%r)' % (magic[:4].decode('ascii'), file_path, error))
+    view = memoryview(mapped)
+
+    def section(name, typecode=None):
+        position, length = header['sections'][name]
+        data = view[base + position:base + position + length]
+        return data.cast(typecode) if typecode else data
+
+    return header, section
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""
+Citation graph of index articles and their references, kept across rounds of backward and forward snowballing.
+"""
+
+import os, collections
+from array import array
+import refchaser.bibparser as bibparser
+import refchaser.deduplicate as deduplicate
+import refchaser.citationcache as citationcache
+
+GRAPH_VERSION = 1
+MAGIC = b'RCCG%04d' % GRAPH_VERSION
+
+
+def node_keys(citation):
+    """
+    Function. Returns the canonical keys of a citation: 'doi:' + normalized DOI and 'ti:' + normalized title, for those it has.
+    """
+    keys = []
+    doi = deduplicate.normalize_doi(citation.doi)
+    if doi:
+        keys.append('doi:' + doi)
+    title = deduplicate.normalize_title(citation.title)
+    if len(title) > 10:
+        keys.append('ti:' + title)
+    return keys
+
+
+class StringColumn:
+    """
+    List of strings whose first part may be a MappedStringPool read from disk; strings added later are kept in a list,
+    and strings of the mapped part that were changed in a dictionary.
+    """
+
+    def __init__(self, mapped=None):
+        self.mapped = mapped
+        self.frozen = len(mapped) if mapped is not None else 0
+        self.added = []
+        self.changed = {}
+
+    def append(self, value):
+        self.added.append(value)
+
+    def __getitem__(self, i):
+        if i < self.frozen:
+            return self.changed[i] if i in self.changed else self.mapped[i]
+        return self.added[i - self.frozen]
+
+    def __setitem__(self, i, value):
+        if i < self.frozen:
+            self.changed[i] = value
+        else:
+            self.added[i - self.frozen] = value
+
+    def __len__(self):
+        return self.frozen + len(self.added)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class CitationGraph:
+    """
+    Class. Directed graph from citing articles to the articles they cite. Each node is one article, identified by its
+    normalized DOI or normalized title; a reference found with a DOI in one article and by title only in another is the same node.
+    Edges are kept as compressed sparse rows: an array of offsets per node into an array of cited nodes. Edges of articles
+    added since the last compact() wait in a dictionary, so adding a round of index articles does not rebuild the arrays.
+    Every node remembers the hop it was found at: index articles of the first round are at hop 0, their references at hop 1,
+    the references of those at hop 2, and so on.
+    The graph is saved as raw arrays that are memory-mapped when it is opened again, so large graphs open instantly.
+        params:
+        graph_path -> path to a graph file written by save(), opened if it exists. None for a graph in memory only.
+    """
+
+    def __init__(self, graph_path=None):
+        self.graph_path = graph_path
+        self.titles = StringColumn()
+        self.dois = StringColumn()
+        self.years = StringColumn()
+        self.hops = array('L')
+        self.chased = array('B')  # 1 for index articles, whose references have been added
+        self.cited_count = array('L')
+        self.offsets = array('L', [0])
+        self.targets = array('L')
+        self.pending = {}
+        self.key_strings = StringColumn()
+        self.key_nodes = array('L')
+        self._keys = None
+        self._reverse = None
+        if graph_path is not None and os.path.exists(graph_path):
+            self._load(graph_path)
+
+    def __len__(self):
+        return len(self.hops)
+
+    def edge_count(self):
+        return len(self.targets) + sum(len(x) for x in self.pending.values())
+
+    def find(self, citation):
+        """
+        Method. Returns the node of an instance of the citation class, or None if it is not in the graph.
+        """
+        keys = self._key_index()
+        for key in node_keys(citation):
+            if key in keys:
+                return keys[key]
+        return None
+
+    def add_node(self, citation, hop=0):
+        """
+        Method. Returns the node of an instance of the citation class, adding it at the given hop if it is new.
+        A node found again at a lower hop moves to that hop, and a DOI or year it lacked is filled in.
+        Returns None for a citation with neither DOI nor usable title.
+        """
+        keys = self._key_index()
+        citation_keys = node_keys(citation)
+        node = None
+        for key in citation_keys:
+            if key in keys:
+                node = keys[key]
+                break
+        if node is None:
+            if not citation_keys:
+                return None
+            node = len(self.hops)
+            self.titles.append(str(citation.title))
+            self.dois.append(str(citation.doi))
+            self.years.append(str(citation.year))
+            self.hops.append(hop)
+            self.chased.append(0)
+            self.cited_count.append(0)
+        else:
+            if not self.dois[node] and citation.doi:
+                self.dois[node] = str(citation.doi)
+            if not self.years[node] and citation.year:
+                self.years[node] = str(citation.year)
+            self._lower_hop(node, hop)
+        for key in citation_keys:
+            if key not in keys:
+                keys[key] = node
+                self.key_strings.append(key)
+                self.key_nodes.append(node)
+        return node
+
+    def add_article(self, article, hop=None):
+        """
+        Method. Adds an index article and the references in its ref_list. A new article is added at hop (0 by default);
+        one already in the graph keeps the lower of its hop and hop, and gets a DOI it lacked. New references are added
+        one hop further. The references of an article are only recorded once. Returns the node of the article.
+        """
+        node = self.find(article)
+        if node is None or hop is not None:
+            node = self.add_node(article, hop or 0)
+            if node is None:
+                return None
+        else:
+            # without a hop, an article already in the graph only gets what it lacked
+            node = self.add_node(article, self.hops[node])
+        if self.chased[node]:
+            return node
+        self.chased[node] = 1
+        cited = []
+        seen = set()
+        for reference in article.ref_list:
+            target = self.add_node(reference, self.hops[node] + 1)
+            if target is None or target == node or target in seen:
+                continue
+            seen.add(target)
+            cited.append(target)
+            self.cited_count[target] += 1
+        self.pending[node] = array('L', cited)
+        self._reverse = None
+        return node
+
+    def extend(self, articles, hop=None):
+        for article in articles:
+            self.add_article(article, hop)
+
+    def references(self, node):
+        """
+        Method. Returns the nodes cited by a node.
+        """
+        if node in self.pending:
+            return list(self.pending[node])
+        if node + 1 < len(self.offsets):
+            return list(self.targets[self.offsets[node]:self.offsets[node + 1]])
+        return []
+
+    def citing(self, node):
+        """
+        Method. Returns the nodes citing a node, from a reverse index built on first use after each change.
+        """
+        if self._reverse is None:
+            self.compact()
+            counts = array('L', [0]) * (len(self) + 1)
+            for target in self.targets:
+                counts[target + 1] += 1
+            for i in range(len(self)):
+                counts[i + 1] += counts[i]
+            sources = array('L', [0]) * len(self.targets)
+            fill = array('L', counts)
+            for source in range(len(self.offsets) - 1):
+                for target in self.targets[self.offsets[source]:self.offsets[source + 1]]:
+                    sources[fill[target]] = source
+                    fill[target] += 1
+            self._reverse = (counts, sources)
+        counts, sources = self._reverse
+        return list(sources[counts[node]:counts[node + 1]])
+
+    def cited_by_at_least(self, k, include_chased=False):
+        """
+        Method. Returns the nodes cited by at least k articles of the graph, most cited first; by default only those whose
+        own references have not been added yet, i.e. candidates for the next round of chasing.
+        """
+        nodes = [i for i, count in enumerate(self.cited_count) if count >= k and (include_chased or not self.chased[i])]
+        return sorted(nodes, key=lambda i: -self.cited_count[i])
+
+    def new_at_hop(self, hop):
+        """
+        Method. Returns the nodes first found at a hop, e.g. new_at_hop(2) for the references of references of the seeds.
+        """
+        return [i for i, node_hop in enumerate(self.hops) if node_hop == hop]
+
+    def frontier(self):
+        """
+        Method. Returns the nodes whose references have not been added yet.
+        """
+        return [i for i, chased in enumerate(self.chased) if not chased]
+
+    def citation(self, node):
+        """
+        Method. Returns an instance of the citation class with the title, DOI and year of a node, e.g. to build a query.
+        """
+        return bibparser.Citation(title=self.titles[node], doi=self.dois[node], year=self.years[node])
+
+    def compact(self):
+        """
+        Method. Merges the edges of articles added since the last compact() into the compressed sparse rows.
+        """
+        if not self.pending and len(self.offsets) == len(self) + 1:
+            return
+        offsets = array('L', [0])
+        targets = array('L')
+        frozen = len(self.offsets) - 1
+        for node in range(len(self)):
+            if node in self.pending:
+                targets.extend(self.pending[node])
+            elif node < frozen:
+                targets.extend(self.targets[self.offsets[node]:self.offsets[node + 1]])
+            offsets.append(len(targets))
+        self.offsets = offsets
+        self.targets = targets
+        self.pending = {}
+
+    def save(self, graph_path=None):
+        """
+        Method. Writes the graph to graph_path (the path it was opened from by default) as memory-mappable raw arrays.
+        """
+        graph_path = graph_path or self.graph_path
+        if graph_path is None:
+            raise Exception("no path to save the citation graph to")
+        self.compact()
+        # edges still mapped from the old file are copied, so it can be replaced even where mapped files are locked (Windows)
+        self.offsets = array('L', self.offsets)
+        self.targets = array('L', self.targets)
+        sections = [('hops', self.hops), ('chased', self.chased), ('cited_count', self.cited_count),
+                    ('offsets', self.offsets), ('targets', self.targets), ('key_nodes', self.key_nodes)]
+        for name in ('titles', 'dois', 'years', 'key_strings'):
+            sections += citationcache.pool_sections(name, list(getattr(self, name)))
+        folder = os.path.dirname(graph_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        citationcache.write_sections(graph_path + '.tmp', MAGIC, {'nodes': len(self)}, sections)
+        for name in ('titles', 'dois', 'years', 'key_strings'):
+            column = StringColumn()
+            column.added = list(getattr(self, name))
+            setattr(self, name, column)
+        os.replace(graph_path + '.tmp', graph_path)
+        self.graph_path = graph_path
+
+    def _load(self, graph_path):
+        header, section = citationcache.map_sections(graph_path, MAGIC)
+        # per-node arrays change on every round and are small, so they are copied; the edges stay mapped until compact()
+        self.hops = array('L', section('hops', 'L'))
+        self.chased = array('B', section('chased', 'B'))
+        self.cited_count = array('L', section('cited_count', 'L'))
+        self.offsets = section('offsets', 'L')
+        self.targets = section('targets', 'L')
+        self.key_nodes = array('L', section('key_nodes', 'L'))
+        for name in ('titles', 'dois', 'years', 'key_strings'):
+            setattr(self, name, StringColumn(
+                citationcache.MappedStringPool(section(name + '_blob'), section(name + '_offsets', 'Q'))))
+
+    def _lower_hop(self, node, hop):
+        # the articles cited by a node moved closer to the seeds are at most one hop further, and so on down the graph
+        queue = collections.deque([(node, hop)])
+        while queue:
+            node, hop = queue.popleft()
+            if hop >= self.hops[node]:
+                continue
+            self.hops[node] = hop
+            if self.chased[node]:
+                queue.extend((target, hop + 1) for target in self.references(node))
+
+    def _key_index(self):
+        if self._keys is None:
+            self._keys = {key: node for key, node in zip(self.key_strings, self.key_nodes)}
+        return self._keys
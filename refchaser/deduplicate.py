@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""
+Finds citations of the same article across bibliographic files, so each article is downloaded once.
+"""
+
+import re, os, unicodedata
+import refchaser.metrics as metrics
+
+doi_prefix = re.compile(r'^(https?://(dx\.)?doi\.org/|doi:\s*)', re.I)
+markup = re.compile(r'<[^>]+>')
+non_alnum = re.compile(r'[\W_]+')
+
+
+def normalize_doi(doi):
+    """
+    Function. Returns a DOI in lower case without URL or "doi:" prefix, or '' if it is not a DOI.
+    """
+    doi = doi_prefix.sub('', str(doi).strip()).strip().rstrip('.').lower()
+    return doi if doi.startswith('10.') else ''
+
+
+def normalize_title(title):
+    """
+    Function. Returns a title in lower case with markup, accents, punctuation and repeated spaces removed.
+    """
+    title = unicodedata.normalize('NFKD', markup.sub(' ', str(title)).lower())
+    title = ''.join(x for x in title if not unicodedata.combining(x))
+    return ' '.join(non_alnum.sub(' ', title).split())
+
+
+class Deduplicator:
+    """
+    Class. Collapses duplicate citations gathered from several bibliographic files.
+    Citations are grouped when their normalized DOIs are equal, when their normalized titles are equal, or when their titles
+    are near-duplicates. Near-duplicates are found with MinHash signatures of character shingles of the title (one
+    permutation, split into bins) and locality-sensitive hashing on bands of the signature; only citations sharing a band
+    are compared, so the work grows linearly with the number of citations.
+        params:
+        threshold -> minimum Jaccard similarity of title shingles for a near-duplicate. 0.8 by default.
+        bands -> number of LSH bands. 4 by default.
+        rows -> number of signature bins per band. 4 by default.
+        shingle_size -> length of character shingles. 4 by default.
+        bucket_size -> how many citations of an LSH bucket new citations are compared against. 8 by default.
+    """
+
+    def __init__(self, threshold=0.8, bands=4, rows=4, shingle_size=4, bucket_size=8):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.bins = bands * rows
+        self.shingle_size = shingle_size
+        self.bucket_size = bucket_size
+        self.citations = []
+        self.sources = []
+        self.parents = []
+        self.reasons = []
+        self.doi_index = {}
+        self.title_index = {}
+        self.band_index = {}
+
+    def add(self, citation, source=''):
+        """
+        Method. Adds an instance of the citation class, found in the bibliographic file named source. Returns its position.
+        """
+        i = len(self.citations)
+        self.citations.append(citation)
+        self.sources.append(source)
+        self.parents.append(i)
+        self.reasons.append('')
+        doi = normalize_doi(citation.doi)
+        if doi:
+            j = self.doi_index.setdefault(doi, i)
+            if j != i:
+                self._union(j, i, 'doi')
+                return i
+        title = normalize_title(citation.title)
+        if len(title) < self.shingle_size:
+            return i
+        j = self.title_index.setdefault(title, i)
+        if j != i:
+            if self._compatible(j, i):
+                self._union(j, i, 'title')
+            return i
+        shingles = self._shingles(title)
+        signature = self._signature(shingles)
+        compared = set()
+        for band in range(self.bands):
+            key = (band,) + signature[band * self.rows:(band + 1) * self.rows]
+            bucket = self.band_index.setdefault(key, [])
+            for j in bucket:
+                if j in compared:
+                    continue
+                compared.add(j)
+                if self._compatible(j, i) and self._jaccard(shingles, self._shingles(normalize_title(
+                        self.citations[j].title))) >= self.threshold:
+                    self._union(j, i, 'near-title')
+                    return i
+            if len(bucket) < self.bucket_size:
+                bucket.append(i)
+        return i
+
+    def extend(self, citations, source=''):
+        with metrics.timer('dedup_seconds'):
+            added = len(self.citations)
+            for citation in citations:
+                self.add(citation, source)
+        metrics.count('dedup_records', len(self.citations) - added)
+
+    def groups(self):
+        """
+        Method. Returns lists of positions of citations that are copies of the same article, in order of first appearance.
+        """
+        groups = {}
+        for i in range(len(self.citations)):
+            groups.setdefault(self._find(i), []).append(i)
+        return list(groups.values())
+
+    def unique(self):
+        """
+        Method. Returns one instance of the citation class per article: the first copy with a DOI, otherwise the first copy.
+        """
+        unique = [self.citations[self._keeper(group)] for group in self.groups()]
+        metrics.count('dedup_duplicates', len(self.citations) - len(unique))
+        return unique
+
+    def report(self):
+        """
+        Method. Returns lines describing which copies were merged into which kept citation, and why.
+        """
+        lines = []
+        for group in self.groups():
+            if len(group) < 2:
+                continue
+            keeper = self._keeper(group)
+            lines.append('Kept: %s DOI: %s (%s)\n' % (
+                self.citations[keeper].title, self.citations[keeper].doi, self.sources[keeper]))
+            for i in group:
+                if i != keeper:
+                    lines.append('    merged [%s]: %s DOI: %s (%s)\n' % (
+                        self.reasons[i] or self.reasons[keeper], self.citations[i].title, self.citations[i].doi,
+                        self.sources[i]))
+        return lines
+
+    def _keeper(self, group):
+        for i in group:
+            if normalize_doi(self.citations[i].doi):
+                return i
+        return group[0]
+
+    def _compatible(self, i, j):
+        # two different DOIs, or two different years, mean two different articles
+        doi_i, doi_j = normalize_doi(self.citations[i].doi), normalize_doi(self.citations[j].doi)
+        if doi_i and doi_j and doi_i != doi_j:
+            return False
+        year_i, year_j = str(self.citations[i].year)[:4], str(self.citations[j].year)[:4]
+        return not (year_i and year_j and year_i != year_j)
+
+    def _shingles(self, title):
+        k = self.shingle_size
+        return {title[x:x + k] for x in range(len(title) - k + 1)}
+
+    def _signature(self, shingles):
+        bins = self.bins
+        signature = [None] * bins
+        for value in map(hash, shingles):
+            b = value % bins
+            if signature[b] is None or value < signature[b]:
+                signature[b] = value
+        return tuple(signature)
+
+    @staticmethod
+    def _jaccard(a, b):
+        return len(a & b) / len(a | b) if a or b else 0.0
+
+    def _find(self, i):
+        parents = self.parents
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def _union(self, i, j, reason):
+        root_i, root_j = self._find(i), self._find(j)
+        if root_i != root_j:
+            if root_j < root_i:
+                root_i, root_j = root_j, root_i
+            self.parents[root_j] = root_i
+        self.reasons[j] = reason
+
+
+def write_report(deduplicator, report_path):
+    """
+    Function. Writes the merge report of a Deduplicator to a text file.
+    """
+    lines = deduplicator.report()
+    unique = len(deduplicator.groups())
+    folder = os.path.dirname(report_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(report_path, 'w', encoding='utf-8') as report:
+        report.write('%d citations, %d unique articles, %d duplicate copies merged\n\n' % (
+            len(deduplicator.citations), unique, len(deduplicator.citations) - unique))
+        report.writelines(lines)
+
+
+def surname(author):
+    """
+    Function. Returns the normalized surname of an author written as "Surname, Given names" or "Surname Initials".
+    """
+    author = str(author)
+    if ',' in author:
+        return normalize_title(author.split(',')[0])
+    name = normalize_title(author)
+    return name.split(' ')[0] if name else ''
+
+
+stop_words = {'a', 'an', 'the', 'of', 'on', 'in', 'and', 'for', 'to'}
+
+
+class CitationMatcher:
+    """
+    Class. Matches citations (e.g. references extracted by CERMINE) against a large set of records (e.g. screening records
+    from a bibliographic file) without comparing every pair.
+    Records are put in a blocking index under three keys: year + first-author surname, year + title prefix and surname +
+    title prefix. A citation is only scored against records sharing at least one key, so a reference whose year, author or
+    title was mangled during extraction can still be found through the other two.
+    A citation whose DOI is that of a record matches it outright; records with another DOI are never its match.
+    Candidates of a citation are scored together: Dice coefficient of title words, plus agreement of surname and year.
+    NumPy is not a dependency, so the scores of the candidates are computed in one comprehension over frozensets of
+    title words built when records are added, rather than as arrays; ties go to the record added first.
+        params:
+        records -> iterable of instances of the citation class to match against.
+        threshold -> minimum score of a match, between 0 and 1. 0.6 by default.
+    """
+
+    def __init__(self, records, threshold=0.6):
+        self.threshold = threshold
+        self.records = []
+        self.words = []
+        self.surnames = []
+        self.years = []
+        self.dois = []
+        self.doi_index = {}
+        self.index = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        i = len(self.records)
+        words, surname_, year, prefix = self._features(record)
+        self.records.append(record)
+        self.words.append(words)
+        self.surnames.append(surname_)
+        self.years.append(year)
+        doi = normalize_doi(record.doi)
+        self.dois.append(doi)
+        if doi:
+            self.doi_index.setdefault(doi, i)
+        for key in self._keys(surname_, year, prefix):
+            self.index.setdefault(key, []).append(i)
+        return i
+
+    def match(self, citation):
+        """
+        Method. Returns (record, score) of the best scoring record for an instance of the citation class, or (None, score)
+        if no record reaches the threshold.
+        """
+        words, surname_, year, prefix = self._features(citation)
+        doi = normalize_doi(citation.doi)
+        if doi in self.doi_index:
+            return self.records[self.doi_index[doi]], 1.0
+        candidates = set()
+        for key in self._keys(surname_, year, prefix):
+            candidates.update(self.index.get(key, ()))
+        if doi:
+            candidates = [i for i in candidates if not self.dois[i]]
+        if not candidates:
+            return None, 0.0
+        candidates = sorted(candidates)
+        size = len(words)
+        title_scores = [2 * len(words & self.words[i]) / (size + len(self.words[i])) if size + len(self.words[i]) else 0.0
+                        for i in candidates]
+        scores = [0.7 * t + 0.15 * (surname_ != '' and surname_ == self.surnames[i]) +
+                  0.15 * (year != '' and year == self.years[i]) for t, i in zip(title_scores, candidates)]
+        best = max(range(len(candidates)), key=scores.__getitem__)
+        if scores[best] < self.threshold:
+            return None, scores[best]
+        return self.records[candidates[best]], scores[best]
+
+    def _features(self, citation):
+        title = normalize_title(citation.title)
+        words = frozenset(title.split())
+        first_author = citation.first_author or (citation.authors[0] if citation.authors else '')
+        year = str(citation.year)[:4]
+        significant = [x for x in title.split() if x not in stop_words]
+        prefix = ' '.join(significant[:2])
+        return words, surname(first_author), year, prefix
+
+    @staticmethod
+    def _keys(surname_, year, prefix):
+        keys = []
+        if year and surname_:
+            keys.append(('ya', year, surname_))
+        if year and prefix:
+            keys.append(('yt', year, prefix))
+        if surname_ and prefix:
+            keys.append(('at', surname_, prefix))
+        return keys
@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+
+"""
+Downloads full texts of many citations at once, with a bounded number of downloads per host and reused connections.
+"""
+
+import os, re, time, heapq, random, shutil, tempfile, threading, queue, functools
+import http.client
+from collections import deque
+from urllib.parse import urlsplit, urljoin, quote
+import refchaser.metrics as metrics
+import refchaser.pdfcheck as pdfcheck
+
+embedded_pdf = re.compile(r'<(?:iframe|embed)[^>]+src\s*=\s*["\']([^"\'#]+)', re.I)
+
+
+def pdf_file_name(doi):
+    """
+    Function. Returns a file name for the full text of a DOI that is valid on Windows.
+    """
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(doi)).strip('_.')[:200] + '.pdf'
+
+
+class ArticleNotFound(Exception):
+    """
+    Raised by a backend when a mirror works but does not have the article, so the failure does not count against the mirror.
+    """
+
+
+class DownloadResult:
+    """
+    Outcome of the download of one citation: the path to the file, or the error and the number of attempts.
+    """
+    __slots__ = ('citation', 'path', 'error', 'attempts', 'elapsed', 'size', 'host')
+
+    def __init__(self, citation, path=None, error='', attempts=0, elapsed=0.0, size=0, host=''):
+        self.citation = citation
+        self.path = path
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.size = size
+        self.host = host
+
+
+class ConnectionPool:
+    """
+    Class. Keeps idle HTTP connections per host so successive downloads from the same mirror skip the TCP and TLS handshakes.
+        params:
+        timeout -> socket timeout of the connections, in seconds.
+        max_idle -> number of idle connections kept per host. 8 by default.
+    """
+
+    def __init__(self, timeout, max_idle=8):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def request(self, url, headers=None, timeout=None):
+        """
+        Method. Sends a GET request and returns (connection key, connection, response).
+        Give the connection back with release() once the response has been read.
+        """
+        timeout = timeout or self.timeout
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            idle = self.idle.get(key)
+            connection = idle.pop() if idle else None
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for fresh in ([False, True] if connection is not None else [True]):
+            if fresh:
+                connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                connection = connection_class(parts.netloc, timeout=timeout)
+            elif connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request('GET', path, headers=dict({'User-Agent': 'refchaser'}, **(headers or {})))
+                return key, connection, connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                # an idle connection may have been closed by the server, so it is tried once more on a new one
+                if fresh:
+                    raise
+
+    def release(self, key, connection, response):
+        if response.will_close or not response.isclosed():
+            connection.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = {}
+
+
+class HTTPBackend:
+    """
+    Class. Download backend fetching full texts over HTTP from mirrors, e.g. Sci-Hub mirrors or a local stub server.
+    The URL of a DOI on a mirror is its URL template with {doi} replaced. If a mirror answers with an HTML page embedding
+    the PDF, as Sci-Hub does, the embedded PDF is fetched from the same pool of connections.
+        params:
+        url_templates -> one URL template or a list of them, one per mirror, e.g. 'https://sci-hub.se/{doi}' or 'http://127.0.0.1:8000/{doi}'.
+        timeout -> socket timeout when the downloader gives none, in seconds. 60 by default.
+    """
+
+    def __init__(self, url_templates, timeout=60):
+        if isinstance(url_templates, str):
+            url_templates = [url_templates]
+        self.templates = {urlsplit(x).netloc: x for x in url_templates}
+        self.mirrors = list(self.templates)
+        self.pool = ConnectionPool(timeout)
+
+    def fetch(self, citation, save_to, mirror=None, timeout=None):
+        """
+        Method. Downloads the full text of a citation from a mirror (the first by default) into the directory save_to.
+        Returns the path to the file. Raises ArticleNotFound if the mirror does not have it.
+        """
+        if not citation.doi:
+            raise ArticleNotFound('no DOI')
+        template = self.templates[mirror or self.mirrors[0]]
+        url = template.format(doi=quote(str(citation.doi).strip(), safe='/'))
+        for hop in range(6):
+            key, connection, response = self.pool.request(url, timeout=timeout)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self.pool.release(key, connection, response)
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                self.pool.release(key, connection, response)
+                if response.status in (404, 410):
+                    raise ArticleNotFound('HTTP %d' % (response.status))
+                raise Exception('HTTP %d' % (response.status))
+            if 'html' in (response.getheader('Content-Type') or ''):
+                page = response.read().decode('utf-8', 'replace')
+                self.pool.release(key, connection, response)
+                embedded = embedded_pdf.search(page)
+                if embedded is None:
+                    raise ArticleNotFound('no PDF on the page')
+                url = urljoin(url, embedded.group(1))
+                continue
+            file_path = os.path.join(save_to, pdf_file_name(citation.doi))
+            # a name of its own for each attempt, so two attempts at the same DOI never write into the same file
+            handle, part_path = tempfile.mkstemp(suffix='.part', prefix='.download_', dir=save_to)
+            try:
+                with os.fdopen(handle, 'wb') as write_pdf:
+                    while True:
+                        chunk = response.read(64 * 1024)
+                        if not chunk:
+                            break
+                        write_pdf.write(chunk)
+                self.pool.release(key, connection, response)
+                os.replace(part_path, file_path)
+            except BaseException:
+                connection.close()
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            return file_path
+        raise Exception('too many redirects')
+
+    def close(self):
+        self.pool.close()
+
+
+class SciHubBackend:
+    """
+    Class. Download backend through the python package scidownl, as MassDownLit always did. Each worker thread keeps its own
+    requests session, and each download goes to its own staging folder so the file scidownl names after the title can be found.
+    scidownl picks the Sci-Hub mirror itself, so there is one mirror. The time limit of the downloader is set as the
+    timeout of every request of the session, so a download given up does not hang on a dead connection.
+    """
+    mirrors = ['sci-hub']
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def fetch(self, citation, save_to, mirror=None, timeout=None):
+        from scidownl.scihub import SciHub
+        import requests
+        if not citation.doi:
+            raise ArticleNotFound('no DOI')
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        # requests waits forever by default
+        self.local.session.request = functools.partial(requests.Session.request, self.local.session,
+                                                       timeout=timeout or 60)
+        staging = tempfile.mkdtemp(prefix='.refchaser_download_', dir=save_to)
+        try:
+            scihub = SciHub(citation.doi, staging)
+            scihub.sess = self.local.session
+            scihub.download()
+            pdf_files = [x for x in os.listdir(staging) if x.lower().endswith('.pdf')]
+            if not pdf_files:
+                raise Exception('nothing downloaded')
+            file_path = os.path.join(save_to, pdf_files[0])
+            os.replace(os.path.join(staging, pdf_files[0]), file_path)
+            return file_path
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def close(self):
+        pass
+
+
+class CircuitBreaker:
+    """
+    Class. Stops sending downloads to a mirror whose recent error rate reaches threshold. After cooldown seconds one trial
+    download is let through: if it works the mirror is used again, otherwise the breaker opens for twice as long.
+        params:
+        threshold -> error rate over the last window downloads that opens the breaker. 0.5 by default.
+        window -> number of recent downloads considered. 20 by default.
+        min_calls -> number of downloads needed before the breaker can open. 10 by default.
+        cooldown -> seconds the breaker stays open the first time, doubling with each failed trial up to 16 times as long. 30 by default.
+    """
+
+    def __init__(self, threshold=0.5, window=20, min_calls=10, cooldown=30.0):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.open_for = cooldown
+        self.probing = False
+
+    def allow(self, now):
+        if self.opened_at is None:
+            return True
+        if not self.probing and now - self.opened_at >= self.open_for:
+            self.probing = True
+            return True
+        return False
+
+    def record(self, success, now):
+        if self.probing:
+            self.probing = False
+            if success:
+                self.opened_at = None
+                self.open_for = self.cooldown
+                self.outcomes.clear()
+            else:
+                self.opened_at = now
+                self.open_for = min(self.open_for * 2, self.cooldown * 16)
+            return
+        self.outcomes.append(success)
+        errors = self.outcomes.count(False)
+        if self.opened_at is None and len(self.outcomes) >= self.min_calls and errors / len(self.outcomes) >= self.threshold:
+            self.opened_at = now
+
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class HostStats:
+    """
+    Class. Latencies of recent successful downloads from a mirror. The time limit of the next download is a multiple of
+    their 95th percentile, between min_timeout and max_timeout; max_timeout until enough downloads have been seen.
+    """
+
+    def __init__(self, min_timeout, max_timeout, factor=3.0, min_samples=20):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.factor = factor
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=200)
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+
+    def timeout(self):
+        if len(self.latencies) < self.min_samples:
+            return self.max_timeout
+        ordered = sorted(self.latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return min(self.max_timeout, max(self.min_timeout, self.factor * p95))
+
+
+class _Item:
+    __slots__ = ('n', 'citation', 'attempts', 'round', 'tried', 'missing', 'error', 'start', 'last_mirror', 'blocked')
+
+    def __init__(self, n, citation):
+        self.n = n
+        self.citation = citation
+        self.attempts = 0
+        self.round = 0
+        self.tried = set()
+        self.missing = 0
+        self.error = ''
+        self.start = None
+        self.last_mirror = ''
+        self.blocked = None
+
+
+class Downloader:
+    """
+    Class. Schedules downloads over worker threads and mirrors: at most workers downloads at once overall, and at most per_host
+    at once from the same mirror, so a slow mirror cannot take every worker.
+    A failed download is tried on the other mirrors first. Once every mirror has failed it, it waits an exponentially
+    growing, jittered delay and goes behind citations with fewer attempts; it is given up after retries rounds, or at
+    once if every mirror answered that it does not have the article.
+    Each mirror has a CircuitBreaker, so a mirror that keeps failing is left alone for a while, and a time limit learnt
+    from its recent latencies (HostStats), so a dead download does not hold a worker for the full timeout. A citation
+    kept waiting over max_backoff seconds because every breaker is open is given up (a resumed run tries it again).
+    A download running past its time limit is given up; its thread is left to finish and replaced by a new one, and what
+    it downloads is thrown away. Beyond max_abandoned threads still stuck on downloads given up, fewer downloads run at
+    once until they finish, down to one, so a batch always moves on.
+    Each attempt downloads into a staging folder of its own. Attempts are given up by number, under the lock workers
+    install files with, so a file is moved into save_to and reported if and only if its attempt was not given up: an
+    attempt left behind and its retry never install the same file, and a file installed just before the time limit
+    is not lost.
+    Every downloaded file is checked with pdfcheck.check_pdf: a captcha page or a truncated file is moved to the quarantine
+    folder and counts as a failed attempt, so it is tried again like any other failure.
+        params:
+        backend -> object with a list of mirrors and fetch(citation, save_to, mirror, timeout) returning the path to the downloaded file. A SciHubBackend by default.
+        workers -> number of downloads running at once. 8 by default.
+        per_host -> number of downloads running at once from one mirror. 4 by default.
+        timeout -> longest time limit of a download, in seconds. 300 by default.
+        retries -> number of rounds over the mirrors per citation. 3 by default.
+        backoff -> delay before the second round, in seconds; it doubles with each round, up to max_backoff. 2 by default.
+        max_backoff -> longest delay between rounds, in seconds. 120 by default.
+        min_timeout -> shortest time limit learnt for a mirror, in seconds. 15 by default.
+        breaker -> function returning a new CircuitBreaker for each mirror. CircuitBreaker by default.
+        validate -> whether or not to check and quarantine downloaded files, see pdfcheck. True by default.
+        max_abandoned -> number of threads stuck on downloads given up that are replaced by new ones. workers by default.
+    """
+
+    def __init__(self, backend=None, workers=8, per_host=4, timeout=300, retries=3, backoff=2.0, max_backoff=120.0,
+                 min_timeout=15.0, breaker=CircuitBreaker, validate=True, max_abandoned=None):
+        self.backend = backend if backend is not None else SciHubBackend()
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.validate = validate
+        self.max_abandoned = workers if max_abandoned is None else max_abandoned
+        self.breakers = {x: breaker() for x in self.backend.mirrors}
+        self.stats = {x: HostStats(min(min_timeout, timeout), timeout) for x in self.backend.mirrors}
+
+    def run(self, citations, save_to):
+        """
+        Method. Generator. Downloads the full texts of citations into the directory save_to, yielding a DownloadResult for
+        each citation as soon as it is done, in order of completion.
+        """
+        if not os.path.exists(save_to):
+            os.makedirs(save_to)
+        self.save_to = save_to
+        self.tasks = queue.Queue()
+        self.outcomes = queue.Queue()
+        self.threads = []
+        # numbers of the attempts given up, read by the workers under lock before they install a file
+        self.lock = threading.Lock()
+        self.given_up = set()
+        ready = [(0, n, _Item(n, citation)) for n, citation in enumerate(citations)]
+        heapq.heapify(ready)
+        waiting = []
+        running = {}  # attempt number -> (item, mirror, started, deadline)
+        in_use = {x: 0 for x in self.backend.mirrors}
+        remaining = len(ready)
+        attempt_number = 0
+        try:
+            while remaining:
+                now = time.time()
+                while waiting and waiting[0][0] <= now:
+                    item = heapq.heappop(waiting)[2]
+                    heapq.heappush(ready, (item.attempts, item.n, item))
+                # dispatch in order of fewest attempts, while workers and mirrors are free; items that cannot go to
+                # any mirror now are put back
+                blocked = []
+                capacity = self._capacity()
+                while ready and len(running) < capacity and len(blocked) < 32:
+                    entry = heapq.heappop(ready)
+                    item = entry[2]
+                    mirror = self._choose_mirror(item, in_use, now)
+                    if mirror is None:
+                        if item.blocked is None:
+                            item.blocked = now
+                        if now - item.blocked >= self.max_backoff and all(x.is_open() for x in self.breakers.values()):
+                            # an item waits no longer for a mirror than between rounds, rather than one at a time
+                            # behind cooldowns that double with each failed trial
+                            remaining -= 1
+                            yield DownloadResult(item.citation, None, item.error or 'every mirror is cut off',
+                                                 item.attempts, now - item.start if item.start else 0.0, 0,
+                                                 item.last_mirror)
+                            continue
+                        if item.tried and self._round_over(item):
+                            # the mirrors it has not been tried on have been cut off since
+                            result = self._end_round(item, now, waiting)
+                            if result is not None:
+                                remaining -= 1
+                                yield result
+                            continue
+                        blocked.append(entry)
+                        continue
+                    attempt_number += 1
+                    item.attempts += 1
+                    item.blocked = None
+                    item.tried.add(mirror)
+                    if item.start is None:
+                        item.start = now
+                    deadline = now + self.stats[mirror].timeout()
+                    in_use[mirror] += 1
+                    running[attempt_number] = (item, mirror, now, deadline)
+                    self._ensure_threads(len(running))
+                    self.tasks.put((attempt_number, item.citation, mirror, deadline - now))
+                for entry in blocked:
+                    heapq.heappush(ready, entry)
+                wake = min([x[3] for x in running.values()] + ([waiting[0][0]] if waiting else []) + [now + 1.0])
+                try:
+                    outcomes = [self.outcomes.get(timeout=max(0.01, wake - time.time()))]
+                except queue.Empty:
+                    outcomes = []
+                now = time.time()
+                with self.lock:
+                    # downloads that finished while the caller held the generator were not late, whatever the clock
+                    # says now; nor were those installed before the lock was taken
+                    while True:
+                        try:
+                            outcomes.append(self.outcomes.get_nowait())
+                        except queue.Empty:
+                            break
+                    finished = [x for x in outcomes if x[0] in running]
+                    done = set(x[0] for x in finished)
+                    for expired, entry in list(running.items()):
+                        if expired not in done and entry[3] <= now:
+                            finished.append((expired, None, 'timeout after %.0f s' % (entry[3] - entry[2]), False))
+                            self.given_up.add(expired)
+                # a thread stuck on a download given up is left behind, a new one takes its place
+                self._ensure_threads(len(running) - len(finished))
+                for number, path, error, missing in finished:
+                    item, mirror, started, deadline = running.pop(number)
+                    in_use[mirror] -= 1
+                    self._record(mirror, path, error, missing, now - started)
+                    result = self._settle(item, mirror, path, error, missing, now - started, now, ready, waiting)
+                    if result is not None:
+                        remaining -= 1
+                        yield result
+        finally:
+            for _ in self.threads:
+                self.tasks.put(None)
+
+    def _choose_mirror(self, item, in_use, now):
+        """
+        Method. Returns the mirror for the next attempt of an item: one it has not been tried on this round, whose breaker
+        lets downloads through and which has a free slot, least busy first. None if there is no such mirror now.
+        """
+        candidates = [x for x in self.backend.mirrors if x not in item.tried and in_use[x] < self.per_host]
+        for mirror in sorted(candidates, key=lambda x: (self.breakers[x].is_open(), in_use[x])):
+            if self.breakers[mirror].allow(now):
+                return mirror
+        return None
+
+    def _settle(self, item, mirror, path, error, missing, seconds, now, ready, waiting):
+        """
+        Method. Records the outcome of an attempt. Returns a DownloadResult if the item is done, otherwise queues it again.
+        """
+        if path is not None:
+            self.stats[mirror].record(seconds)
+            self.breakers[mirror].record(True, now)
+            return DownloadResult(item.citation, path, '', item.attempts, now - item.start, os.path.getsize(path), mirror)
+        item.error = error
+        item.last_mirror = mirror
+        if missing:
+            # the mirror answered properly, it just does not have the article
+            item.missing += 1
+            self.breakers[mirror].record(True, now)
+        else:
+            self.breakers[mirror].record(False, now)
+        if not self._round_over(item):
+            # fail over to a mirror not tried yet
+            heapq.heappush(ready, (item.attempts, item.n, item))
+            return None
+        return self._end_round(item, now, waiting)
+
+    def _round_over(self, item):
+        """
+        Method. Whether an item has been tried on every mirror whose breaker is closed.
+        """
+        return not any(x not in item.tried and not self.breakers[x].is_open() for x in self.backend.mirrors)
+
+    def _end_round(self, item, now, waiting):
+        """
+        Method. Returns a failed DownloadResult if an item is out of rounds, or if every mirror tried said it does not have
+        the article; otherwise puts it in waiting until its backoff delay is over.
+        """
+        if item.missing >= len(item.tried) or item.round + 1 >= self.retries:
+            return DownloadResult(item.citation, None, item.error, item.attempts, now - item.start, 0, item.last_mirror)
+        item.round += 1
+        item.tried = set()
+        item.missing = 0
+        item.blocked = None
+        delay = min(self.max_backoff, self.backoff * 2 ** (item.round - 1)) * random.uniform(0.5, 1.5)
+        heapq.heappush(waiting, (now + delay, item.n, item))
+        return None
+
+    def _record(self, mirror, path, error, missing, seconds):
+        if metrics.registry is None:
+            return
+        if path is not None:
+            outcome = 'ok'
+            metrics.count('download_bytes', os.path.getsize(path), mirror=mirror)
+        elif missing:
+            outcome = 'missing'
+        else:
+            outcome = error.split(' ')[0] if error.startswith(('timeout', 'invalid')) else 'error'
+        metrics.count('download_attempts', mirror=mirror, outcome=outcome)
+        metrics.observe('download_attempt_seconds', seconds, mirror=mirror, outcome=outcome)
+
+    def _capacity(self):
+        """
+        Method. Returns the number of downloads that may run at once: workers, less the threads stuck on downloads given
+        up beyond max_abandoned, which are not replaced until they finish; at least one.
+        """
+        stuck = sum(1 for x in self.threads if x.current in self.given_up)
+        return max(1, self.workers - max(0, stuck - self.max_abandoned))
+
+    def _ensure_threads(self, busy):
+        """
+        Method. Starts threads until there is one for each of busy downloads, not counting those stuck on downloads given up.
+        """
+        self.threads = [x for x in self.threads if x.is_alive()]
+        free = sum(1 for x in self.threads if x.current not in self.given_up)
+        for _ in range(min(busy, self._capacity()) - free):
+            thread = _Worker(self.backend, self.save_to, self.tasks, self.outcomes, self.lock, self.given_up,
+                             self.validate)
+            thread.start()
+            self.threads.append(thread)
+
+
+class _Worker(threading.Thread):
+    """
+    Worker thread running fetches of the backend, until it gets None. Each fetch goes to a staging folder of its own;
+    the file is checked, then moved into save_to and reported under the downloader's lock, unless its attempt was given
+    up meanwhile. A thread whose download was given up takes new ones once it is over.
+    """
+
+    def __init__(self, backend, save_to, tasks, outcomes, lock, given_up, validate=True):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.validate = validate
+        self.save_to = save_to
+        self.tasks = tasks
+        self.outcomes = outcomes
+        self.lock = lock
+        self.given_up = given_up
+        self.current = None
+
+    def run(self):
+        for number, citation, mirror, timeout in iter(self.tasks.get, None):
+            if number in self.given_up:
+                # timed out while waiting in the queue
+                continue
+            self.current = number
+            staging = tempfile.mkdtemp(prefix='.refchaser_attempt_', dir=self.save_to)
+            try:
+                self._attempt(number, citation, mirror, timeout, staging)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            self.current = None
+
+    def _attempt(self, number, citation, mirror, timeout, staging):
+        staged, reason, failure = None, None, None
+        try:
+            staged = self.backend.fetch(citation, staging, mirror, timeout)
+            reason = pdfcheck.check_pdf(staged)[0] if self.validate else None
+        except ArticleNotFound as error:
+            failure = (str(error) or 'not found', True)
+        except Exception as error:
+            failure = (str(error) or type(error).__name__, False)
+        with self.lock:
+            if number in self.given_up:
+                # a retry may be installing the same file
+                return
+            try:
+                if failure is not None:
+                    outcome = (number, None) + failure
+                elif reason is not None:
+                    pdfcheck.quarantine(staged, reason, os.path.join(self.save_to, pdfcheck.quarantine_name))
+                    outcome = (number, None, 'invalid PDF (%s)' % (reason), False)
+                else:
+                    path = os.path.join(self.save_to, os.path.basename(staged))
+                    os.replace(staged, path)
+                    outcome = (number, path, '', False)
+            except Exception as error:
+                outcome = (number, None, str(error) or type(error).__name__, False)
+            self.outcomes.put(outcome)
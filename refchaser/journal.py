@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent journal of downloads, so an interrupted batch resumes where it stopped.
+"""
+
+import os, time, sqlite3, hashlib
+import refchaser.deduplicate as deduplicate
+
+journal_name = 'refchaser_journal.sqlite'
+
+
+def citation_key(citation):
+    """
+    Function. Returns the key of a citation in the journal: its normalized DOI, or its normalized title if it has no DOI.
+    A citation with neither is keyed by its database ID, or else by a hash of its authors, year and journal. Returns None
+    when none of these is known, as such citations cannot be told apart and are not journaled.
+    """
+    doi = deduplicate.normalize_doi(citation.doi)
+    if doi:
+        return doi
+    title = deduplicate.normalize_title(citation.title)
+    if title:
+        return 'title:' + title
+    if citation.databaseID:
+        return 'id:' + str(citation.databaseID).strip()
+    fields = [str(x).strip().lower() for x in (list(citation.authors) or [citation.first_author])]
+    fields += [str(citation.year).strip(), str(citation.journal).strip().lower()]
+    if not any(fields):
+        return None
+    return 'record:' + hashlib.sha256('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+
+class DownloadJournal:
+    """
+    Class. SQLite journal of the downloads of a folder: the state of every citation ('pending', 'done' or 'failed'), number of
+    attempts, size and path of the file and last error. Each result is committed as soon as it is known, in write-ahead-log
+    mode, so a crash loses at most the download in progress.
+        params:
+        save_pdf_to -> the folder the full texts are downloaded to; the journal is kept in it as refchaser_journal.sqlite.
+    """
+
+    def __init__(self, save_pdf_to):
+        if not os.path.exists(save_pdf_to):
+            os.makedirs(save_pdf_to)
+        self.journal_path = os.path.join(save_pdf_to, journal_name)
+        self.connection = sqlite3.connect(self.journal_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS downloads (
+            key TEXT PRIMARY KEY, batch TEXT, title TEXT, doi TEXT, state TEXT, attempts INTEGER DEFAULT 0,
+            bytes INTEGER DEFAULT 0, path TEXT DEFAULT '', error TEXT DEFAULT '', updated REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS downloads_batch ON downloads (batch, state)')
+        self.connection.commit()
+
+    def register(self, citations, batch=''):
+        """
+        Method. Adds citations not in the journal yet as 'pending'. Returns the citations still to download: those not done,
+        or done but whose file has since disappeared. Citations without a key (see citation_key) are always returned.
+        """
+        now = time.time()
+        keys = [citation_key(x) for x in citations]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO downloads (key, batch, title, doi, state, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                ((key, batch, str(x.title), str(x.doi), 'pending', now) for key, x in zip(keys, citations)
+                 if key is not None))
+        done = {key: path for key, path in self.connection.execute(
+            "SELECT key, path FROM downloads WHERE state = 'done'")}
+        remaining = []
+        for key, citation in zip(keys, citations):
+            path = done.get(key)
+            if path is None or not os.path.exists(path):
+                remaining.append(citation)
+        return remaining
+
+    def record(self, result):
+        """
+        Method. Records a downloader.DownloadResult and commits it.
+        """
+        key = citation_key(result.citation)
+        if key is None:
+            return
+        with self.connection:
+            self.connection.execute(
+                'UPDATE downloads SET state = ?, attempts = attempts + ?, bytes = ?, path = ?, error = ?, updated = ? '
+                'WHERE key = ?',
+                ('done' if result.path is not None else 'failed', result.attempts, result.size, result.path or '',
+                 result.error, time.time(), key))
+
+    def counts(self, batch=None):
+        """
+        Method. Returns a dictionary of state -> number of citations, for one batch or for every batch.
+        """
+        if batch is None:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM downloads GROUP BY state')
+        else:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM downloads WHERE batch = ? GROUP BY state',
+                                           (batch,))
+        counts = {'pending': 0, 'done': 0, 'failed': 0}
+        counts.update(dict(rows))
+        return counts
+
+    def failures(self, batch=None):
+        """
+        Method. Returns (title, doi, attempts, error) of the citations that could not be downloaded.
+        """
+        if batch is None:
+            return self.connection.execute(
+                "SELECT title, doi, attempts, error FROM downloads WHERE state = 'failed' ORDER BY title").fetchall()
+        return self.connection.execute(
+            "SELECT title, doi, attempts, error FROM downloads WHERE state = 'failed' AND batch = ? ORDER BY title",
+            (batch,)).fetchall()
+
+    def write_report(self, report_path, batch=None, seconds=None, duplicates=0):
+        """
+        Method. Writes a download report from the journal, replacing any earlier report at report_path.
+        duplicates is the number of articles of the bibliographic file not journaled as duplicates of articles in other
+        files.
+        """
+        counts = self.counts(batch)
+        failures = self.failures(batch)
+        with open(report_path, 'w', encoding='utf-8') as report:
+            report.writelines([
+                'Total number of articles identified from bibliographic file: %d\n' % (sum(counts.values()) + duplicates),
+                'Number of duplicates of articles in other files removed: %d\n' % (duplicates),
+                'Number of articles successfully retrieved: %d\n' % (counts['done']),
+                'Number of articles still pending: %d\n' % (counts['pending']),
+            ])
+            if seconds is not None:
+                report.write('Time taken by the last run: %s seconds\n' % (str(seconds)))
+            report.write('\nA total of %d articles were not downloaded. Please manually retrive them.\n' % (
+                len(failures)))
+            report.writelines('%s DOI: %s (%d attempts, %s)\n' % (title, doi, attempts, error)
+                              for title, doi, attempts, error in failures)
+
+    def close(self):
+        self.connection.close()
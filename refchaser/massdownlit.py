@@ -4,9 +4,17 @@
 Downloads full texts of citations from sci-hub.
 """
 
-from scidownl.scihub import SciHub
-import os, time, eventlet
+import os, time
 import refchaser.bibparser as bibparser
+import refchaser.citationcache as citationcache
+import refchaser.deduplicate as deduplicate
+import refchaser.downloader as downloader
+import refchaser.journal as journal
+import refchaser.metrics as metrics
+import refchaser.pdfstore as pdfstore
+
+# attributes of citations used to deduplicate, download, journal and report them
+download_fields = ('title', 'year', 'first_author', 'doi')
 
 
 class MassDownLit():
@@ -20,56 +28,81 @@ class MassDownLit():
         in_sep_folders -> Valid when path is a to directory. Whether or not to save full texts to seperate folders under the save_pdf_to folder, named after respective txt file that indexes them. True by default.
         reports -> whether or not to generate a download report. True by default.
         timeout -> how many seconds before the script should stop waiting while trying to download an individual pdf. an integer. 300 by default.
+        cache -> whether or not to keep parsed bibliographic files in a citationcache.CitationCache, so reruns on the same files skip parsing. True by default. An instance of CitationCache can also be passed.
+        dedup -> Valid when path is to a directory. Whether or not to download an article found in several bibliographic files only once. True by default.
+        workers -> number of articles downloaded at once. 8 by default.
+        per_host -> number of articles downloaded at once from the same mirror. 4 by default.
+        resume -> whether or not to keep a journal.DownloadJournal in each download folder, so a rerun skips articles already downloaded and retries only failures. True by default.
+        validate -> whether or not to check each downloaded file is a complete PDF, moving captcha pages and truncated files to a quarantine folder and trying them again, see pdfcheck. True by default.
+        store -> whether or not to keep full texts in a pdfstore.PDFStore shared by every project, looked up before downloading and filled with each download, so articles of earlier reviews are linked from disk instead of downloaded again. True by default. An instance of PDFStore can also be passed.
+        backend -> where full texts come from: a downloader.SciHubBackend (the default, through scidownl), a downloader.HTTPBackend for a given mirror, or any object with the same fetch and host methods.
+        lazy -> if True, nothing is downloaded in the constructor; call litdown, massdown or iter_downloads. False by default.
     """
 
-    def __init__(self, path: str, save_pdf_to: str, in_sep_folders=True, reports=True, timeout=300):
+    def __init__(self, path: str, save_pdf_to: str, in_sep_folders=True, reports=True, timeout=300, cache=True,
+                 dedup=True, workers=8, per_host=4, backend=None, resume=True, validate=True,
+                 store=True, lazy=False):
         self.timeout = timeout
-        self._main(path, save_pdf_to, in_sep_folders, reports)
+        self.dedup = dedup
+        self.workers = workers
+        self.per_host = per_host
+        self.resume = resume
+        self.validate = validate
+        self.backend = backend if backend is not None else downloader.SciHubBackend()
+        if cache is True:
+            cache = citationcache.CitationCache()
+        self.cache = cache or None
+        if store is True:
+            store = pdfstore.PDFStore()
+        self.store = store or None
+        self.batch_name = 'batch'
+        if not lazy:
+            self._main(path, save_pdf_to, in_sep_folders, reports)
 
-    def info_extract(self, file_path):
+    def info_extract(self, file_path, member=None):
         """
-        Method. Extracts article information from .ris/.ciw/.nbib/BibTeX bibliographic files.
+        Method. Extracts article information from .ris/.ciw/.nbib/BibTeX bibliographic files, compressed or not.
         params:
             file_path -> path to a bibliographic file of RIS/CIW/NBIB/BibTeX format.
-        Returns a list of instances of the citation class.
+            member -> name of the bibliographic file inside a .zip archive, if file_path is one.
+        Returns a list of instances of the citation class holding the attributes downloads need (see download_fields),
+        built from the columns of the parsed CitationTable, so abstracts, keywords and author lists are never decoded.
         """
-        self.batch_name = file_path.split('\\')[-1].split('.')[0]
-        citation_list = bibparser.BibFile(file_path).parse()
-        return citation_list
+        self.batch_name = os.path.basename(member or file_path.split('\\')[-1]).split('.')[0]
+        table = bibparser.BibFile(file_path, cache=self.cache, member=member).parse(as_table=True)
+        if self.cache is not None:
+            self.cache.save()
+        return [bibparser.Citation(title=title, year=year, first_author=first_author, doi=doi)
+                for title, year, first_author, doi in zip(*(table.column(x) for x in download_fields))]
 
-    def down_pdf(self, citation_list: list, save_pdf_to: str, report=True):
+    def down_pdf(self, citation_list: list, save_pdf_to: str, report=True, duplicates=0):
         """
-        Method. Takes in a list of instances of the citation class, downloading full texts from Scihub to a folder
+        Method. Takes in a list of instances of the citation class, downloading full texts from Scihub to a folder, several at a time (see downloader.Downloader).
         params
             citation_list -> a list of instances of the class citation.
             save_pdf_to -> the path to the directory where downloaded full texts are saved.
+            duplicates -> the number of articles of the bibliographic file left out of citation_list as duplicates of articles in other files.
         """
         self.Failures = []
-        self.num_articles = len(citation_list)
-        print('Ready to download %d articles from SciHub' % (self.num_articles))
+        self.num_articles = len(citation_list) + duplicates
+        download_journal = journal.DownloadJournal(save_pdf_to) if self.resume else None
         counter = 0
+        stored = []
         prompt = ''
         start_time = time.time()
-        for article in citation_list:
+        for result in self.iter_downloads(citation_list, save_pdf_to, download_journal):
+            if result.host == 'store':
+                stored.append(result)
+                continue
             counter += 1
-            try:
-                for i in range(0, 3):
-                    try:
-                        with eventlet.Timeout(self.timeout):
-                            SciHub(article.doi, save_pdf_to).download()
-                            prompt = "Article number %d downloaded successfully, %d articles remaining" % (
-                                counter, self.num_articles - counter)
-                            print(prompt)
-                            break
-                    except eventlet.Timeout:
-                        print("Timeout! Retrying download.")
-                        if i == 2:
-                            raise Exception
-                        continue
-            except:
-                prompt = "Article number %d downloaded unsuccessfully, %d articles remaining " % (
-                    counter, self.num_articles - counter)
-                self.Failures.append(article)
+            if result.path is not None:
+                prompt = "Article number %d downloaded successfully, %d articles remaining" % (
+                    counter, self.num_downloads - counter)
+            else:
+                prompt = "Article number %d downloaded unsuccessfully (%s), %d articles remaining " % (
+                    counter, result.error, self.num_downloads - counter)
+                self.Failures.append(result.citation)
+            print(prompt)
         end_time = time.time()
         if report == True:
             report_name = r'\%s_report' % (self.batch_name)
@@ -77,46 +110,130 @@ class MassDownLit():
             report_path = report_path.replace(r'\\', '\\')
             if not os.path.exists(save_pdf_to):
                 os.makedirs(save_pdf_to)
-            with open(report_path, 'a', encoding='utf-8') as report:
-                General_rep = [
-                    'Total number of articles identified from bibliographic file: %s\n' % (str(self.num_articles)),
-                    'Number of downloads attempted: %s\n' % (str(counter)),
-                    'Number of articles successfully retrieved: %d\n' % (int(counter) - len(self.Failures)),
-                    'Time taken: %s\n seconds' % (str(end_time - start_time))
-                ]
-                report.writelines(General_rep)
-                report.write('\nA total of %d articles were not downloaded. Please manually retrive them.\n' % (
-                    len(self.Failures)))
-                Failures_str = []
-                for Failed_article in self.Failures:
-                    Failed_article = str(Failed_article.title) + ' DOI: ' + str(Failed_article.doi) + '\n'
-                    Failures_str.append(Failed_article)
-                report.writelines(Failures_str)
+            if download_journal is not None:
+                # the report of a resumed batch covers every run, so it is rewritten rather than appended to
+                download_journal.write_report(report_path, self.batch_name, end_time - start_time, duplicates)
+            else:
+                with open(report_path, 'a', encoding='utf-8') as report:
+                    General_rep = [
+                        'Total number of articles identified from bibliographic file: %s\n' % (str(self.num_articles)),
+                        'Number of duplicates of articles in other files removed: %d\n' % (duplicates),
+                        'Number of articles linked from the PDF store: %d\n' % (len(stored)),
+                        'Number of downloads attempted: %s\n' % (str(counter)),
+                        'Number of articles successfully retrieved: %d\n' % (int(counter) + len(stored) - len(self.Failures)),
+                        'Time taken: %s\n seconds' % (str(end_time - start_time))
+                    ]
+                    report.writelines(General_rep)
+                    report.write('\nA total of %d articles were not downloaded. Please manually retrive them.\n' % (
+                        len(self.Failures)))
+                    Failures_str = []
+                    for Failed_article in self.Failures:
+                        Failed_article = str(Failed_article.title) + ' DOI: ' + str(Failed_article.doi) + '\n'
+                        Failures_str.append(Failed_article)
+                    report.writelines(Failures_str)
+        if download_journal is not None:
+            download_journal.close()
+        if self.store is not None:
+            self.store.save()
+            if self.store.hit_rate() is not None:
+                print('PDF store hit rate: %.1f%%, %.1f MB kept' % (100 * self.store.hit_rate(), self.store.total / 2 ** 20))
+
+    def iter_downloads(self, citation_list, save_pdf_to, download_journal=None):
+        """
+        Method. Generator. Yields a downloader.DownloadResult for each citation not downloaded in an earlier run: first
+        those linked from the PDF store (their host is 'store'), then each download as soon as it is done. Every result is
+        recorded in download_journal, and every download is added to the PDF store.
+        The downloader only moves on while results are being taken, so a slow consumer holds back new downloads.
+        params
+            citation_list -> a list of instances of the class citation.
+            save_pdf_to -> the path to the directory where downloaded full texts are saved.
+            download_journal -> a journal.DownloadJournal of save_pdf_to, or None.
+        """
+        if download_journal is not None:
+            remaining = download_journal.register(citation_list, self.batch_name)
+            print('%d articles already downloaded in an earlier run' % (len(citation_list) - len(remaining)))
+            citation_list = remaining
+        stored = []
+        if self.store is not None:
+            stored, citation_list = self.from_store(citation_list, save_pdf_to)
+            print('%d articles found in the PDF store' % (len(stored)))
+        self.num_downloads = len(citation_list)
+        print('Ready to download %d articles from SciHub, %d at a time' % (len(citation_list), self.workers))
+        for result in stored:
+            if download_journal is not None:
+                download_journal.record(result)
+            metrics.count('downloads', source='store', outcome='ok')
+            yield result
+        engine = downloader.Downloader(self.backend, self.workers, self.per_host, self.timeout, validate=self.validate)
+        for result in engine.run(citation_list, save_pdf_to):
+            if download_journal is not None:
+                download_journal.record(result)
+            if result.path is not None and self.store is not None:
+                self.store.put(result.citation.doi, result.path)
+            metrics.count('downloads', source='network', outcome='ok' if result.path is not None else 'failed')
+            metrics.observe('download_seconds', result.elapsed, outcome='ok' if result.path is not None else 'failed')
+            yield result
+
+    def from_store(self, citation_list, save_pdf_to):
+        """
+        Method. Links the full texts of citations found in the PDF store into the folder save_pdf_to.
+        Returns a list of downloader.DownloadResult of those found, and the list of citations still to download.
+        """
+        stored = []
+        missing = []
+        for citation in citation_list:
+            path = self.store.link_to(citation.doi, save_pdf_to)
+            if path is None:
+                missing.append(citation)
+                continue
+            stored.append(downloader.DownloadResult(citation, path, '', 0, 0.0, os.path.getsize(path), 'store'))
+        return stored, missing
 
-    def litdown(self, file_path: str, save_pdf_to: str, in_sep_folders=False, report=True):
+    def litdown(self, file_path: str, save_pdf_to: str, in_sep_folders=False, report=True, member=None):
         """
         Method. Downloads articles indexed in one blibliographic file to a folder
         param:
             file_path -> Path to the endnote "All Fields" export file, must be in the format of r'C:\\User\\citations.txt'.
             save_pdf_to -> Path to the directory where downloaded full texts shall be saved, must be in the format of r'C:\\User\\full_texts'.
             report -> whether or not to generate a download report. True by default.
+            member -> name of the bibliographic file inside a .zip archive, if file_path is one.
         """
         save_to = lambda: save_pdf_to + '\\' + file_path.split('\\')[-1] if in_sep_folders else save_pdf_to
-        self.down_pdf(citation_list=self.info_extract(file_path), save_pdf_to=save_to(), report=report)
+        self.down_pdf(citation_list=self.info_extract(file_path, member), save_pdf_to=save_to(), report=report)
 
     def massdown(self, dir_path: str, save_pdf_to: str, in_sep_folders=True, reports=True):
         """
         Method. Downloads articles indexed in all blibliographic files in a folder, to a designated folder or to seperate folders under it
         params:
-            dir_path -> Path to the folder endnote "All Fields" export files, must be in the format of r'C:\\User\\citations'.
+            dir_path -> Path to the folder of bibliographic files (plain, .gz, .bz2, .xz or .zip), must be in the format of r'C:\\User\\citations'. Files are recognized by content, not by extension.
             save_pdf_to -> Path to the folder where full texts shall be saved, must be in the format of r'C:\\User\\full_texts'.
             in_sep_folders -> whether or not to save full texts to seperate folders under the save_pdf_to folder, named after respective txt file that indexes them. True by default.
             report -> whether or not to generate a download report. True by default.
         """
-        for txt in os.listdir(dir_path):
-            folder_name = os.path.basename(save_pdf_to + '\\' + txt).rstrip('.txt')
-            save_to = lambda: save_pdf_to + '\\' + folder_name if in_sep_folders else save_pdf_to
-            self.litdown(file_path=dir_path + '\\' + txt, save_pdf_to=save_to(), report=reports)
+        # every file whose content is a bibliographic format, including files inside .zip archives
+        sources = bibparser.find_bibliographies(dir_path)
+        if not self.dedup:
+            for file_path, member in sources:
+                folder_name = os.path.basename(member or file_path).split('.')[0]
+                save_to = lambda: os.path.join(save_pdf_to, folder_name) if in_sep_folders else save_pdf_to
+                self.litdown(file_path=file_path, save_pdf_to=save_to(), report=reports, member=member)
+            return
+        batches = []
+        deduplicator = deduplicate.Deduplicator()
+        for file_path, member in sources:
+            citation_list = self.info_extract(file_path, member)
+            deduplicator.extend(citation_list, self.batch_name)
+            batches.append((self.batch_name, citation_list))
+        kept = set(map(id, deduplicator.unique()))
+        print('%d citations in %d files, %d unique articles' % (len(deduplicator.citations), len(batches), len(kept)))
+        if reports:
+            deduplicate.write_report(deduplicator, os.path.join(save_pdf_to, 'dedup_report.txt'))
+        for batch_name, citation_list in batches:
+            self.batch_name = batch_name
+            save_to = lambda: os.path.join(save_pdf_to, batch_name) if in_sep_folders else save_pdf_to
+            unique = [x for x in citation_list if id(x) in kept]
+            self.down_pdf(citation_list=unique, save_pdf_to=save_to(), report=reports,
+                          duplicates=len(citation_list) - len(unique))
 
     def _main(self, path: str, save_pdf_to: str, in_sep_folders=True, reports=True):
         """
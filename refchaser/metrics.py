@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+Counters, latency histograms and throughput of every stage of a run, written as a JSON summary and a Prometheus textfile.
+Metrics are off unless enable() is called: every recording function then returns at once, so instrumented code runs
+as fast as without them. Stages record per file, shard or attempt, never per record of a bibliographic file.
+"""
+
+import os, sys, json, time, bisect, threading, contextlib
+
+# upper bounds of the buckets of histograms, in seconds
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+prefix = 'refchaser_'
+summary_name = 'refchaser_metrics.json'
+prometheus_name = 'refchaser_metrics.prom'
+
+# the Registry of the run, None while metrics are off
+registry = None
+_null_timer = contextlib.nullcontext()
+
+
+class Registry:
+    """
+    Class. Counters and histograms of one run, safe to update from many threads. Each is identified by a name and its
+    labels, e.g. ('download_attempts', (('mirror', 'sci-hub'), ('outcome', 'ok'))).
+        params:
+        buckets -> upper bounds of the buckets of histograms, in seconds. default_buckets by default.
+        info -> dictionary describing the run, e.g. its settings, written with the metrics. Empty by default.
+    """
+
+    def __init__(self, buckets=default_buckets, info=None):
+        self.buckets = tuple(buckets)
+        self.info = dict(info or {})
+        self.started = time.time()
+        self.counters = {}
+        # (name, labels) -> [count of each bucket..., count above the last bucket, sum, largest value]
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.progress = None
+
+    def count(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0.0]
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] = max(histogram[-1], value)
+
+    def totals(self):
+        """
+        Method. Returns a dictionary of counter name -> value summed over its labels, in order of first use.
+        """
+        totals = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def summary(self):
+        """
+        Method. Returns the metrics as a dictionary ready for JSON: each counter with its rate per second over the run,
+        and each histogram with its count, sum, mean, largest value, cumulative buckets and percentiles estimated from them.
+        """
+        seconds = time.time() - self.started
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        result = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': seconds,
+            'info': self.info,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value,
+                          'per_second': value / seconds if seconds > 0 else None}
+                         for (name, labels), value in counters],
+            'histograms': [],
+        }
+        for (name, labels), histogram in histograms:
+            counts = histogram[:-2]
+            total = sum(counts)
+            cumulative = []
+            running = 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            result['histograms'].append({
+                'name': name, 'labels': dict(labels), 'count': total, 'sum': histogram[-2],
+                'mean': histogram[-2] / total if total else None, 'max': histogram[-1],
+                'buckets': {str(bound): n for bound, n in zip(self.buckets + ('+Inf',), cumulative)},
+                'p50': self._quantile(cumulative, 0.5, histogram[-1]),
+                'p95': self._quantile(cumulative, 0.95, histogram[-1]),
+                'p99': self._quantile(cumulative, 0.99, histogram[-1]),
+            })
+        return result
+
+    def prometheus(self):
+        """
+        Method. Returns the metrics in the Prometheus text format: counters as name_total, histograms as name_bucket,
+        name_sum and name_count, all prefixed with refchaser_.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        lines = ['# TYPE %srun_seconds gauge' % (prefix), '%srun_seconds %f' % (prefix, time.time() - self.started)]
+        if self.info:
+            lines += ['# TYPE %srun_info gauge' % (prefix), '%srun_info%s 1' % (prefix, _labels(sorted(self.info.items())))]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s%s_total counter' % (prefix, name))
+            lines.append('%s%s_total%s %s' % (prefix, name, _labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s%s histogram' % (prefix, name))
+            running = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram[:-2]):
+                running += count
+                lines.append('%s%s_bucket%s %d' % (prefix, name, _labels(labels + (('le', str(bound)),)), running))
+            lines.append('%s%s_sum%s %f' % (prefix, name, _labels(labels), histogram[-2]))
+            lines.append('%s%s_count%s %d' % (prefix, name, _labels(labels), running))
+        return '\n'.join(lines) + '\n'
+
+    def _quantile(self, cumulative, q, largest):
+        if not cumulative[-1]:
+            return None
+        rank = q * cumulative[-1]
+        for bound, running in zip(self.buckets, cumulative):
+            if running >= rank:
+                return min(bound, largest)
+        return largest
+
+
+class Progress(threading.Thread):
+    """
+    Class. Thread showing the counters of a Registry and their rates on one line of a stream, refreshed every interval
+    seconds until stop() is called.
+    """
+
+    def __init__(self, registry_, stream=None, interval=1.0):
+        super().__init__(daemon=True)
+        self.registry = registry_
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.show()
+
+    def show(self, end=''):
+        seconds = max(time.time() - self.registry.started, 1e-9)
+        line = ' | '.join('%s %d (%.1f/s)' % (name, value, value / seconds)
+                          for name, value in self.registry.totals().items())
+        try:
+            if self.stream.isatty():
+                self.stream.write('\r%6.0fs %s\033[K%s' % (seconds, line, end))
+            else:
+                self.stream.write('%6.0fs %s\n' % (seconds, line))
+            self.stream.flush()
+        except (OSError, ValueError):
+            # the stream was closed; progress is not worth failing the run for
+            self.stopped.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.show('\n')
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'started')
+
+    def __init__(self, registry_, name, labels):
+        self.registry = registry_
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.started, self.labels)
+        return False
+
+
+def enable(progress=False, buckets=default_buckets, info=None, stream=None, interval=1.0):
+    """
+    Function. Turns metrics on with a new Registry, and returns it.
+    params:
+        progress -> whether or not to show the counters live on stream (standard error by default). False by default.
+        buckets -> upper bounds of the buckets of histograms, in seconds. default_buckets by default.
+        info -> dictionary describing the run, e.g. its settings, written with the metrics.
+        interval -> seconds between two refreshes of the progress line. 1 by default.
+    """
+    global registry
+    disable()
+    registry = Registry(buckets, info)
+    if progress:
+        registry.progress = Progress(registry, stream, interval)
+        registry.progress.start()
+    return registry
+
+
+def disable():
+    """
+    Function. Turns metrics off, stopping the progress display. Returns the Registry of the run, or None if metrics were off.
+    """
+    global registry
+    finished, registry = registry, None
+    if finished is not None and finished.progress is not None:
+        finished.progress.stop()
+        finished.progress = None
+    return finished
+
+
+def count(name, value=1, **labels):
+    """
+    Function. Adds value to the counter name with the given labels, e.g. count('download_attempts', mirror='sci-hub').
+    """
+    if registry is not None:
+        registry.count(name, value, tuple(sorted(labels.items())))
+
+
+def observe(name, value, **labels):
+    """
+    Function. Adds a value, in seconds, to the histogram name with the given labels.
+    """
+    if registry is not None:
+        registry.observe(name, value, tuple(sorted(labels.items())))
+
+
+def timer(name, **labels):
+    """
+    Function. Returns a context manager adding the seconds spent in its block to the histogram name.
+    """
+    if registry is None:
+        return _null_timer
+    return _Timer(registry, name, tuple(sorted(labels.items())))
+
+
+def write_summary(file_path, registry_=None):
+    """
+    Function. Writes the JSON summary of the metrics of a run (the current one by default) to file_path.
+    """
+    registry_ = registry_ or registry
+    _write_atomic(file_path, json.dumps(registry_.summary(), indent=1))
+
+
+def write_prometheus(file_path, registry_=None):
+    """
+    Function. Writes the metrics of a run (the current one by default) to file_path in the Prometheus text format, e.g.
+    into the textfile directory of node_exporter. The file is replaced at once, so it is never read half-written.
+    """
+    registry_ = registry_ or registry
+    _write_atomic(file_path, registry_.prometheus())
+
+
+def finish(save_to=None):
+    """
+    Function. Turns metrics off and, if save_to is given, writes refchaser_metrics.json and refchaser_metrics.prom to
+    that folder. Returns the summary of the run, or None if metrics were off.
+    """
+    finished = disable()
+    if finished is None:
+        return None
+    if save_to:
+        if not os.path.exists(save_to):
+            os.makedirs(save_to)
+        write_summary(os.path.join(save_to, summary_name), finished)
+        write_prometheus(os.path.join(save_to, prometheus_name), finished)
+    return finished.summary()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                              for key, value in labels))
+
+
+def _write_atomic(file_path, text):
+    with open(file_path + '.tmp', 'w', encoding='utf-8') as write_str:
+        write_str.write(text)
+    os.replace(file_path + '.tmp', file_path)
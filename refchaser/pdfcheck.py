@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast checks that a downloaded file is a complete PDF, so captcha pages and truncated downloads never reach CERMINE.
+"""
+
+import os, re, time, shutil
+import refchaser.metrics as metrics
+
+# reason codes of invalid files
+reasons = {
+    'empty': 'the file is empty',
+    'too_small': 'the file is smaller than min_size',
+    'too_large': 'the file is larger than max_size',
+    'html': 'the file is an HTML page, e.g. a captcha or an error page',
+    'not_pdf': 'the file does not start with %PDF-',
+    'truncated': 'no %%EOF marker at the end of the file',
+    'no_xref': 'no startxref at the end of the file',
+    'bad_xref': 'startxref points beyond the end of the file',
+    'no_pages': 'the file has no page objects',
+}
+
+quarantine_name = 'quarantine'
+min_size = 1024
+max_size = 256 * 1024 * 1024
+
+# the byte after /Page must be read, so a match at the end of a chunk is only made once the next chunk tells /Page from /Pages
+page_object = re.compile(rb'/Type\s{0,8}/Page(?=[^A-Za-z])')
+start_xref = re.compile(rb'startxref\s+(\d+)')
+chunk_size = 1024 * 1024
+
+
+def check_pdf(file_path, min_size=min_size, max_size=max_size):
+    """
+    Function. Checks a file in one streaming pass: %PDF- header in the first 1024 bytes, %%EOF and startxref in the last
+    1024 bytes (where PDF readers look for them), an xref offset inside the file, at least one page and a size between
+    min_size and max_size bytes.
+    Returns (reason, pages): reason is None for a valid file, otherwise one of the codes in reasons; pages is the number
+    of page objects found, or None if they are in compressed object streams and cannot be counted without inflating them.
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return 'empty', 0
+    if size > max_size:
+        return 'too_large', None
+    with open(file_path, 'rb') as read_bytes:
+        head = read_bytes.read(1024)
+        if b'%PDF-' not in head:
+            return ('html' if b'<html' in head.lower() or head.lstrip().startswith(b'<') else 'not_pdf'), 0
+        if size < min_size:
+            return 'too_small', None
+        read_bytes.seek(max(0, size - 1024))
+        tail = read_bytes.read()
+        if b'%%EOF' not in tail:
+            return 'truncated', None
+        offsets = start_xref.findall(tail)
+        if not offsets:
+            return 'no_xref', None
+        if int(offsets[-1]) >= size:
+            return 'bad_xref', None
+        read_bytes.seek(0)
+        pages = 0
+        object_streams = False
+        carry = b''
+        for chunk in iter(lambda: read_bytes.read(chunk_size), b''):
+            window = carry + chunk
+            # a match whose next byte was in the previous window was counted with it; matches are shorter than the carry
+            pages += sum(1 for x in page_object.finditer(window) if x.end() >= len(carry))
+            object_streams = object_streams or b'/ObjStm' in window
+            carry = window[-32:]
+    if pages == 0:
+        if object_streams:
+            return None, None
+        return 'no_pages', 0
+    return None, pages
+
+
+def quarantine(file_path, reason, quarantine_dir=None, move=True):
+    """
+    Function. Moves an invalid file to a quarantine folder (a folder named quarantine next to it by default), with its
+    reason code appended to its name so it is not taken for a PDF again, and logs it in quarantine.txt there.
+    Returns the new path of the file.
+    move -> whether to move the file or to leave it where it is and quarantine a copy. True by default.
+    """
+    if quarantine_dir is None:
+        quarantine_dir = os.path.join(os.path.dirname(file_path), quarantine_name)
+    if not os.path.exists(quarantine_dir):
+        os.makedirs(quarantine_dir)
+    new_path = os.path.join(quarantine_dir, '%s.%s' % (os.path.basename(file_path), reason))
+    if move:
+        os.replace(file_path, new_path)
+    else:
+        shutil.copyfile(file_path, new_path)
+    metrics.count('quarantined', reason=reason)
+    with open(os.path.join(quarantine_dir, 'quarantine.txt'), 'a', encoding='utf-8') as log:
+        log.write('%s\t%s\t%s\t%s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), os.path.basename(file_path), reason,
+                                        reasons.get(reason, '')))
+    return new_path
+
+
+def screen(pdf_files, min_size=min_size, max_size=max_size, quarantine_dir=None, move=False):
+    """
+    Function. Checks PDF files with check_pdf and quarantines the invalid ones. As pdf_files may be the user's own files,
+    they are copied to the quarantine folder and left in place unless move is True.
+    Returns (valid, invalid): the paths of the valid files, and (path, reason) of the quarantined ones.
+    """
+    valid = []
+    invalid = []
+    for pdf_file in pdf_files:
+        reason = check_pdf(pdf_file, min_size, max_size)[0]
+        if reason is None:
+            valid.append(pdf_file)
+            continue
+        quarantine(pdf_file, reason, quarantine_dir, move)
+        invalid.append((pdf_file, reason))
+    return valid, invalid
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Store of downloaded full texts shared by every review project, so an article is downloaded once per machine.
+"""
+
+import os, time, shutil, hashlib
+import refchaser.citationcache as citationcache
+import refchaser.deduplicate as deduplicate
+import refchaser.downloader as downloader
+import refchaser.metrics as metrics
+
+default_store_dir = os.path.join(os.path.expanduser('~'), '.refchaser', 'pdf_store')
+
+
+def file_sha256(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as read_bytes:
+        for chunk in iter(lambda: read_bytes.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(source, destination):
+    """
+    Function. Makes destination a hard link to source, so both names share the same bytes on disk, or a copy where hard
+    links are not possible (another drive, a FAT or network drive). Returns 'link' or 'copy'.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        return 'link'
+    except OSError:
+        shutil.copyfile(source, destination)
+        return 'copy'
+
+
+class PDFStore(citationcache.ContentCache):
+    """
+    Class. Content-addressed store of full texts: each PDF is kept once under the SHA-256 of its bytes, and index.json maps
+    normalized DOIs to it, with its size and last use. Files are hard-linked between the store and the project folders
+    rather than copied, so a PDF in several projects takes its space once. A stored file found changed (e.g. annotated
+    through its link in a project folder) is dropped from the store rather than handed out.
+    Least recently used PDFs are evicted beyond max_bytes; copies in project folders are not touched. The index is written
+    by save(), not on every lookup.
+        params:
+        store_dir -> directory where PDFs are kept. ~/.refchaser/pdf_store by default.
+        max_bytes -> size cap of the store; least recently used PDFs are evicted beyond it. 10 GB by default.
+    """
+    suffix = '.pdf'
+
+    def __init__(self, store_dir=default_store_dir, max_bytes=10 * 1024 * 1024 * 1024):
+        super().__init__(store_dir, max_bytes)
+        self.index.setdefault('dois', {})
+        self.index.setdefault('stats', {'hits': 0, 'misses': 0})
+        self.total = self.size()
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+
+    def get(self, doi):
+        """
+        Method. Returns the path to the stored PDF of a DOI and marks it as used, or None if it is not in the store.
+        """
+        doi = deduplicate.normalize_doi(doi)
+        key = self.index['dois'].get(doi) if doi else None
+        entry = self.index['entries'].get(key) if key else None
+        if entry is not None:
+            try:
+                stat = os.stat(self._entry_path(key))
+            except OSError:
+                stat = None
+            if stat is None or stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime']:
+                self._drop(key)
+                entry = None
+        if entry is None:
+            self.misses += 1
+            self.index['stats']['misses'] += 1
+            metrics.count('store_lookups', outcome='miss')
+            return None
+        self.hits += 1
+        self.index['stats']['hits'] += 1
+        metrics.count('store_lookups', outcome='hit')
+        entry['last_used'] = time.time()
+        return self._entry_path(key)
+
+    def link_to(self, doi, save_to):
+        """
+        Method. Puts the stored PDF of a DOI into the folder save_to, as a hard link where possible, named like a download
+        (see downloader.pdf_file_name). Returns the path to it, or None if the DOI is not in the store.
+        """
+        entry_path = self.get(doi)
+        if entry_path is None:
+            return None
+        if not os.path.exists(save_to):
+            os.makedirs(save_to)
+        file_path = os.path.join(save_to, downloader.pdf_file_name(doi))
+        link_or_copy(entry_path, file_path)
+        return file_path
+
+    def put(self, doi, pdf_file):
+        """
+        Method. Adds a downloaded PDF under a DOI, hard-linked to pdf_file where possible, then evicts least recently used
+        PDFs beyond max_bytes. Returns the path to the stored PDF, or None for a citation without DOI.
+        """
+        doi = deduplicate.normalize_doi(doi)
+        if not doi:
+            return None
+        key = file_sha256(pdf_file)
+        entry_path = self._entry_path(key)
+        entry = self.index['entries'].get(key)
+        if entry is None or not os.path.exists(entry_path):
+            if entry is not None:
+                self._drop(key)
+            link_or_copy(pdf_file, entry_path)
+            stat = os.stat(entry_path)
+            entry = self.index['entries'][key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'dois': []}
+            self.total += stat.st_size
+            self.added += 1
+        entry['last_used'] = time.time()
+        if doi not in entry['dois']:
+            entry['dois'].append(doi)
+        self.index['dois'][doi] = key
+        self._evict()
+        return entry_path if key in self.index['entries'] else None
+
+    def hit_rate(self):
+        """
+        Method. Returns the share of lookups since opening that found a PDF, or None if there was none.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def save(self):
+        """
+        Method. Writes the index, with the hits and misses of every project that used the store.
+        """
+        self._save_index()
+
+    def _drop(self, key):
+        entry = self.index['entries'].get(key)
+        if entry is not None:
+            self.total -= entry['size']
+            for doi in entry.get('dois', []):
+                if self.index['dois'].get(doi) == key:
+                    del self.index['dois'][doi]
+        super()._drop(key)
+
+    def _evict(self):
+        if self.total > self.max_bytes:
+            super()._evict()
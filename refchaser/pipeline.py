@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+"""
+Runs a review end to end with every stage at work at once: download -> validate -> CERMINE -> extract -> queries.
+"""
+
+import os, time, shutil, tempfile, threading, queue, collections, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import refchaser.bibparser as bibparser
+import refchaser.deduplicate as deduplicate
+import refchaser.massdownlit as massdownlit
+import refchaser.refchaser as refchaser
+import refchaser.cerminepool as cerminepool
+import refchaser.citationcache as citationcache
+import refchaser.journal as journal
+import refchaser.metrics as metrics
+import refchaser.pdfcheck as pdfcheck
+
+
+class QueryWriter:
+    """
+    Class. Writes a query as terms stream in. Unchunked, the query is written to <name>.txt when the writer is closed.
+    Chunked, terms go to the current query until the next one would not fit the limits of the database (see
+    refchaser.query_limits), and each full query is written at once to <name>_NNN.txt, so it can be run while later
+    terms are still being extracted.
+        params:
+        save_to -> directory to write the query files to.
+        name -> stem of the file names, e.g. 'back_query'.
+        database -> 'WOS','PubMed','EMBASE','Scopus' or 'GS', or any name accepted by refchaser.database_name.
+        query_type -> 'titles', 'dois' or 'first_author'. 'titles' by default.
+        chunked -> whether or not to split the query within the limits of the database. False by default.
+    """
+
+    def __init__(self, save_to, name, database, query_type='titles', chunked=False):
+        self.save_to = save_to
+        self.name = name
+        self.database = database
+        self.query_type = query_type
+        self.chunked = chunked
+        limits = refchaser.query_limits[refchaser.database_name(database)]
+        prefix, separator, suffix = refchaser.query_syntax[refchaser.database_name(database)]
+        self.capacity = limits['max_chars'] - len(prefix) - len(suffix) + len(separator)
+        self.max_terms = limits['max_terms']
+        self.separator = separator
+        self.seen = set()
+        self.terms = []
+        self.room = self.capacity
+        self.files = []
+
+    def add(self, term):
+        for quoted in refchaser.quote_terms([str(term)], self.query_type):
+            if quoted in self.seen:
+                continue
+            self.seen.add(quoted)
+            cost = len(quoted) + len(self.separator)
+            if self.chunked and self.terms and (cost > self.room or len(self.terms) >= self.max_terms):
+                self._write()
+            self.terms.append(quoted)
+            self.room -= cost
+
+    def close(self):
+        """
+        Method. Writes the last query. Returns the paths to the query files.
+        """
+        if self.terms or not self.files:
+            self._write()
+        metrics.count('query_terms', len(self.seen), database=refchaser.database_name(self.database))
+        metrics.count('query_chunks', len(self.files), database=refchaser.database_name(self.database))
+        return self.files
+
+    def _write(self):
+        if self.chunked:
+            file_path = os.path.join(self.save_to, '{}_{:03d}.txt'.format(self.name, len(self.files) + 1))
+        else:
+            file_path = os.path.join(self.save_to, self.name + '.txt')
+        with open(file_path, 'w', encoding='utf-8') as query_file:
+            query_file.write(refchaser.join_query(self.terms, self.database))
+        self.files.append(file_path)
+        self.terms = []
+        self.room = self.capacity
+
+
+class _Stopped(Exception):
+    """
+    Raised in a stage waiting for room in a queue once the pipeline is stopped.
+    """
+
+
+class Pipeline:
+    """
+    Class. Downloads the full texts of the citations of bibliographic files, parses them with CERMINE, extracts their
+    reference lists and writes forward and backward queries, with the stages working at the same time on different
+    articles:
+        downloads (MassDownLit.iter_downloads, validated by pdfcheck) -> PDF queue -> CERMINE workers, each taking the PDFs
+        waiting in the queue as one shard (up to shard_size) -> JATS queue -> extraction (on extract_workers processes)
+        -> query writers and pooled_reflist.ris / index_articles.ris.
+    The queues hold at most queue_size items, so a stage that falls behind holds back the stages before it instead of
+    letting files pile up, and the time of a review approaches that of its slowest stage rather than the sum of all.
+    PDFs already in save_pdf_to from an earlier run are parsed too, after checking them with pdfcheck.
+    If the CERMINE or extraction stage fails, every stage stops instead of waiting on its queue, and run() raises the error;
+    if the download stage fails, the PDFs already downloaded are parsed first.
+        params:
+        path -> path to a bibliographic file or to a directory of them.
+        save_pdf_to -> directory where full texts are saved.
+        save_to -> directory where queries and bibliographic files of the references are saved.
+        forw_database -> database of the forward query, see refchaser.database_name.
+        back_database -> database of the backward query, see refchaser.database_name.
+        chunked -> whether or not to split queries within the limits of the databases, see QueryWriter. False by default.
+        download_workers -> number of downloads at once. 8 by default.
+        per_host -> number of downloads at once from the same mirror. 4 by default.
+        cermine_workers -> number of CERMINE processes at once. 1 by default.
+        shard_size -> most PDFs given to one CERMINE process at once. 10 by default.
+        extract_workers -> number of processes extracting JATS outputs. 1 (in the main process) by default.
+        queue_size -> number of items each queue holds before the stage feeding it waits. 32 by default.
+        timeout -> time limit of a download and of CERMINE on one PDF, in seconds. 300 by default.
+        cache -> whether or not to use a citationcache.JatsCache, see RefChaser. True by default. An instance can also be passed.
+        backend, store, resume -> as for MassDownLit.
+    """
+
+    def __init__(self, path, save_pdf_to, save_to, forw_database, back_database, chunked=False, download_workers=8,
+                 per_host=4, cermine_workers=1, shard_size=10, extract_workers=1, queue_size=32, timeout=300,
+                 cache=True, backend=None, store=True, resume=True):
+        self.path = path
+        self.save_pdf_to = save_pdf_to
+        self.save_to = save_to
+        self.forw_database = forw_database
+        self.back_database = back_database
+        self.chunked = chunked
+        self.cermine_workers = cermine_workers
+        self.shard_size = shard_size
+        self.extract_workers = extract_workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        if cache is True:
+            cache = citationcache.JatsCache()
+        self.cache = cache or None
+        self.cache_lock = threading.Lock()
+        self.downloads = massdownlit.MassDownLit(path, save_pdf_to, timeout=timeout, workers=download_workers,
+                                                 per_host=per_host, backend=backend, resume=resume, store=store,
+                                                 lazy=True)
+        self.result_list = []
+        self.failures = []
+        self.stats = collections.Counter()
+        self.busy = collections.Counter()  # seconds each stage spent working
+        # the stages count into stats and busy from their own threads
+        self.counter_lock = threading.Lock()
+
+    def run(self):
+        """
+        Method. Runs the pipeline. Returns the list of index articles, each an instance of the class citation with its ref_list.
+        """
+        for folder in (self.save_pdf_to, self.save_to):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        pdf_queue = queue.Queue(self.queue_size)
+        jats_queue = queue.Queue(self.queue_size)
+        self.errors = []
+        self.stop = threading.Event()
+        results_dir = tempfile.mkdtemp(prefix='refchaser_jats_')
+        start = time.time()
+        threads = [threading.Thread(target=self._download, args=(pdf_queue,), daemon=True)]
+        threads += [threading.Thread(target=self._parse, args=(pdf_queue, jats_queue, results_dir), daemon=True)
+                    for _ in range(self.cermine_workers)]
+        for thread in threads:
+            thread.start()
+        closer = threading.Thread(target=self._close_jats, args=(threads[1:], jats_queue), daemon=True)
+        closer.start()
+        try:
+            self._extract(jats_queue)
+        except Exception as error:
+            self._fail(error)
+        finally:
+            for thread in threads + [closer]:
+                thread.join()
+            shutil.rmtree(results_dir, ignore_errors=True)
+        if self.errors:
+            raise self.errors[0]
+        self.stats['seconds'] = time.time() - start
+        self._write_report()
+        return self.result_list
+
+    def _download(self, pdf_queue):
+        """
+        Method. Stage 1. Puts the PDFs already in save_pdf_to, then each downloaded PDF, into pdf_queue. An error is kept
+        for run() to raise, and the end of the stage is passed down in any case, so the stages after it do not wait forever.
+        """
+        try:
+            self._download_all(pdf_queue)
+        except _Stopped:
+            pass
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            try:
+                for _ in range(self.cermine_workers):
+                    self._offer(pdf_queue, None)
+            except _Stopped:
+                pass
+
+    def _download_all(self, pdf_queue):
+        busy = time.time()
+        queued = set()
+        for file_name in sorted(os.listdir(self.save_pdf_to)):
+            pdf_file = os.path.join(self.save_pdf_to, file_name)
+            if not file_name.lower().endswith('.pdf') or not os.path.isfile(pdf_file):
+                continue
+            reason = pdfcheck.check_pdf(pdf_file)[0]
+            if reason is not None:
+                pdfcheck.quarantine(pdf_file, reason)
+                self.failures.append('%s (%s)' % (file_name, reason))
+                continue
+            queued.add(pdf_file)
+            busy = self._put(pdf_queue, pdf_file, 'download', busy)
+        sources = bibparser.find_bibliographies(self.path) if os.path.isdir(self.path) else [(self.path, None)]
+        deduplicator = deduplicate.Deduplicator()
+        for file_path, member in sources:
+            deduplicator.extend(self.downloads.info_extract(file_path, member), self.downloads.batch_name)
+        citation_list = deduplicator.unique()
+        self._tally(self.stats, 'citations', len(citation_list))
+        self.downloads.batch_name = 'pipeline'
+        download_journal = journal.DownloadJournal(self.save_pdf_to) if self.downloads.resume else None
+        try:
+            for result in self.downloads.iter_downloads(citation_list, self.save_pdf_to, download_journal):
+                if result.path is None:
+                    self._tally(self.stats, 'download failures')
+                    continue
+                self._tally(self.stats, 'from store' if result.host == 'store' else 'downloaded')
+                if result.path not in queued:
+                    busy = self._put(pdf_queue, result.path, 'download', busy)
+        finally:
+            if download_journal is not None:
+                download_journal.close()
+            if self.downloads.store is not None:
+                self.downloads.store.save()
+            self._tally(self.busy, 'download', time.time() - busy)
+
+    def _parse(self, pdf_queue, jats_queue, results_dir):
+        """
+        Method. Stage 2, one thread per CERMINE worker. Takes a PDF, and every other PDF already waiting up to shard_size,
+        and runs CERMINE on them as one shard; cached outputs skip CERMINE. Puts the JATS outputs into jats_queue.
+        An error of CERMINE is kept for run() to raise, and the worker goes on taking PDFs, so the download stage is never
+        blocked; any other error stops the pipeline.
+        """
+        try:
+            self._parse_all(pdf_queue, jats_queue, results_dir)
+        except _Stopped:
+            pass
+        except Exception as error:
+            self._fail(error)
+
+    def _parse_all(self, pdf_queue, jats_queue, results_dir):
+        pool = cerminepool.CerminePool(1, self.timeout, self.shard_size, results_dir=results_dir if self.cache else None)
+        finished = False
+        while not finished:
+            shard = []
+            pdf_file = self._take(pdf_queue)
+            while pdf_file is not None:
+                cached = None
+                if self.cache is not None:
+                    with self.cache_lock:
+                        cached = self.cache.get(pdf_file)
+                if cached is not None:
+                    self._tally(self.stats, 'cached')
+                    metrics.count('jats_cache_hits')
+                    self._offer(jats_queue, cached)
+                else:
+                    shard.append(pdf_file)
+                if len(shard) >= self.shard_size:
+                    break
+                try:
+                    pdf_file = pdf_queue.get_nowait()
+                except queue.Empty:
+                    break
+            finished = pdf_file is None
+            if not shard:
+                continue
+            busy = time.time()
+            try:
+                results = list(pool.run(shard))
+            except Exception as error:
+                self.errors.append(error)
+                results = [(x, None) for x in shard]
+            for pdf_file, result_file in results:
+                if result_file is None:
+                    self.failures.append(os.path.basename(pdf_file))
+                    continue
+                self._tally(self.stats, 'parsed')
+                if self.cache is not None:
+                    with self.cache_lock:
+                        cached = self.cache.put(pdf_file, result_file)
+                    os.remove(result_file)
+                    result_file = cached
+                busy = self._put(jats_queue, result_file, 'cermine', busy)
+            self._tally(self.busy, 'cermine', time.time() - busy)
+
+    def _close_jats(self, parse_threads, jats_queue):
+        for thread in parse_threads:
+            thread.join()
+        if self.cache is not None:
+            # lookups and new entries of every CERMINE worker are written to the index at once
+            self.cache.save()
+        try:
+            self._offer(jats_queue, None)
+        except _Stopped:
+            pass
+
+    def _extract(self, jats_queue):
+        """
+        Method. Stage 3, in the calling thread. Extracts each JATS output as it arrives, on a pool of processes when
+        extract_workers > 1, and streams the articles into the query writers and bibliographic files.
+        """
+        forw = QueryWriter(self.save_to, 'forw_query', self.forw_database, chunked=self.chunked)
+        back = QueryWriter(self.save_to, 'back_query', self.back_database, chunked=self.chunked)
+        with open(os.path.join(self.save_to, 'index_articles.ris'), 'w', encoding='utf-8') as index_articles, \
+                open(os.path.join(self.save_to, 'pooled_reflist.ris'), 'w', encoding='utf-8') as pooled_reflist:
+            def write(article):
+                started = time.time()
+                self.result_list.append(article)
+                forw.add(article.title)
+                for reference in article.ref_list:
+                    back.add(reference.title)
+                bibparser.write_citations([article], index_articles, 'ris')
+                bibparser.write_citations(article.ref_list, pooled_reflist, 'ris')
+                print('%d: %s (%d references)' % (len(self.result_list), article.title, len(article.ref_list)))
+                self._tally(self.busy, 'write', time.time() - started)
+
+            if self.extract_workers == 1:
+                for JATS_file in iter(lambda: self._take(jats_queue), None):
+                    started = time.time()
+                    article = refchaser.record_extraction(refchaser.timed_extract(JATS_file), self.failures)
+                    self._tally(self.busy, 'extract', time.time() - started)
+                    write(article)
+            else:
+                pending = collections.deque()
+                # processes are spawned, not forked: a fork while the other stages' threads hold locks can deadlock
+                with ProcessPoolExecutor(max_workers=self.extract_workers,
+                                         mp_context=multiprocessing.get_context('spawn')) as pool:
+                    for JATS_file in iter(lambda: self._take(jats_queue), None):
+                        pending.append(pool.submit(refchaser.timed_extract, JATS_file))
+                        # no more than queue_size extractions in flight, or the JATS queue never fills up
+                        while pending and (pending[0].done() or len(pending) >= self.queue_size):
+                            write(refchaser.record_extraction(pending.popleft().result(), self.failures))
+                    while pending:
+                        write(refchaser.record_extraction(pending.popleft().result(), self.failures))
+        self.query_files = forw.close() + back.close()
+
+    def _put(self, stage_queue, item, stage, busy):
+        """
+        Method. Puts an item into a queue, counting the time spent waiting for room as idle time of the stage.
+        Returns the time the stage is busy again from.
+        """
+        if stage_queue.full():
+            waiting = time.time()
+            self._tally(self.busy, stage, waiting - busy)
+            self._tally(self.stats, stage + ' waits')
+            self._offer(stage_queue, item)
+            metrics.observe('pipeline_queue_wait_seconds', time.time() - waiting, stage=stage)
+            return time.time()
+        self._offer(stage_queue, item)
+        return busy
+
+    def _offer(self, stage_queue, item):
+        """
+        Method. Puts an item into a queue, waiting for room unless the pipeline is stopped; then raises _Stopped.
+        """
+        while True:
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.stop.is_set():
+                    raise _Stopped()
+
+    def _take(self, stage_queue):
+        """
+        Method. Returns the next item of a queue, or None, the end of the queue, once the pipeline is stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _fail(self, error):
+        """
+        Method. Keeps an error for run() to raise and stops every stage.
+        """
+        self.errors.append(error)
+        self.stop.set()
+
+    def _tally(self, counter, key, amount=1):
+        with self.counter_lock:
+            counter[key] += amount
+
+    def _write_report(self):
+        with open(os.path.join(self.save_to, 'pipeline_report.txt'), 'w', encoding='utf-8') as report:
+            report.write('Wall-clock time: %.1f seconds\n' % (self.stats['seconds']))
+            for stage in ('download', 'cermine', 'extract', 'write'):
+                report.write('Time working in the %s stage: %.1f seconds\n' % (stage, self.busy[stage]))
+            for key in sorted(self.stats):
+                if key != 'seconds':
+                    report.write('%s: %d\n' % (key, self.stats[key]))
+            report.write('Index articles extracted: %d\n' % (len(self.result_list)))
+            report.write('failed to parse the following %d items:\n' % (len(self.failures)))
+            report.writelines(x + '\n' for x in self.failures)
@@ -1,4 +1,346 @@
+# -*- coding: utf-8 -*-
+
 """
-Not available
+Local search engine: runs the title queries produced by RefChaser against bibliographic exports kept on disk.
 """
-print("this module is not finished")
\ No newline at end of file
+
+import os, re, hashlib
+from array import array
+from bisect import bisect_left
+import refchaser.bibparser as bibparser
+import refchaser.deduplicate as deduplicate
+import refchaser.citationcache as citationcache
+import refchaser.citationgraph as citationgraph
+
+INDEX_VERSION = 1
+MAGIC = b'RCQI%04d' % INDEX_VERSION
+
+# tokens of the query dialects of combine_title_list: WOS TI=(...), Scopus TITLE(...), PubMed [Title], EMBASE :ti
+query_token = re.compile(r'''
+    \s*(?:
+    (?P<field>[A-Za-z]{2,5}\s*=\s*\(|TITLE\s*\(|TITLE-ABS-KEY\s*\() |
+    (?P<open>\() |
+    (?P<close>\)) |
+    "(?P<phrase>[^"]*)" |
+    (?P<tag>\[[^\]]*\]|:[a-z]{2,3}\b) |
+    (?P<word>[^\s()"\[\]]+)
+    )''', re.X)
+title_fields = {'TI=(', 'TITLE(', '[title]', '[ti]', ':ti'}
+
+
+def tokens(title):
+    return deduplicate.normalize_title(title).split()
+
+
+class LocalIndex:
+    """
+    Class. Inverted index of the titles of bibliographic records with positional postings, so quoted titles are matched as phrases.
+    For every term, postings are a flat array of document, number of positions and the positions. On disk, the terms are
+    sorted and memory-mapped together with the postings, so an index opens without being read and terms are found by binary search.
+    Records added after opening are kept in memory until save().
+        params:
+        index_path -> path to an index file written by save(), opened if it exists. None for an index in memory only.
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self.titles = citationgraph.StringColumn()
+        self.dois = citationgraph.StringColumn()
+        self.years = citationgraph.StringColumn()
+        self.sources = citationgraph.StringColumn()
+        self.terms = []
+        self.term_offsets = array('Q', [0])
+        self.postings = array('L')
+        self.added = {}
+        self.files = {}
+        if index_path is not None and os.path.exists(index_path):
+            self._load(index_path)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, citation, source=''):
+        """
+        Method. Adds an instance of the citation class. Returns its document number.
+        """
+        doc = len(self.titles)
+        self.titles.append(str(citation.title))
+        self.dois.append(str(citation.doi))
+        self.years.append(str(citation.year))
+        self.sources.append(source)
+        positions = {}
+        for position, term in enumerate(tokens(citation.title)):
+            positions.setdefault(term, []).append(position)
+        for term, term_positions in positions.items():
+            postings = self.added.get(term)
+            if postings is None:
+                postings = self.added[term] = array('L')
+            postings.append(doc)
+            postings.append(len(term_positions))
+            postings.extend(term_positions)
+        return doc
+
+    def add_file(self, file_path, member=None):
+        """
+        Method. Adds the records of a bibliographic file, unless a file with the same content was added before. Returns the
+        number of records added.
+        """
+        sha = hashlib.sha256(member.encode('utf-8') if member else b'')
+        with open(file_path, 'rb') as read_bytes:
+            for chunk in iter(lambda: read_bytes.read(1024 * 1024), b''):
+                sha.update(chunk)
+        if sha.hexdigest() in self.files:
+            return 0
+        source = os.path.basename(member or file_path)
+        count = 0
+        for citation in bibparser.BibFile(file_path, member=member).iter_citations():
+            self.add(citation, source)
+            count += 1
+        self.files[sha.hexdigest()] = source
+        return count
+
+    def add_directory(self, dir_path):
+        """
+        Method. Adds the records of every bibliographic file in a directory, see bibparser.find_bibliographies.
+        """
+        return sum(self.add_file(file_path, member) for file_path, member in bibparser.find_bibliographies(dir_path))
+
+    def postings_of(self, term):
+        """
+        Method. Returns the flat postings of a term: document, number of positions, positions, and so on.
+        """
+        postings = array('L')
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            postings.extend(self.postings[self.term_offsets[i]:self.term_offsets[i + 1]])
+        if term in self.added:
+            postings.extend(self.added[term])
+        return postings
+
+    def term_documents(self, term):
+        """
+        Method. Returns the set of documents containing a term. A term ending with * matches every term it starts.
+        """
+        if term.endswith('*'):
+            prefix = term.rstrip('*')
+            matched = set(x for x in self.added if x.startswith(prefix))
+            i = bisect_left(self.terms, prefix)
+            while i < len(self.terms) and self.terms[i].startswith(prefix):
+                matched.add(self.terms[i])
+                i += 1
+            documents = set()
+            for x in matched:
+                documents |= self.term_documents(x)
+            return documents
+        documents = set()
+        postings = self.postings_of(term)
+        i = 0
+        while i < len(postings):
+            documents.add(postings[i])
+            i += 2 + postings[i + 1]
+        return documents
+
+    def phrase_documents(self, phrase):
+        """
+        Method. Returns the set of documents whose title contains the words of a phrase next to each other, in order.
+        """
+        words = tokens(phrase)
+        if not words:
+            return set()
+        if len(words) == 1:
+            return self.term_documents(words[0])
+        # start from the rarest word, then check the others at their offsets
+        positions = [self._positions(word) for word in words]
+        rarest = min(range(len(words)), key=lambda x: len(positions[x]))
+        documents = set()
+        for doc, rarest_positions in positions[rarest].items():
+            others = []
+            for j in range(len(words)):
+                if j != rarest:
+                    if doc not in positions[j]:
+                        break
+                    others.append((j - rarest, positions[j][doc]))
+            else:
+                for start in rarest_positions:
+                    if all(start + offset in other for offset, other in others):
+                        documents.add(doc)
+                        break
+        return documents
+
+    def search(self, query):
+        """
+        Method. Runs a query and returns the sorted document numbers of the records it hits.
+        The query may be written in any dialect produced by RefChaser: TI=("A" OR "B"), ("A"[Title]) OR ("B"[Title]),
+        "A":ti OR "B":ti, TITLE("A" OR "B") or "A" OR "B", and may use AND, NOT, parentheses and trailing * wildcards.
+        Every search is a title search.
+        """
+        return sorted(QueryParser(self, query).parse())
+
+    def count(self, query):
+        return len(self.search(query))
+
+    def citation(self, doc):
+        """
+        Method. Returns an instance of the citation class with the title, DOI and year of a document.
+        """
+        return bibparser.Citation(title=self.titles[doc], doi=self.dois[doc], year=self.years[doc])
+
+    def unique(self, documents):
+        """
+        Method. Collapses documents that are copies of the same article, e.g. hits of a query found in several exports.
+        Returns the first document of each article.
+        """
+        deduplicator = deduplicate.Deduplicator()
+        documents = list(documents)
+        for doc in documents:
+            deduplicator.add(self.citation(doc), self.sources[doc])
+        return [documents[group[0]] for group in deduplicator.groups()]
+
+    def save(self, index_path=None):
+        """
+        Method. Merges the records added since opening into the sorted terms and postings, and writes the index to
+        index_path (the path it was opened from by default).
+        """
+        index_path = index_path or self.index_path
+        if index_path is None:
+            raise Exception("no path to save the index to")
+        terms = sorted(set(self.terms) | set(self.added))
+        term_offsets = array('Q', [0])
+        postings = array('L')
+        for term in terms:
+            postings.extend(self.postings_of(term))
+            term_offsets.append(len(postings))
+        sections = [('term_offsets', term_offsets), ('postings', postings)]
+        sections += citationcache.pool_sections('terms', terms)
+        for name in ('titles', 'dois', 'years', 'sources'):
+            sections += citationcache.pool_sections(name, list(getattr(self, name)))
+        folder = os.path.dirname(index_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        citationcache.write_sections(index_path + '.tmp', MAGIC, {'documents': len(self), 'files': self.files}, sections)
+        # nothing may stay mapped from the old file when it is replaced (Windows)
+        for name in ('titles', 'dois', 'years', 'sources'):
+            column = citationgraph.StringColumn()
+            column.added = list(getattr(self, name))
+            setattr(self, name, column)
+        self.terms, self.term_offsets, self.postings, self.added = terms, term_offsets, postings, {}
+        os.replace(index_path + '.tmp', index_path)
+        self.index_path = index_path
+
+    def _load(self, index_path):
+        header, section = citationcache.map_sections(index_path, MAGIC)
+        self.files = header['files']
+        self.term_offsets = section('term_offsets', 'Q')
+        self.postings = section('postings', 'L')
+        self.terms = citationcache.MappedStringPool(section('terms_blob'), section('terms_offsets', 'Q'))
+        for name in ('titles', 'dois', 'years', 'sources'):
+            setattr(self, name, citationgraph.StringColumn(
+                citationcache.MappedStringPool(section(name + '_blob'), section(name + '_offsets', 'Q'))))
+
+    def _positions(self, term):
+        positions = {}
+        postings = self.postings_of(term)
+        i = 0
+        while i < len(postings):
+            count = postings[i + 1]
+            positions[postings[i]] = set(postings[i + 2:i + 2 + count])
+            i += 2 + count
+        return positions
+
+
+class QueryParser:
+    """
+    Class. Recursive descent parser of a title query, evaluated on a LocalIndex while it is parsed.
+    OR binds loosest, then AND (also between terms written side by side), then NOT.
+        params:
+        index -> the LocalIndex to search.
+        query -> the query string.
+    """
+
+    def __init__(self, index, query):
+        self.index = index
+        self.query = query
+        self.tokens = []
+        position = 0
+        query = query.rstrip()
+        while position < len(query):
+            match = query_token.match(query, position)
+            if match is None or match.end() == position:
+                raise Exception('cannot read the query at: %s' % (query[position:position + 30]))
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        self.position = 0
+
+    def parse(self):
+        documents = self._or()
+        if self.position < len(self.tokens):
+            raise Exception('unexpected %s in the query' % (self.tokens[self.position][1]))
+        return documents
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _operator(self, name):
+        kind, value = self._peek()
+        if kind == 'word' and value.upper() == name:
+            self.position += 1
+            return True
+        return False
+
+    def _or(self):
+        documents = self._and()
+        while self._operator('OR'):
+            documents = documents | self._and()
+        return documents
+
+    def _and(self):
+        documents = self._not()
+        while True:
+            if self._operator('AND'):
+                documents = documents & self._not()
+                continue
+            kind, value = self._peek()
+            if kind in (None, 'close') or (kind == 'word' and value.upper() in ('OR', 'NOT')):
+                return documents
+            documents = documents & self._not()
+
+    def _not(self):
+        documents = self._primary()
+        while self._operator('NOT'):
+            documents = documents - self._primary()
+        return documents
+
+    def _primary(self):
+        kind, value = self._peek()
+        if kind is None:
+            raise Exception('the query ends too early')
+        self.position += 1
+        if kind in ('open', 'field'):
+            if kind == 'field' and re.sub(r'\s+', '', value).upper() not in title_fields:
+                raise Exception('only title fields can be searched locally, not %s' % (value))
+            # an empty group, e.g. TI=() from an empty title list, hits nothing
+            documents = self._or() if self._peek()[0] != 'close' else set()
+            if self._peek()[0] != 'close':
+                raise Exception('missing ) in the query')
+            self.position += 1
+        elif kind == 'phrase':
+            documents = self.index.phrase_documents(value)
+        elif kind == 'word':
+            words = tokens(value.rstrip('*'))
+            if not words:
+                documents = set()
+            elif value.endswith('*'):
+                documents = self.index.phrase_documents(' '.join(words[:-1])) if len(words) > 1 else None
+                last = self.index.term_documents(words[-1] + '*')
+                documents = last if documents is None else documents & last
+            else:
+                documents = self.index.phrase_documents(value)
+        else:
+            raise Exception('unexpected %s in the query' % (value))
+        # field tags follow the term they apply to
+        kind, value = self._peek()
+        if kind == 'tag':
+            if value.lower() not in title_fields:
+                raise Exception('only title fields can be searched locally, not %s' % (value))
+            self.position += 1
+        return documents
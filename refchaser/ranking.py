@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ranks citations by relevance to a seed set of included articles, so the most relevant records are screened first.
+"""
+
+import os, re, math, uuid, itertools
+from array import array
+from bisect import bisect_right
+from collections import Counter
+import refchaser.bibparser as bibparser
+import refchaser.citationcache as citationcache
+
+MATRIX_VERSION = 2
+MAGIC = b'RCTM%04d' % MATRIX_VERSION
+default_vocabulary_path = os.path.join(os.path.expanduser('~'), '.refchaser', 'vocabulary.txt')
+default_matrix_cache_dir = os.path.join(os.path.expanduser('~'), '.refchaser', 'term_matrix_cache')
+
+word = re.compile(r'[^\W_]{2,}')
+stop_words = {'a', 'an', 'the', 'of', 'on', 'in', 'and', 'for', 'to', 'with', 'by', 'from', 'at', 'as', 'or', 'is', 'are',
+              'was', 'were', 'be', 'been', 'this', 'that', 'these', 'those', 'it', 'its', 'we', 'our', 'their', 'which',
+              'not', 'no', 'but', 'than', 'between', 'after', 'before', 'during', 'into', 'among', 'all', 'can', 'may',
+              'has', 'have', 'had', 'also', 'there', 'both', 'other', 'such', 'more', 'most', 'using', 'used'}
+
+
+def term_counts(citation):
+    """
+    Function. Returns a Counter of the terms of a citation's title, keywords and abstract. Title and keyword terms count twice.
+    """
+    counts = Counter(word.findall(str(citation.abstract).lower()))
+    heading = word.findall((str(citation.title) + ' ' + ' '.join(map(str, citation.keywords))).lower())
+    counts.update(heading)
+    counts.update(heading)
+    for term in stop_words.intersection(counts):
+        del counts[term]
+    return counts
+
+
+class Vocabulary(dict):
+    """
+    Class. Maps terms to ids that never change, so term matrices built in one run are still valid in the next.
+    Saved as a text file of one term per line, after a first line identifying the vocabulary; save() only appends new terms.
+        params:
+        vocabulary_path -> path to the vocabulary file, read if it exists. ~/.refchaser/vocabulary.txt by default, None for a vocabulary in memory only.
+    """
+
+    def __init__(self, vocabulary_path=default_vocabulary_path):
+        super().__init__()
+        self.vocabulary_path = vocabulary_path
+        self.terms = []
+        self.saved = 0
+        self.vocabulary_id = uuid.uuid4().hex
+        if vocabulary_path is not None and os.path.exists(vocabulary_path):
+            with open(vocabulary_path, 'r', encoding='utf-8') as read_terms:
+                self.vocabulary_id = read_terms.readline().split()[-1]
+                for line in read_terms:
+                    self[line.rstrip('\n')]
+            self.saved = len(self.terms)
+
+    def __missing__(self, term):
+        i = self[term] = len(self.terms)
+        self.terms.append(term)
+        return i
+
+    def save(self):
+        """
+        Method. Appends the terms added since the vocabulary was read or last saved to its file.
+        """
+        if self.vocabulary_path is None or self.saved == len(self.terms):
+            return
+        folder = os.path.dirname(self.vocabulary_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.vocabulary_path, 'a', encoding='utf-8') as write_terms:
+            if self.saved == 0 and write_terms.tell() == 0:
+                write_terms.write('#refchaser-vocabulary %s\n' % (self.vocabulary_id))
+            write_terms.writelines(term + '\n' for term in self.terms[self.saved:])
+        self.saved = len(self.terms)
+
+
+class TermMatrix:
+    """
+    Class. Sparse matrix of term frequencies, one row per citation, stored as compressed sparse rows: row offsets into an
+    array of term ids and an array of their frequencies. Each row is built at once from a Counter of the citation's terms.
+    The matrix is also kept transposed as postings, the rows and frequencies of each term, so the rows containing a term
+    are found without reading the others. Rows added with add() are transposed into a dictionary on the first lookup,
+    posting by posting in Python; save() writes the postings sorted by term id, as compressed sparse columns that load()
+    memory-maps, so a cached matrix is never transposed again.
+    refchaser needs nothing beyond the standard library, so the matrix is made of arrays rather than NumPy or SciPy sparse
+    matrices, and ranking loops in Python over the postings of the query terms only; see the 'rank' benchmark.
+        params:
+        vocabulary -> the Vocabulary giving term ids.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.offsets = array('Q', [0])
+        self.terms = array('L')
+        self.tfs = array('L')
+        self.lengths = array('L')
+        # term id -> rows and frequencies, interleaved, of rows added with add() up to row transposed
+        self.postings = {}
+        self.transposed = 0
+        # (term offsets, rows, frequencies) read by load()
+        self.columns = None
+        # (first row, TermMatrix) of matrices appended with extend_matrix()
+        self.parts = []
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, citation):
+        counts = term_counts(citation)
+        self.terms.extend(map(self.vocabulary.__getitem__, counts))
+        self.tfs.extend(counts.values())
+        self.offsets.append(len(self.terms))
+        self.lengths.append(sum(counts.values()))
+
+    def extend(self, citations):
+        for citation in citations:
+            self.add(citation)
+
+    def extend_matrix(self, matrix):
+        """
+        Method. Appends the rows of another TermMatrix built on the same vocabulary.
+        """
+        base = len(self.terms)
+        self.parts.append((len(self), matrix))
+        self.offsets.extend(x + base for x in matrix.offsets[1:])
+        self.terms.extend(matrix.terms)
+        self.tfs.extend(matrix.tfs)
+        self.lengths.extend(matrix.lengths)
+
+    def row(self, i):
+        """
+        Method. Returns a dictionary of term id -> frequency of a row.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return dict(zip(self.terms[start:end], self.tfs[start:end]))
+
+    def postings_of(self, term_id):
+        """
+        Method. Returns the rows containing a term, in order, and the term's frequency in each, as two arrays.
+        """
+        self._transpose()
+        rows, tfs = array('L'), array('L')
+        if self.columns is not None and term_id + 1 < len(self.columns[0]):
+            start, end = self.columns[0][term_id], self.columns[0][term_id + 1]
+            rows.extend(self.columns[1][start:end])
+            tfs.extend(self.columns[2][start:end])
+        posting = self.postings.get(term_id)
+        if posting is not None:
+            rows.extend(posting[0::2])
+            tfs.extend(posting[1::2])
+        for first, part in self.parts:
+            part_rows, part_tfs = part.postings_of(term_id)
+            rows.extend(part_rows if first == 0 else [x + first for x in part_rows])
+            tfs.extend(part_tfs)
+        return rows, tfs
+
+    def document_frequency(self, term_id):
+        """
+        Method. Returns the number of rows containing a term, from the lengths of its postings.
+        """
+        self._transpose()
+        frequency = 0
+        if self.columns is not None and term_id + 1 < len(self.columns[0]):
+            frequency += self.columns[0][term_id + 1] - self.columns[0][term_id]
+        posting = self.postings.get(term_id)
+        if posting is not None:
+            frequency += len(posting) // 2
+        for first, part in self.parts:
+            frequency += part.document_frequency(term_id)
+        return frequency
+
+    def save(self, file_path):
+        term_offsets, rows, tfs = array('Q', [0]), array('L'), array('L')
+        for term_id in sorted(set(self.terms)):
+            term_offsets.extend(itertools.repeat(len(rows), term_id + 1 - len(term_offsets)))
+            term_rows, term_tfs = self.postings_of(term_id)
+            rows.extend(term_rows)
+            tfs.extend(term_tfs)
+            term_offsets.append(len(rows))
+        citationcache.write_sections(file_path, MAGIC, {'vocabulary_id': self.vocabulary.vocabulary_id},
+                                     [('offsets', self.offsets), ('terms', self.terms), ('tfs', self.tfs),
+                                      ('lengths', self.lengths), ('term_offsets', term_offsets),
+                                      ('posting_rows', rows), ('posting_tfs', tfs)])
+
+    def load(self, file_path):
+        """
+        Method. Maps a matrix written by save() into memory as the rows of this matrix. Raises ValueError if it was built
+        on another vocabulary.
+        """
+        header, section = citationcache.map_sections(file_path, MAGIC)
+        if header['vocabulary_id'] != self.vocabulary.vocabulary_id:
+            raise ValueError('term matrix built on another vocabulary: %s' % (file_path))
+        self.offsets = section('offsets', 'Q')
+        self.terms = section('terms', 'L')
+        self.tfs = section('tfs', 'L')
+        self.lengths = section('lengths', 'L')
+        self.columns = (section('term_offsets', 'Q'), section('posting_rows', 'L'), section('posting_tfs', 'L'))
+        self.postings = {}
+        self.transposed = len(self)
+        self.parts = []
+        return self
+
+    def _transpose(self):
+        """
+        Method. Adds the rows added with add() since the last call to the postings; rows of matrices appended with
+        extend_matrix() keep their postings in those matrices.
+        """
+        if self.transposed == len(self):
+            return
+        skip = {first: first + len(part) for first, part in self.parts}
+        postings = self.postings
+        offsets, terms, tfs = self.offsets, self.terms, self.tfs
+        row = self.transposed
+        while row < len(self):
+            if row in skip:
+                row = skip[row]
+                continue
+            start, end = offsets[row], offsets[row + 1]
+            for term_id, tf in zip(terms[start:end], tfs[start:end]):
+                posting = postings.get(term_id)
+                if posting is None:
+                    posting = postings[term_id] = array('L')
+                posting.append(row)
+                posting.append(tf)
+            row += 1
+        self.transposed = len(self)
+
+
+class TermMatrixCache(citationcache.ContentCache):
+    """
+    Class. Cache of the term matrices of bibliographic files, keyed by their content and the vocabulary, so a file is only
+    tokenized once however many times it is ranked.
+        params:
+        vocabulary -> the Vocabulary the matrices are built on.
+        cache_dir -> directory where entries are kept. ~/.refchaser/term_matrix_cache by default.
+        max_bytes -> size cap of the cache; least recently used entries are evicted beyond it. 512 MB by default.
+    """
+    suffix = '.rtm'
+
+    def __init__(self, vocabulary, cache_dir=default_matrix_cache_dir, max_bytes=512 * 1024 * 1024):
+        self.vocabulary = vocabulary
+        super().__init__(cache_dir, max_bytes)
+
+    def get(self, file_path, member=None):
+        """
+        Method. Returns the cached TermMatrix of a file, or None if it is not cached. A corrupt entry is dropped.
+        """
+        key = self.key(file_path, member)
+        entry_path = self._lookup(key)
+        if entry_path is None:
+            return None
+        try:
+            return TermMatrix(self.vocabulary).load(entry_path)
+        except citationcache.entry_errors:
+            self._drop(key)
+            self.dirty = True
+            return None
+
+    def put(self, file_path, matrix, member=None):
+        # the vocabulary must be on disk before matrices referring to its ids are
+        self.vocabulary.save()
+        key = self.key(file_path, member)
+        matrix.save(self._entry_path(key) + '.tmp')
+        self._store(key, self._entry_path(key) + '.tmp')
+
+    def _salt(self, file_path):
+        return (self.vocabulary.vocabulary_id + os.path.splitext(file_path)[1]).encode('utf-8')
+
+
+class Ranker:
+    """
+    Class. Ranks records, e.g. the results of a database search, by their relevance to seed articles already included in a review.
+    The terms of the seeds' titles, keywords and abstracts make up one weighted query (its query_terms most distinctive
+    terms). Records are scored against it with BM25, with the cosine similarity of TF-IDF vectors, or with both.
+    Scores are accumulated in Python from the postings of the query terms, so only records sharing a term with the query
+    are visited; the others score 0. Document frequencies are the lengths of postings. The norms of the TF-IDF vectors
+    of the records visited are summed over all of their terms.
+        params:
+        vocabulary -> a Vocabulary, reused between runs. The one at ~/.refchaser/vocabulary.txt by default.
+        cache -> whether or not to keep term matrices of bibliographic files in a TermMatrixCache. True by default. An instance of TermMatrixCache can also be passed.
+        k1, b -> BM25 parameters. 1.2 and 0.75 by default.
+        query_terms -> number of terms kept in the query. 100 by default.
+    """
+
+    def __init__(self, vocabulary=None, cache=True, k1=1.2, b=0.75, query_terms=100):
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        if cache is True:
+            cache = TermMatrixCache(self.vocabulary)
+        self.cache = cache or None
+        self.k1 = k1
+        self.b = b
+        self.query_terms = query_terms
+        self.matrix = TermMatrix(self.vocabulary)
+        # (number of records, record -> norm, term id -> squared idf, frequency -> squared weight), see _norm
+        self.norms = (0, {}, {}, {})
+        self.tables = []
+        self.starts = []
+        self.sources = []
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def add(self, citations, source=''):
+        """
+        Method. Adds records to rank: a list of instances of the citation class or a CitationTable.
+        """
+        matrix = TermMatrix(self.vocabulary)
+        matrix.extend(citations)
+        self._add_rows(citations, matrix, source)
+
+    def add_file(self, file_path, member=None):
+        """
+        Method. Adds the records of a bibliographic file, reading its term matrix from the cache if the file is unchanged.
+        """
+        source = os.path.basename(member or file_path)
+        citations = bibparser.BibFile(file_path, member=member).parse(as_table=True)
+        matrix = self.cache.get(file_path, member) if self.cache is not None else None
+        if matrix is None or len(matrix) != len(citations):
+            matrix = TermMatrix(self.vocabulary)
+            matrix.extend(citations)
+            if self.cache is not None:
+                self.cache.put(file_path, matrix, member)
+        if self.cache is not None:
+            self.cache.save()
+        self._add_rows(citations, matrix, source)
+
+    def add_directory(self, dir_path):
+        """
+        Method. Adds the records of every bibliographic file in a directory, see bibparser.find_bibliographies.
+        """
+        for file_path, member in bibparser.find_bibliographies(dir_path):
+            self.add_file(file_path, member)
+
+    def record(self, i):
+        """
+        Method. Returns (citation, source file name) of the i-th record.
+        """
+        t = bisect_right(self.starts, i) - 1
+        return self.tables[t][i - self.starts[t]], self.sources[t]
+
+    def rank(self, seeds, method='bm25'):
+        """
+        Method. Returns (position of the record, score) of every record, most relevant first.
+        params:
+            seeds -> instances of the citation class of the included articles, e.g. the index articles of a RefChaser.
+            method -> 'bm25', 'cosine', or 'both' to rank by the mean of both scores, each divided by its highest value. 'bm25' by default.
+        """
+        if method not in ('bm25', 'cosine', 'both'):
+            raise Exception("method must be 'bm25', 'cosine' or 'both'")
+        n = len(self.matrix)
+        if n == 0:
+            return []
+        idf = {}
+        query = Counter()
+        for seed in seeds:
+            query.update(term_counts(seed))
+        for term in list(query):
+            term_id = self.vocabulary.get(term)
+            frequency = self.matrix.document_frequency(term_id) if term_id is not None else 0
+            if frequency:
+                idf[term_id] = math.log(1 + (n - frequency + 0.5) / (frequency + 0.5))
+                query[term_id] = query.pop(term)
+            else:
+                del query[term]
+        kept = sorted(query, key=lambda t: -query[t] * idf[t])[:self.query_terms]
+        query = {t: query[t] for t in kept}
+        postings = {t: self.matrix.postings_of(t) for t in query}
+        if method == 'bm25':
+            scores = self._bm25(query, idf, postings)
+        elif method == 'cosine':
+            scores = self._cosine(query, idf, postings)
+        else:
+            bm25, cosine = self._bm25(query, idf, postings), self._cosine(query, idf, postings)
+            top_bm25, top_cosine = max(bm25.values(), default=0) or 1.0, max(cosine.values(), default=0) or 1.0
+            scores = {i: (bm25[i] / top_bm25 + cosine.get(i, 0.0) / top_cosine) / 2 for i in bm25}
+        ranking = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        ranking.extend((i, 0.0) for i in range(n) if i not in scores)
+        return ranking
+
+    def _bm25(self, query, idf, postings):
+        """
+        Method. Returns a dictionary of record -> BM25 score of the records sharing a term with the query.
+        """
+        k1, b = self.k1, self.b
+        lengths = self.matrix.lengths
+        average_length = (sum(lengths) / len(lengths)) or 1.0
+        # length normalization of every record, computed once rather than once per posting
+        normalizers = [k1 * (1 - b + b * x / average_length) for x in lengths]
+        scores = [0.0] * len(lengths)
+        for t in query:
+            # saturated query term frequency, as in BM25 for long queries
+            weight = idf[t] * 9 * query[t] / (8 + query[t]) * (k1 + 1)
+            for i, tf in zip(*postings[t]):
+                scores[i] += weight * tf / (tf + normalizers[i])
+        # every term of the query has a positive idf, so records sharing a term with it score above 0
+        return {i: score for i, score in enumerate(scores) if score}
+
+    def _cosine(self, query, idf, postings):
+        """
+        Method. Returns a dictionary of record -> cosine similarity of TF-IDF vectors of the records sharing a term with
+        the query. See _norm for the norms of the records' vectors.
+        """
+        n = len(self.matrix)
+        tf_weights = {}
+        query_weights = {t: (1 + math.log(query[t])) * idf[t] for t in query}
+        query_norm = math.sqrt(sum(x * x for x in query_weights.values())) or 1.0
+        dots = [0.0] * n
+        for t in query:
+            weight = query_weights[t] * idf[t]
+            for i, tf in zip(*postings[t]):
+                tf_weight = tf_weights.get(tf)
+                if tf_weight is None:
+                    tf_weight = tf_weights[tf] = 1 + math.log(tf)
+                dots[i] += weight * tf_weight
+        # a term of the record adds at least its idf, which is positive, so records sharing a term with the query have a dot above 0
+        return {i: dot / (query_norm * self._norm(i)) for i, dot in enumerate(dots) if dot}
+
+    def _norm(self, i):
+        """
+        Method. Returns the norm of the TF-IDF vector of a record, which needs the idf of all its terms. Norms are kept
+        between rankings until records are added, as they do not depend on the query.
+        """
+        matrix = self.matrix
+        n = len(matrix)
+        if self.norms[0] != n:
+            self.norms = (n, {}, {}, {})
+        norms, squared_idf, squared_tf_weight = self.norms[1:]
+        norm = norms.get(i)
+        if norm is not None:
+            return norm
+        start, end = matrix.offsets[i], matrix.offsets[i + 1]
+        squared = 0.0
+        for t, tf in zip(matrix.terms[start:end], matrix.tfs[start:end]):
+            weight = squared_tf_weight.get(tf)
+            if weight is None:
+                weight = squared_tf_weight[tf] = (1 + math.log(tf)) ** 2
+            value = squared_idf.get(t)
+            if value is None:
+                frequency = matrix.document_frequency(t)
+                value = squared_idf[t] = math.log(1 + (n - frequency + 0.5) / (frequency + 0.5)) ** 2
+            squared += weight * value
+        norm = norms[i] = math.sqrt(squared) or 1.0
+        return norm
+
+    def _add_rows(self, citations, matrix, source):
+        self.starts.append(len(self.matrix))
+        self.tables.append(citations)
+        self.sources.append(source)
+        self.matrix.extend_matrix(matrix)
+
+
+def write_ranking(ranker, ranking, save_to, format_='ris'):
+    """
+    Function. Writes a ranked screening list: ranked_screening_list.txt, tab-delimited with rank, score, title, year, DOI and
+    source file of every record, and the records in ranked order as a bibliographic file for screening software.
+    params:
+        ranker -> the Ranker the ranking comes from.
+        ranking -> the result of Ranker.rank.
+        save_to -> the directory to save the files to.
+        format_ -> format of the bibliographic file: 'ris', 'ciw', 'nbib' or 'bib'. 'ris' by default.
+    """
+    if not os.path.exists(save_to):
+        os.makedirs(save_to)
+    format_fixed = bibparser.format_name(format_)
+    with open(os.path.join(save_to, 'ranked_screening_list.txt'), 'w', encoding='utf-8',
+              buffering=1024 * 1024) as ranked_list:
+        ranked_list.write('rank\tscore\ttitle\tyear\tdoi\tsource\n')
+        for rank, (i, score) in enumerate(ranking, 1):
+            citation, source = ranker.record(i)
+            ranked_list.write('%d\t%.4f\t%s\t%s\t%s\t%s\n' % (rank, score, ' '.join(str(citation.title).split()),
+                                                            citation.year, citation.doi, source))
+    with open(os.path.join(save_to, 'ranked_records.' + format_fixed), 'w', encoding='utf-8',
+              buffering=1024 * 1024) as ranked_records:
+        bibparser.write_citations((ranker.record(i)[0] for i, score in ranking), ranked_records, format_fixed)
@@ -4,8 +4,16 @@
 Extract information and reference lists of pdf academic articles with cermine.
 """
 
-import re, os, subprocess
+import re, os, io, time, subprocess, shutil, tempfile, collections, multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 import refchaser.bibparser as bibparser
+import refchaser.deduplicate as deduplicate
+import refchaser.cerminepool as cerminepool
+import refchaser.citationcache as citationcache
+import refchaser.citationgraph as citationgraph
+import refchaser.metrics as metrics
+import refchaser.pdfcheck as pdfcheck
 
 class RefChaser:
     """
@@ -13,45 +21,143 @@ class RefChaser:
     You need to call methods to produce queries or retrive citations.
     Params:
         pdf_path -> path to the directory containing all PDF files to be extracted. It must not be path to a single pdf file because cermine only accepts a path to a directory as argument.
+        as_table -> keep result_list as a columnar bibparser.CitationTable instead of a list, for large batches. False by default.
+        workers -> number of CERMINE processes to run at once on shards of the PDF files, see cerminepool.CerminePool. 1 by default.
+        cache -> whether or not to keep CERMINE's output in a citationcache.JatsCache, so only new or changed PDFs are sent to CERMINE. True by default. An instance of JatsCache can also be passed.
+        lazy -> if True, nothing is parsed in the constructor; articles are parsed as iter_articles(), or a method needing them, consumes them. False by default.
+        validate -> whether or not to check PDF files before CERMINE, copying empty, truncated or HTML files to a quarantine folder and skipping them instead of letting CERMINE time out on them, see pdfcheck. True by default.
     Methods:
+        iter_articles -> yields index articles with their reference lists as soon as each is extracted.
         back_query -> produces a query by joining all extracted references with Boolean operator OR for searching a database.
         forw_query -> produces a query by joining titles of index articles with Boolean operator OR for searching a database.
         back_WOS/PubMed/GS/EMBASE/Scopus -> retrieves extracted articles as citation files from Web of Science / NCBI PubMed / Google Scholar / EMBASE / Elsevier Scopus.
         forw_WOS/Scopus/GS -> retrieves citing articles as citation files from Web of Science / Scopus / Google Scholar.
     """
 
-    def __init__(self, pdf_path, timeout=300):
+    def __init__(self, pdf_path, timeout=300, as_table=False, workers=1, cache=True, lazy=False, validate=True):
         """
         Parses PDFs, extracts information, produces a list of instances of the citation class each containing results of an extracted PDF. Also records failures of extraction.
         """
         self.pdf_path = pdf_path
         self.timeout = timeout
-        self.result_list = []
+        self.workers = workers
+        self.validate = validate
+        if cache is True:
+            cache = citationcache.JatsCache()
+        self.cache = cache or None
+        self.result_list = bibparser.CitationTable() if as_table else []
         self.failures = []
-        self._main()
+        self.JATS_files = []
+        self._complete = False
+        if not lazy:
+            self._main()
 
     def parse_with_cermine(self, pdf_path):
         """
-        Method. Calls local CERMINE .jar file, returns the extraction results in JATS format.
+        Method. Calls local CERMINE .jar file, and lists the paths to the extraction results in JATS format in JATS_files.
         The CERMINE .jar package is version 1.13 and has "Main-Class: pl.edu.icm.cermine.ContentExtractor" appended to its MANIFEST.MF file.
         params:
             pdf_path: the full path to the directory containing pdf files to be parsed
         """
+        self.JATS_files = list(self.iter_JATS_files(pdf_path))
 
+    def iter_JATS_files(self, pdf_path):
+        """
+        Method. Generator. Yields the path to the JATS output of each PDF file as soon as it is ready: cached outputs first,
+        then the outputs of each shard of CERMINE workers as the shard completes. PDFs CERMINE failed on, and files
+        quarantined as invalid, go to self.failures.
+        params:
+            pdf_path: the full path to the directory containing pdf files to be parsed
+        """
+        self.failures = []
+        if self.cache is not None:
+            yield from self._parse_with_cache(pdf_path)
+            return
+        if self.workers > 1:
+            yield from self._parse_with_pool(pdf_path)
+            return
+        pdf_files = self._checked(
+            [os.path.join(pdf_path, x) for x in os.listdir(pdf_path) if x.lower().endswith('.pdf')])
+        started = time.perf_counter()
         subprocess.run("java -jar {}/cermine.jar -path {} -outputs jats -timeout {}".
             format(
             os.path.dirname(os.path.realpath(__file__)),
             pdf_path,
             str(self.timeout)))
+        cerminepool.record_shard(len(pdf_files), time.perf_counter() - started)
         all_files_in_dir = os.listdir(pdf_path)
         result_files = list(filter(lambda item: item.endswith('.cermxml'), all_files_in_dir))
         result_file_names = list((x.split('.')[0] for x in result_files))
-        self.failures = list(
+        failures = list(
             (x for x in all_files_in_dir if x.endswith('.pdf') and x.split('.')[0] not in set(result_file_names)))
-        self.JATS_list = []
+        self.failures += failures
+        metrics.count('cermine_pdfs', len(pdf_files) - len(failures), outcome='ok')
+        metrics.count('cermine_pdfs', len(failures), outcome='failed')
         for result_file in result_files:
-            with open(pdf_path + '/' + result_file, 'r', encoding='latin1') as r:
-                self.JATS_list.append(r.read())
+            yield os.path.join(pdf_path, result_file)
+
+    def _parse_with_pool(self, pdf_path):
+        """
+        Method. Generator. Parses the PDF files of a directory on a cerminepool.CerminePool, yielding results as each shard completes.
+        """
+        pdf_files = self._checked(
+            sorted(os.path.join(pdf_path, x) for x in os.listdir(pdf_path) if x.lower().endswith('.pdf')))
+        print('Parsing %d PDF files with %d CERMINE workers' % (len(pdf_files), self.workers))
+        for pdf_file, result_file in cerminepool.CerminePool(self.workers, self.timeout).run(pdf_files):
+            if result_file is None:
+                self.failures.append(os.path.basename(pdf_file))
+                continue
+            yield result_file
+
+    def _parse_with_cache(self, pdf_path):
+        """
+        Method. Generator. Yields the JATS output of unchanged PDFs from the cache and sends only new or changed PDFs to CERMINE.
+        Stale .cermxml files next to the PDFs are ignored.
+        """
+        pdf_files = sorted(os.path.join(pdf_path, x) for x in os.listdir(pdf_path) if x.lower().endswith('.pdf'))
+        pending = []
+        cached_files = []
+        for pdf_file in pdf_files:
+            cached = self.cache.get(pdf_file)
+            if cached is None:
+                pending.append(pdf_file)
+                continue
+            cached_files.append(cached)
+        # the index is written once for the batch, not on every lookup
+        self.cache.save()
+        print('%d PDF files found in cache, %d to parse with CERMINE' % (len(pdf_files) - len(pending), len(pending)))
+        metrics.count('jats_cache_hits', len(cached_files))
+        yield from cached_files
+        # PDFs found in the cache were parsed before, so only the others are checked
+        pending = self._checked(pending)
+        if not pending:
+            return
+        results_dir = tempfile.mkdtemp(prefix='refchaser_jats_')
+        # with one worker, one JVM parses all pending PDFs as before
+        shard_size = len(pending) if self.workers == 1 else 20
+        pool = cerminepool.CerminePool(self.workers, self.timeout, shard_size, results_dir=results_dir)
+        try:
+            for pdf_file, result_file in pool.run(pending):
+                if result_file is None:
+                    self.failures.append(os.path.basename(pdf_file))
+                    continue
+                yield self.cache.put(pdf_file, result_file)
+        finally:
+            self.cache.save()
+            shutil.rmtree(results_dir, ignore_errors=True)
+
+    def _checked(self, pdf_files):
+        """
+        Method. Returns the valid PDF files among pdf_files. Invalid ones are copied to the quarantine folder, left in place
+        and added to self.failures with their reason code.
+        """
+        if not self.validate:
+            return pdf_files
+        valid, invalid = pdfcheck.screen(pdf_files)
+        if invalid:
+            print('%d files are not valid PDFs and were copied to the quarantine folder' % (len(invalid)))
+        self.failures += ['%s (%s)' % (os.path.basename(x), reason) for x, reason in invalid]
+        return valid
 
     def JATS_extract(self, JATS):
         """
@@ -59,79 +165,65 @@ class RefChaser:
         Each refernce is identified by its title, year of publication, journal and first author.
         Returns an instance of the class citation, including a ref_list attribute, also a list of instances of the class citation.
         params:
-            JATS -> path to an XML-like file produced by cermine .jar after it extracts a pdf. Exists only after parse_with_cermine is called.
+            JATS -> path to an XML-like file produced by cermine .jar after it extracts a pdf, or the text of such a file.
         """
+        return extract_jats(JATS)
 
-        article = bibparser.Citation()
-
-        # Extracting information of index articles.
-
-        # extract title
-        try:
-            article.title = re.search(r'<article-title>(.*?)</article-title>', JATS, re.S).group(1)
-        except:
-            article.title = ''
+    def extract_all(self, JATS_files=None):
+        """
+        Method. Extracts every JATS file on a pool of processes, one file per task, keeping the order of the files.
+        Returns a list of instances of the class citation.
+        params:
+            JATS_files -> paths to JATS files. self.JATS_files by default.
+        """
+        JATS_files = self.JATS_files if JATS_files is None else JATS_files
+        if self.workers == 1 or len(JATS_files) < 2:
+            return [record_extraction(timed_extract(x), self.failures) for x in JATS_files]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return [record_extraction(x, self.failures) for x in pool.map(timed_extract, JATS_files, chunksize=8)]
 
-        # extract doi
-        try:
-            article.doi = re.search(r'<article-id.*?>(.*?)</article-id>', JATS).group(1)
-        except:
-            article.doi = ''
-
-        # identify references
-        ref_list = re.findall(r'<ref id="ref\d{1,3}">(.*?)</ref>', JATS, re.S)
-
-        # Extracting information of references
-        for ref in ref_list:
-            indiv_ref = bibparser.Citation()
-
-            # extract authors
-            authors_list = []
-            try:
-                authors = re.findall(r'<string-name>(.*?)</string-name>', ref, re.S)
-                for author in authors:
-                    try:
-                        given_name = re.search(r'<given-names>(.*?)</given-names>', author).group(1)
-                        given_name = given_name.replace(",", "").replace(";", "").replace(" ", "").replace("\n", "")
-                        surname = re.search(r'<surname>(.*?)</surname>', author).group(1)
-                        surname = surname.replace(",", "").replace(";", "").replace(" ", "").replace("\n", "")
-                        author_name = surname + ", " + given_name
-                        authors_list.append(author_name)
-                    except:
-                        pass
-            except:
-                pass
-            if len(authors_list) == 0:
-                authors_list = ['']
-            indiv_ref.authors = authors_list
-            indiv_ref.first_author = authors_list[0]
-            #print(indiv_ref.first_author)
-
-            # extract year
-            try:
-                year = re.search(r'<year>(\d{4})</year>', ref).group(1)
-                indiv_ref.year = str(year)
-            except:
-                indiv_ref.year = ''
-
-            # extract title
-            try:
-                potential_title = re.search(r'<article-title>(.*?)</article-title>', ref).group(1)
-                indiv_ref.title = potential_title.replace('\n', '').replace('?', '').replace('*', '').replace(':',
-                                                                                                              '').replace(
-                    '>', '').replace('<', '').replace('|', '')
-            except:
-                indiv_ref.title = ''
-
-            # extract journal
-            try:
-                indiv_ref.journal = re.search(r'<source>(.*?)</source>', ref, re.S).group(1)
-            except:
-                indiv_ref.journal = ''
-
-            article.ref_list.append(indiv_ref)
-
-        return article
+    def iter_articles(self):
+        """
+        Method. Generator. Yields each index article, an instance of the class citation with its ref_list, as soon as its
+        JATS output is ready and extracted, and appends it to result_list. Once every PDF is done the failures are written
+        to report.txt. After a complete run, the articles are read back from result_list instead of parsing again.
+        With more than one worker, extraction runs on a pool of processes while CERMINE is still working on later shards.
+        """
+        if self._complete:
+            yield from self.result_list
+            return
+        # a run abandoned halfway is started over
+        self.result_list = type(self.result_list)()
+        self.JATS_files = []
+        if self.workers == 1:
+            for JATS_file in self.iter_JATS_files(self.pdf_path):
+                self.JATS_files.append(JATS_file)
+                article = record_extraction(timed_extract(JATS_file), self.failures)
+                self.result_list.append(article)
+                yield article
+        else:
+            pending = collections.deque()
+            # processes are spawned, not forked: a fork while the CERMINE pool's threads hold locks can deadlock
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                for JATS_file in self.iter_JATS_files(self.pdf_path):
+                    self.JATS_files.append(JATS_file)
+                    pending.append(pool.submit(timed_extract, JATS_file))
+                    while pending and pending[0].done():
+                        article = record_extraction(pending.popleft().result(), self.failures)
+                        self.result_list.append(article)
+                        yield article
+                while pending:
+                    article = record_extraction(pending.popleft().result(), self.failures)
+                    self.result_list.append(article)
+                    yield article
+        self._complete = True
+        self._write_report()
+
+    def articles(self):
+        """
+        Method. Returns an iterator over index articles: result_list once parsing is complete, iter_articles() before that.
+        """
+        return iter(self.result_list) if self._complete else self.iter_articles()
 
     def combine_title_list(self, title_list, database, query_type='titles'):
         """
@@ -142,104 +234,154 @@ class RefChaser:
             database ->  what database you want to use your query on? must be one of the following: 'WOS','PubMed','EMBASE','GS','Scopus'
             query_type -> must be 'titles','dois' or 'first_author', 'titles' by default
         """
-        title_list = list(set(title_list))  # remove duplicates
-        final_query = []
-        if query_type in ['titles', 'title', 'Title', 'Titles', 'TITLE', 'TITLES']:
-            title_list = list(filter(lambda indiv_title: len(str(indiv_title)) > 20, title_list))
-            for indiv_t in title_list:
-                indiv_t = '"' + indiv_t.replace('\n', '').lstrip('/').rstrip('/').lstrip('\'').rstrip("\'").lstrip(
-                    ' ').rstrip(' ') + '"'
-                final_query.append(indiv_t)
-        elif query_type in ['dois', 'doi', 'DOI', 'DOIS', 'DOIs', 'Dois', 'Doi']:
-            title_list = list(filter(lambda indiv_title: re.search(r'10\.\d{4,9}/(\S+\.)?(\S+)', indiv_title) and len(
-                indiv_title.split('.')) > 10, title_list))
-            for indiv_t in title_list:
-                indiv_t = '"' + indiv_t.replace('\n', '').lstrip('/').rstrip('/').lstrip('\\').rstrip('\\').lstrip(
-                    ' ').rstrip(' ') + '"'
-                final_query.append(indiv_t)
-        else:
-            for indiv_t in title_list:
-                indiv_t = '"' + indiv_t.replace('\n', '').lstrip('/').rstrip('/').lstrip('\\').rstrip('\\').lstrip(
-                    ' ').rstrip(' ') + '"'
-                final_query.append(indiv_t)
-
-        if database in ['1', 'WOS', 'Web of Science', 'web of science']:
-            return 'TI=(' + ' OR '.join(final_query) + ")"  # example TI=("Title One" OR "Title Two" OR "Title Three")
-        elif database in ['2', 'PubMed', 'PM', 'pubmed', 'Pubmed']:
-            return '(' + '[Title]) OR ('.join(
-                final_query) + '[Title])'  # example ("Title One"[Title]) OR ("Title Two"[Title]) OR ("Title Three"[Title])
-        elif database in ['3', 'EMBASE', 'em', 'EM']:
-            return ':ti OR '.join(final_query) + ':ti'  # example "Title One":ti OR "Title Two":ti OR "Title Three":ti
-        elif database in ['4', 'Scopus', 'SCOPUS', 'scopus']:
-            return 'TITLE(' + ' OR '.join(
-                final_query) + ')'  # example TITLE("Title One" OR "Title Two" OR "Title Three")
-        else:
-            return ' OR '.join(final_query)  # example "Title One" OR "Title Two" OR "Title Three"
+        with metrics.timer('query_build_seconds', database=database_name(database)):
+            terms = quote_terms(title_list, query_type)
+            query = join_query(terms, database)
+        metrics.count('query_terms', len(terms), database=database_name(database))
+        return query
 
-    def back_query(self, database):
+    def combine_title_chunks(self, title_list, database, query_type='titles', max_chars=None, max_terms=None):
+        """
+        Method. Like combine_title_list, but packs the titles into as few queries as possible that each stay within the
+        limits of the database (see query_limits), with first-fit decreasing bin packing.
+        Returns a list of queries. A single title longer than max_chars gets a query of its own.
+        params:
+            title_list -> list of titles of extracted articles
+            database ->  'WOS','PubMed','EMBASE','GS' or 'Scopus'
+            query_type -> must be 'titles','dois' or 'first_author', 'titles' by default
+            max_chars -> maximum length of a query. The limit of the database in query_limits by default.
+            max_terms -> maximum number of terms joined with OR in a query. The limit of the database in query_limits by default.
+        """
+        started = time.perf_counter()
+        limits = query_limits[database_name(database)]
+        max_chars = max_chars or limits['max_chars']
+        max_terms = max_terms or limits['max_terms']
+        prefix, separator, suffix = query_syntax[database_name(database)]
+        capacity = max_chars - len(prefix) - len(suffix) + len(separator)
+        bins = []  # [room left, terms]
+        terms = quote_terms(title_list, query_type)
+        for term in sorted(terms, key=lambda x: (-len(x), x)):
+            cost = len(term) + len(separator)
+            for chunk in bins:
+                if chunk[0] >= cost and len(chunk[1]) < max_terms:
+                    chunk[0] -= cost
+                    chunk[1].append(term)
+                    break
+            else:
+                bins.append([capacity - cost, [term]])
+        queries = [join_query(chunk[1], database) for chunk in bins]
+        metrics.observe('query_build_seconds', time.perf_counter() - started, database=database_name(database))
+        metrics.count('query_terms', len(terms), database=database_name(database))
+        metrics.count('query_chunks', len(queries), database=database_name(database))
+        return queries
+
+    def back_query(self, database, chunked=False):
         """
         Method. For searching backward. 
         Returns a query to search for the references of index articles as a string.
         You can print the query or save it to a .txt file.
         params:
             database: what database you want to search with your query? must be one of the following: 'WOS','PubMed','EMBASE','Scopus','GS'
+            chunked -> if True, returns a list of queries within the limits of the database, see combine_title_chunks. False by default.
         """
         titles_list = []
-        for index_article in self.result_list:
+        for index_article in self.articles():
             for citation in index_article.ref_list:
                 titles_list.append(citation.title)
+        if chunked:
+            return self.combine_title_chunks(titles_list, database)
         return self.combine_title_list(titles_list, database)
 
-    def forw_query(self, database, query_type='titles'):
+    def forw_query(self, database, query_type='titles', chunked=False):
         """
         Method. For searching backward. 
         Returns a query to search for articles that cite index articles as a string. You can print the query or save it to a .txt file.
         params:
             database: what database you want to use your query at? must be one of the following: 'WOS','PubMed','EMBASE','GS','Scopus'
             query_type -> must be 'titles','dois', 'first_author' or 'authors'. 'titles' by default
+            chunked -> if True, returns a list of queries within the limits of the database, see combine_title_chunks. False by default.
         """
+        combine = self.combine_title_chunks if chunked else self.combine_title_list
         titles_list = []
         dois_list = []
         first_author_list = []
         authors_list = []
-        for index_article in self.result_list:
+        for index_article in self.articles():
             titles_list.append(index_article.title)
             dois_list.append(index_article.doi)
             first_author_list.append(index_article.first_author)
             authors_list.append(index_article.authors)
         if query_type in ['titles', 'title', 'Title', 'Titles', 'TITLE', 'TITLES']:
-            return self.combine_title_list(titles_list, database, 'titles')
+            return combine(titles_list, database, 'titles')
         elif query_type in ['dois', 'doi', 'DOI', 'DOIS', 'DOIs', 'Dois', 'Doi']:
-            return self.combine_title_list(dois_list, database, 'dois')
+            return combine(dois_list, database, 'dois')
         elif query_type in ['first_author', 'firstauthor', 'first author', '1st author', '1st_author', '1stauthor']:
-            return self.combine_title_list(first_author_list, database, 'first_author')
+            return combine(first_author_list, database, 'first_author')
 
     def save_ref_list(self, format_: str, save_to: str, separately: bool):
-        if format_ in ['ris', '.ris', 'RIS']:
-            format_fixed = 'ris'
-        elif format_ in ['ciw', '.ciw', 'CIW']:
-            format_fixed = 'ciw'
-        elif format_ in ['nbib', '.nbib', 'NBIB']:
-            format_fixed = 'nbib'
-        elif format_ in ['bibtex', 'BibTeX', 'bib', '.bib']:
-            format_fixed = 'bib'
-        with open(self.pdf_path + 'index_articles_n={}.{}'.format(len(self.result_list), format_fixed), 'a',
-                  encoding='utf-8') as index_articles:
-            index_articles.writelines([x.write(format_) for x in self.result_list])
+        """
+        Method. Saves index articles and their references as bibliographic files, streaming records into buffered files as it goes.
+        params:
+            format_ -> 'ris', 'ciw', 'nbib' or 'bib'.
+            save_to -> the directory to save the files to.
+            separately -> if True, the references of each index article go to a file named after its title, otherwise all go to pooled_reflist.
+        """
+        format_fixed = bibparser.format_name(format_)
+        if not self._complete:
+            self._main()
+        if not os.path.exists(save_to):
+            os.makedirs(save_to)
+        with open(os.path.join(save_to, 'index_articles_n={}.{}'.format(len(self.result_list), format_fixed)), 'w',
+                  encoding='utf-8', buffering=1024 * 1024) as index_articles:
+            bibparser.write_citations(self.result_list, index_articles, format_fixed)
         if separately:
             for article in self.result_list:
-                title_fixed = article.title.replace('-', ' ').replace.lstrip('/').rstrip('/').lstrip('\'').rstrip(
-                    "\'").lstrip(' ').rstrip(' ').rstrip('.')
-                with open(self.pdf_path + '/' + title_fixed + '.' + format_fixed, 'a',
-                          encoding='utf-8') as indiv_reflist:
-                    indiv_reflist.writelines([x.write(format_) for x in article.ref_list])
+                title_fixed = re.sub(r'[\\/:*?"<>|\n]', '', article.title.replace('-', ' ')).strip(' \'.')[:150]
+                with open(os.path.join(save_to, (title_fixed or 'untitled') + '.' + format_fixed), 'w',
+                          encoding='utf-8', buffering=1024 * 1024) as indiv_reflist:
+                    bibparser.write_citations(article.ref_list, indiv_reflist, format_fixed)
         else:
-            with open(self.pdf_path + '/pooled_reflist.' + format_fixed, 'a', encoding='utf-8') as pooled_reflist:
-                for article in self.result_list:
-                    pooled_reflist.writelines([x.write(format_) for x in article.ref_list])
+            with open(os.path.join(save_to, 'pooled_reflist.' + format_fixed), 'w', encoding='utf-8',
+                      buffering=1024 * 1024) as pooled_reflist:
+                bibparser.write_citations((x for article in self.result_list for x in article.ref_list),
+                                          pooled_reflist, format_fixed)
 
-    def crosscheck_extracted_citations(self, citations):
-        pass
+    def crosscheck_extracted_citations(self, citations, threshold=0.6):
+        """
+        Method. Matches the extracted references of all index articles against screening records, e.g. the results of a search.
+        Uses a deduplicate.CitationMatcher, which only scores records sharing year, first-author surname or title prefix with a reference.
+        Returns a match table: a list of dictionaries with keys 'index_article', 'reference', 'match' (None when unmatched) and 'score'.
+        params:
+            citations -> path to a bibliographic file, or an iterable of instances of the citation class.
+            threshold -> minimum score of a match, between 0 and 1. 0.6 by default.
+        """
+        if isinstance(citations, str):
+            citations = bibparser.BibFile(citations).parse(as_table=True)
+        matcher = deduplicate.CitationMatcher(citations, threshold)
+        match_table = []
+        for index_article in self.articles():
+            for reference in index_article.ref_list:
+                match, score = matcher.match(reference)
+                match_table.append({'index_article': index_article, 'reference': reference, 'match': match,
+                                    'score': round(score, 3)})
+        return match_table
+
+    def update_graph(self, graph, hop=None):
+        """
+        Method. Adds the index articles and their references to a citationgraph.CitationGraph, e.g. to chase references over several rounds.
+        Returns the graph.
+        params:
+            graph -> an instance of citationgraph.CitationGraph, or a path to a graph file, which is opened (or created) and saved.
+            hop -> hop of index articles new to the graph. 0 by default; index articles found in an earlier round keep their hop.
+        """
+        graph_path = None
+        if isinstance(graph, str):
+            graph_path = graph
+            graph = citationgraph.CitationGraph(graph_path)
+        graph.extend(self.articles(), hop)
+        if graph_path is not None:
+            graph.save()
+        return graph
 
     def back_WOS(self, saveto):
         pass
@@ -266,12 +408,258 @@ class RefChaser:
         pass
 
     def _main(self):
-        self.parse_with_cermine(self.pdf_path)
-        for result in self.JATS_list:
-            self.result_list.append(self.JATS_extract(result))
+        for _ in self.iter_articles():
+            pass
+
+    def _write_report(self):
         failures_report = 'failed to parse the following %s items:' % (str(len(self.failures)))
         with open(self.pdf_path + '/report.txt', 'a', encoding='utf-8') as report:
             report.write(failures_report)
             report.writelines(self.failures)
         print(failures_report)
         print(self.failures)
+
+
+# (prefix, separator, suffix) of a query joining quoted terms with OR
+query_syntax = {
+    'WOS': ('TI=(', ' OR ', ')'),  # example TI=("Title One" OR "Title Two" OR "Title Three")
+    'PubMed': ('(', '[Title]) OR (', '[Title])'),  # example ("Title One"[Title]) OR ("Title Two"[Title])
+    'EMBASE': ('', ':ti OR ', ':ti'),  # example "Title One":ti OR "Title Two":ti OR "Title Three":ti
+    'Scopus': ('TITLE(', ' OR ', ')'),  # example TITLE("Title One" OR "Title Two" OR "Title Three")
+    'GS': ('', ' OR ', ''),  # example "Title One" OR "Title Two" OR "Title Three"
+}
+
+# conservative limits of a single query of each database, used to split long queries; adjust if a database changes them
+query_limits = {
+    'WOS': {'max_chars': 6000, 'max_terms': 600},
+    'PubMed': {'max_chars': 4000, 'max_terms': 1000},
+    'EMBASE': {'max_chars': 4000, 'max_terms': 1000},
+    'Scopus': {'max_chars': 4000, 'max_terms': 500},
+    'GS': {'max_chars': 256, 'max_terms': 32},
+}
+
+
+def database_name(database):
+    """
+    Function. Returns 'WOS', 'PubMed', 'EMBASE', 'Scopus' or 'GS' for any of the names or numbers of a database accepted by
+    RefChaser's queries. Unknown databases are treated as Google Scholar.
+    """
+    if database in ['1', 'WOS', 'Web of Science', 'web of science']:
+        return 'WOS'
+    elif database in ['2', 'PubMed', 'PM', 'pubmed', 'Pubmed']:
+        return 'PubMed'
+    elif database in ['3', 'EMBASE', 'em', 'EM']:
+        return 'EMBASE'
+    elif database in ['4', 'Scopus', 'SCOPUS', 'scopus']:
+        return 'Scopus'
+    else:
+        return 'GS'
+
+
+def unquote(term):
+    """
+    Function. Returns a term without line breaks and with its double quotes replaced by spaces: a quote inside a quoted
+    term would end it early, and the query languages of the databases have no way to escape one.
+    """
+    return re.sub(r' {2,}', ' ', term.replace('\n', '').replace('"', ' '))
+
+
+def quote_terms(title_list, query_type='titles'):
+    """
+    Function. Removes duplicates and unusable entries from a list of titles, DOIs or authors, and returns them in double quotes.
+    Double quotes inside an entry are dropped (see unquote).
+    """
+    title_list = list(set(title_list))  # remove duplicates
+    final_query = []
+    if query_type in ['titles', 'title', 'Title', 'Titles', 'TITLE', 'TITLES']:
+        title_list = list(filter(lambda indiv_title: len(str(indiv_title)) > 20, title_list))
+        for indiv_t in title_list:
+            indiv_t = '"' + unquote(indiv_t).lstrip('/').rstrip('/').lstrip('\'').rstrip("\'").lstrip(
+                ' ').rstrip(' ') + '"'
+            final_query.append(indiv_t)
+    elif query_type in ['dois', 'doi', 'DOI', 'DOIS', 'DOIs', 'Dois', 'Doi']:
+        title_list = list(filter(lambda indiv_title: re.search(r'10\.\d{4,9}/(\S+\.)?(\S+)', indiv_title) and len(
+            indiv_title.split('.')) > 10, title_list))
+        for indiv_t in title_list:
+            indiv_t = '"' + unquote(indiv_t).lstrip('/').rstrip('/').lstrip('\\').rstrip('\\').lstrip(
+                ' ').rstrip(' ') + '"'
+            final_query.append(indiv_t)
+    else:
+        for indiv_t in title_list:
+            indiv_t = '"' + unquote(indiv_t).lstrip('/').rstrip('/').lstrip('\\').rstrip('\\').lstrip(
+                ' ').rstrip(' ') + '"'
+            final_query.append(indiv_t)
+    return final_query
+
+
+def join_query(terms, database):
+    """
+    Function. Joins quoted terms with OR in the syntax of a database.
+    """
+    prefix, separator, suffix = query_syntax[database_name(database)]
+    return prefix + separator.join(terms) + suffix
+
+
+# pieces of JATS output cut out by extract_jats_tolerant
+jats_front = re.compile(r'<front>.*?</front>', re.S)
+jats_ref = re.compile(r'<ref(?:\s[^>]*)?>.*?</ref>', re.S)
+markup_tag = re.compile(r'<[^>]+>')
+undefined_entity = re.compile(r'&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)')
+
+
+def _text(element):
+    return ''.join(element.itertext()) if element is not None else ''
+
+
+def _clean_name(name):
+    return name.replace(",", "").replace(";", "").replace(" ", "").replace("\n", "")
+
+
+def _ref_to_citation(ref):
+    """
+    Function. Turns a <ref> element of CERMINE's JATS output into an instance of the class citation.
+    """
+    indiv_ref = bibparser.Citation()
+
+    # extract authors
+    authors_list = []
+    for author in ref.iter('string-name'):
+        given_name = author.find('given-names')
+        surname = author.find('surname')
+        if given_name is not None and surname is not None:
+            authors_list.append(_clean_name(_text(surname)) + ", " + _clean_name(_text(given_name)))
+    if len(authors_list) == 0:
+        authors_list = ['']
+    indiv_ref.authors = authors_list
+    indiv_ref.first_author = authors_list[0]
+
+    # extract year
+    indiv_ref.year = ''
+    for year in ref.iter('year'):
+        if re.fullmatch(r'\d{4}', _text(year)):
+            indiv_ref.year = _text(year)
+            break
+
+    # extract title
+    title = ref.find('.//article-title')
+    indiv_ref.title = _text(title).replace('\n', '').replace('?', '').replace('*', '').replace(':', '').replace(
+        '>', '').replace('<', '').replace('|', '')
+
+    # extract journal
+    indiv_ref.journal = bibparser._intern(_text(ref.find('.//source')))
+    return indiv_ref
+
+
+def timed_extract(JATS):
+    """
+    Function. Returns (extract_jats(JATS), seconds taken, problems found in the JATS file). Run in a pool of processes,
+    it lets the parent process record extraction times and problems with record_extraction, as the metrics of a worker
+    process are not collected.
+    """
+    started = time.perf_counter()
+    errors = []
+    article = extract_jats(JATS, errors)
+    name = os.path.basename(JATS) if isinstance(JATS, str) and '<' not in JATS else 'JATS text'
+    return article, time.perf_counter() - started, ['%s (%s)' % (name, x) for x in errors]
+
+
+def record_extraction(extracted, failures=None):
+    """
+    Function. Records an extraction returned by timed_extract in the metrics, and adds the problems found in the JATS
+    file to failures if given. Returns the article.
+    """
+    article, seconds, problems = extracted
+    metrics.observe('jats_extract_seconds', seconds)
+    metrics.count('jats_articles')
+    metrics.count('jats_references', len(article.ref_list))
+    if problems:
+        metrics.count('jats_malformed')
+        print('\n'.join(problems))
+        if failures is not None:
+            failures += problems
+    return article
+
+
+def extract_jats(JATS, errors=None):
+    """
+    Function. Extracts the title and doi of an index article and its reference list from CERMINE's JATS output,
+    reading the XML incrementally and freeing every element once it has been used, so memory is bounded by the
+    largest single reference rather than by the document.
+    A document that is not well-formed XML, e.g. with an undefined entity partway, is read again with
+    extract_jats_tolerant, so the references after the error are not lost, and the error is added to errors.
+    Returns an instance of the class citation, with the references in its ref_list attribute.
+    params:
+        JATS -> path to a .cermxml file, or its text.
+        errors -> optional list the problems found in the document are added to.
+    """
+    article = bibparser.Citation()
+    if isinstance(JATS, bytes):
+        source = io.BytesIO(JATS)
+    elif '<' not in JATS and os.path.isfile(JATS):
+        source = JATS
+    else:
+        source = io.BytesIO(JATS.encode('utf-8'))
+    stack = []
+    try:
+        for event, element in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element)
+                continue
+            stack.pop()
+            tag = element.tag
+            if tag == 'ref':
+                article.ref_list.append(_ref_to_citation(element))
+                element.clear()
+                if stack:
+                    stack[-1].remove(element)
+            elif 'ref' in (x.tag for x in stack):
+                # part of a reference, read when the reference ends
+                continue
+            elif tag == 'article-title' and not article.title and 'front' in (x.tag for x in stack):
+                article.title = _text(element)
+            elif tag == 'article-id' and not article.doi:
+                article.doi = _text(element)
+            elif len(stack) > 1:
+                # everything else is of no use once read
+                element.clear()
+                stack[-1].remove(element)
+    except ET.ParseError as error:
+        return extract_jats_tolerant(JATS, 'malformed JATS, %s' % (error), errors)
+    return article
+
+
+def extract_jats_tolerant(JATS, reason='', errors=None):
+    """
+    Function. Extracts an index article and its references from JATS output that is not well-formed XML, as the
+    regular expressions of JATS_extract used to: each <ref> element is cut out of the text and parsed on its own, with
+    undefined entities escaped. References still unreadable are left out and counted in the problem added to errors.
+    Reads the whole document into memory.
+    params:
+        JATS -> path to a .cermxml file, or its text.
+        reason -> why the document is read this way, the start of the problem added to errors.
+        errors -> optional list the problems found in the document are added to.
+    """
+    if isinstance(JATS, bytes):
+        text = JATS.decode('utf-8', 'replace')
+    elif '<' not in JATS and os.path.isfile(JATS):
+        with open(JATS, 'r', encoding='utf-8', errors='replace') as read_str:
+            text = read_str.read()
+    else:
+        text = JATS
+    article = bibparser.Citation()
+    front = jats_front.search(text)
+    if front:
+        title = re.search(r'<article-title[^>]*>(.*?)</article-title>', front.group(0), re.S)
+        article.title = markup_tag.sub('', title.group(1)) if title else ''
+    doi = re.search(r'<article-id[^>]*>(.*?)</article-id>', text, re.S)
+    article.doi = markup_tag.sub('', doi.group(1)).strip() if doi else ''
+    unreadable = 0
+    for block in jats_ref.findall(text):
+        try:
+            article.ref_list.append(_ref_to_citation(ET.fromstring(undefined_entity.sub('&amp;', block))))
+        except ET.ParseError:
+            unreadable += 1
+    if errors is not None and (reason or unreadable):
+        errors.append('%s; %d references read, %d unreadable' % (reason or 'malformed JATS', len(article.ref_list),
+                                                                   unreadable))
+    return article
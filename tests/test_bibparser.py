@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import refchaser.benchmark as benchmark
+import refchaser.bibparser as bibparser
+import refchaser.citationcache as citationcache
+
+
+def sample_citations():
+    return [
+        bibparser.Citation(title='Effect of aspirin on mortality', article_type='Article', year='2001',
+                           authors=['Smith, John', 'Doe, Jane'], first_author='Smith, John', doi='10.1000/abc.1',
+                           journal='Journal of Trials', abstract='An abstract.', keywords=['aspirin', 'mortality'],
+                           databaseID='WOS:000000000000001'),
+        bibparser.Citation(title='Screening for cancer in adults', article_type='Review', year='2015',
+                           authors=['Kim, H'], first_author='Kim, H', doi='10.1000/abc.2', journal='Health Reviews',
+                           abstract='', keywords=['screening', 'cancer', 'adults'], databaseID='WOS:000000000000002'),
+    ]
+
+
+def test_ciw_round_trip(tmp_path):
+    file_path = tmp_path / 'written.ciw'
+    with open(file_path, 'w', encoding='utf-8') as write_str:
+        bibparser.write_citations(sample_citations(), write_str, 'ciw')
+    parsed = bibparser.BibFile(str(file_path)).parse()
+    assert len(parsed) == 2
+    for original, read in zip(sample_citations(), parsed):
+        assert read.title == original.title
+        assert read.authors == original.authors
+        assert read.year == original.year
+        assert read.doi == original.doi
+        assert read.journal == original.journal
+        assert read.keywords == original.keywords
+        assert read.article_type == original.article_type
+        assert read.databaseID == original.databaseID
+
+
+savedrecs = '''﻿FN Clarivate Analytics Web of Science
+VR 1.0
+PT J
+AU Smith, J
+   Doe, J
+AF Smith, John
+   Doe, Jane
+TI Effect of aspirin on mortality in a
+   randomized trial
+SO JOURNAL OF TRIALS
+LA English
+DT Article
+DE aspirin; mortality; randomized trial
+ID PREVENTION
+AB An abstract.
+C1 [Smith, John] Univ Trials, Dept Med, London, England.
+PY 2001
+VL 10
+BP 1
+EP 9
+DI 10.1000/abc.1
+UT WOS:000000000000001
+ER
+
+PT J
+AU Kim, H
+AF Kim, Hana
+TI Screening for cancer in adults
+SO HEALTH REVIEWS
+DT Review
+DE screening; cancer
+PY 2015
+DI 10.1000/abc.2
+UT WOS:000000000000002
+ER
+
+EF
+'''
+
+
+def test_web_of_science_all_fields_export(tmp_path):
+    file_path = tmp_path / 'savedrecs.txt'
+    file_path.write_bytes(savedrecs.encode('utf-8'))
+    bib_file = bibparser.BibFile(str(file_path))
+    assert bib_file.filename_extension == '.txt'
+    parsed = bib_file.parse()
+    assert len(parsed) == 2
+    assert parsed[0].title == 'Effect of aspirin on mortality in a randomized trial'
+    assert parsed[0].authors == ['Smith, John', 'Doe, Jane']
+    assert parsed[0].article_type == 'Article'
+    assert parsed[0].keywords == ['aspirin', 'mortality', 'randomized trial']
+    assert parsed[0].databaseID == 'WOS:000000000000001'
+    assert parsed[1].keywords == ['screening', 'cancer']
+    assert parsed[1].databaseID == 'WOS:000000000000002'
+
+
+def fields(citation):
+    return [getattr(citation, x) for x in bibparser.Citation.__slots__ if x != 'ref_list']
+
+
+def test_parse_list_and_table_agree(tmp_path):
+    for format_ in ('ris', 'nbib', 'bib'):
+        file_path = tmp_path / ('written.' + format_)
+        with open(file_path, 'w', encoding='utf-8') as write_str:
+            bibparser.write_citations(sample_citations(), write_str, format_)
+        bib_file = bibparser.BibFile(str(file_path))
+        parsed = bib_file.parse()
+        assert isinstance(parsed, list) and len(parsed) == 2
+        assert list(map(fields, parsed)) == list(map(fields, bib_file.parse(as_table=True)))
+
+
+def test_parse_parallel_matches_parse(tmp_path):
+    cache = citationcache.CitationCache(str(tmp_path / 'cache'))
+    for format_ in ('ris', 'ciw', 'nbib', 'bib'):
+        file_path = benchmark.write_corpus(str(tmp_path / ('corpus.' + format_)), 300, format_, seed=3)
+        serial = list(map(fields, bibparser.BibFile(file_path).parse()))
+        assert len(serial) == 300
+        # shards of a few kilobytes, so records are cut at many boundaries
+        parallel = bibparser.BibFile(file_path).parse_parallel(workers=2, shard_size=8192)
+        assert list(map(fields, parallel)) == serial
+        # the merged result of the shards is cached, and read back the same
+        cached = bibparser.BibFile(file_path, cache=cache).parse_parallel(workers=2, shard_size=8192)
+        assert list(map(fields, cached)) == serial
+        assert list(map(fields, bibparser.BibFile(file_path, cache=cache).parse())) == serial
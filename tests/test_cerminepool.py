@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import pytest
+import refchaser.cerminepool as cerminepool
+
+# a stand-in for java running CERMINE: writes a JATS file for each PDF of the -path directory, in order, and hangs
+# on a PDF containing "hang"
+fake_java = '''#!%s
+import os, sys, time
+path = sys.argv[sys.argv.index('-path') + 1]
+for name in sorted(os.listdir(path)):
+    if name.endswith('.pdf'):
+        with open(os.path.join(path, name), 'rb') as read_bytes:
+            content = read_bytes.read()
+        if b'hang' in content:
+            time.sleep(60)
+        with open(os.path.join(path, name[:-4] + '.cermxml'), 'wb') as write_bytes:
+            write_bytes.write(b'<article>' + content + b'</article>')
+''' % (sys.executable)
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason='the stand-in for java is a script run through its shebang')
+
+
+def make_pdfs(tmp_path, contents):
+    java = tmp_path / 'java'
+    java.write_text(fake_java, encoding='utf-8')
+    java.chmod(0o755)
+    pdf_dir = tmp_path / 'pdfs'
+    pdf_dir.mkdir()
+    pdf_files = []
+    for n, content in enumerate(contents):
+        pdf_file = pdf_dir / ('article%02d.pdf' % n)
+        pdf_file.write_bytes(content)
+        pdf_files.append(str(pdf_file))
+    return str(java), pdf_files
+
+
+def test_every_pdf_of_every_shard_is_parsed_once(tmp_path):
+    java, pdf_files = make_pdfs(tmp_path, [b'pdf %d' % x for x in range(11)])
+    pool = cerminepool.CerminePool(workers=3, shard_size=4, java=java, staging_dir=str(tmp_path / 'staging'))
+    results = dict(pool.run(pdf_files))
+    assert sorted(results) == pdf_files
+    for pdf_file, result_file in results.items():
+        assert result_file == os.path.splitext(pdf_file)[0] + '.cermxml'
+        with open(result_file, 'rb') as read_bytes:
+            assert read_bytes.read() == b'<article>pdf %d</article>' % pdf_files.index(pdf_file)
+    # worker directories are emptied after each shard
+    assert not any(os.listdir(str(tmp_path / 'staging' / x)) for x in os.listdir(str(tmp_path / 'staging')))
+
+
+def test_a_hanging_pdf_only_fails_itself(tmp_path):
+    java, pdf_files = make_pdfs(tmp_path, [b'pdf 0', b'hang', b'pdf 2', b'pdf 3'])
+    results_dir = tmp_path / 'results'
+    results_dir.mkdir()
+    pool = cerminepool.CerminePool(workers=2, shard_size=3, timeout=0.5, startup=0.5, java=java,
+                                   results_dir=str(results_dir))
+    results = dict(pool.run(pdf_files))
+    assert sorted(results) == pdf_files
+    assert results[pdf_files[1]] is None
+    for n in (0, 2, 3):
+        assert os.path.dirname(results[pdf_files[n]]) == str(results_dir)
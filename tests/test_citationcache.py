@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import os, json
+import refchaser.bibparser as bibparser
+import refchaser.citationcache as citationcache
+
+
+def write_bibliography(tmp_path, name='search.ris', n=3):
+    bib_path = tmp_path / name
+    with open(str(bib_path), 'w', encoding='utf-8') as write_str:
+        bibparser.write_citations([bibparser.Citation(title='Cached article %d' % x, doi='10.1000/cache.%d' % x,
+                                                      authors=['Author %d' % x], year='2020') for x in range(n)],
+                                  write_str, 'ris')
+    return str(bib_path)
+
+
+def test_hit_and_miss(tmp_path):
+    bib_path = write_bibliography(tmp_path)
+    cache = citationcache.CitationCache(str(tmp_path / 'cache'))
+    assert cache.get(bib_path) is None
+    citations = bibparser.BibFile(bib_path).parse()
+    cache.put(bib_path, citations)
+    cache.save()
+
+    # a new instance reads the index written by save()
+    cache = citationcache.CitationCache(str(tmp_path / 'cache'))
+    table = cache.get(bib_path)
+    assert [(x.title, x.doi, x.authors) for x in table] == [(x.title, x.doi, x.authors) for x in citations]
+
+    # a changed file is a miss
+    with open(bib_path, 'a', encoding='utf-8') as write_str:
+        write_str.write('\n')
+    assert citationcache.CitationCache(str(tmp_path / 'cache')).get(bib_path) is None
+
+
+def test_corrupt_entries_are_dropped(tmp_path):
+    bib_path = write_bibliography(tmp_path)
+    citations = bibparser.BibFile(bib_path).parse()
+    cache = citationcache.CitationCache(str(tmp_path / 'cache'))
+    cache.put(bib_path, citations)
+    entry_path = cache._entry_path(cache.key(bib_path))
+    with open(entry_path, 'rb') as read_bytes:
+        entry = read_bytes.read()
+    header_length = int.from_bytes(entry[8:16], 'little')
+    header = json.loads(entry[16:16 + header_length])
+    del header['sections']['column:title']
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * ((-len(header_bytes)) % 8)
+    corrupt = [
+        b'',  # empty
+        b'garbage',  # not an entry
+        entry[:12],  # truncated header length
+        entry[:16] + b'[' + entry[17:],  # header is not JSON
+        entry[:len(entry) // 2],  # truncated sections
+        entry[:8] + len(header_bytes).to_bytes(8, 'little') + header_bytes + entry[16 + header_length:],  # missing section
+    ]
+    for data in corrupt:
+        cache.put(bib_path, citations)
+        with open(entry_path, 'wb') as write_bytes:
+            write_bytes.write(data)
+        assert cache.get(bib_path) is None
+        assert not os.path.exists(entry_path)
+        assert cache.size() == 0
+
+
+def test_entries_still_mapped_are_removed_later(tmp_path, monkeypatch):
+    bib_path = write_bibliography(tmp_path)
+    cache = citationcache.CitationCache(str(tmp_path / 'cache'))
+    cache.put(bib_path, bibparser.BibFile(bib_path).parse())
+    table = cache.get(bib_path)
+    entry_path = cache._entry_path(cache.key(bib_path))
+    remove = os.remove
+
+    def windows_remove(path):
+        # Windows refuses to remove a file mapped into memory
+        if path == entry_path and table is not None:
+            raise PermissionError(13, 'The process cannot access the file', path)
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', windows_remove)
+    cache.invalidate(bib_path)
+    assert os.path.exists(entry_path) and cache.deferred == {entry_path}
+    assert cache.get(bib_path) is None
+    assert table[0].title == 'Cached article 0'
+    table = None
+    cache.save()
+    assert not os.path.exists(entry_path) and not cache.deferred
+
+
+def test_jats_cache_hit_and_miss(tmp_path):
+    pdf_file = tmp_path / 'article.pdf'
+    pdf_file.write_bytes(b'%PDF-1.5\n%%EOF\n')
+    jats_file = tmp_path / 'article.cermxml'
+    jats_file.write_text('<article/>', encoding='utf-8')
+    cache = citationcache.JatsCache(str(tmp_path / 'cache'))
+    assert cache.get(str(pdf_file)) is None
+    cached = cache.put(str(pdf_file), str(jats_file))
+    assert cache.get(str(pdf_file)) == cached
+    with open(cached, 'r', encoding='utf-8') as read_str:
+        assert read_str.read() == '<article/>'
+    os.remove(cached)
+    assert cache.get(str(pdf_file)) is None
+
+
+def test_index_is_written_on_save_only(tmp_path):
+    pdf_files = []
+    for n in range(3):
+        pdf_file = tmp_path / ('article%d.pdf' % n)
+        pdf_file.write_bytes(b'%%PDF-1.5\n%d\n' % n)
+        pdf_files.append(str(pdf_file))
+    jats_file = tmp_path / 'article.cermxml'
+    jats_file.write_text('<article/>', encoding='utf-8')
+    cache = citationcache.JatsCache(str(tmp_path / 'cache'))
+    for pdf_file in pdf_files:
+        cache.put(pdf_file, str(jats_file))
+        assert cache.get(pdf_file) is not None
+    assert not os.path.exists(cache.index_path) and cache.dirty
+    cache.save()
+    written = os.stat(cache.index_path).st_mtime_ns
+    assert not cache.dirty
+    cache.save()
+    assert os.stat(cache.index_path).st_mtime_ns == written
+    assert all(citationcache.JatsCache(str(tmp_path / 'cache')).get(x) is not None for x in pdf_files)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import refchaser.bibparser as bibparser
+import refchaser.citationgraph as citationgraph
+
+
+def article(title, doi='', refs=()):
+    return bibparser.Citation(title=title, doi=doi, year='2020', ref_list=list(refs))
+
+
+def test_rediscovered_node_keeps_lowest_hop_and_gains_doi(tmp_path):
+    graph_path = str(tmp_path / 'graph.rcg')
+    graph = citationgraph.CitationGraph(graph_path)
+    deep = article('A reference of a reference found late')
+    middle = article('An article cited by the first seed', refs=[deep])
+    graph.add_article(article('The first seed of the review', '10.1000/seed.1', refs=[middle]), hop=0)
+    graph.add_article(middle)
+    node = graph.find(deep)
+    assert graph.hops[node] == 2
+    assert graph.dois[node] == ''
+    graph.save()
+
+    # reopened from disk, the nodes are read from the mapped file; found again as an index article, a node and the
+    # articles it cites move closer to the seeds
+    graph = citationgraph.CitationGraph(graph_path)
+    middle_node = graph.find(middle)
+    graph.add_article(middle, hop=0)
+    assert graph.hops[middle_node] == 0
+    assert graph.hops[node] == 1
+
+    # found again with a DOI at a higher hop, the node gains the DOI and keeps its hop
+    rediscovered = article('A reference of a reference found late', '10.1000/deep.1')
+    graph.add_article(article('A later article citing it', '10.1000/late.1', refs=[rediscovered]), hop=3)
+    assert graph.find(rediscovered) == node
+    assert graph.hops[node] == 1
+    assert graph.dois[node] == '10.1000/deep.1'
+    assert graph.find(bibparser.Citation(doi='10.1000/deep.1')) == node
+    graph.save()
+    graph = citationgraph.CitationGraph(graph_path)
+    assert graph.hops[middle_node] == 0
+    assert graph.hops[node] == 1
+    assert graph.dois[node] == '10.1000/deep.1'
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import refchaser.bibparser as bibparser
+import refchaser.deduplicate as deduplicate
+
+
+def citation(title, author, year, doi=''):
+    return bibparser.Citation(title=title, first_author=author, authors=[author], year=year, doi=doi)
+
+
+records = [
+    citation('Statin therapy and cardiovascular mortality in older adults', 'Smith, J', '2015', '10.1000/statin.1'),
+    citation('Statin therapy and cardiovascular mortality in younger adults', 'Smith, J', '2015', '10.1000/statin.2'),
+    citation('Exercise and blood pressure: a randomized trial', 'Garcia, M', '2018'),
+    citation('Exercise and blood pressure in adolescents', 'Garcia, M', '2019'),
+    citation('Screening for colorectal cancer in primary care', 'Kim, H', '2012'),
+    citation('Mental health of hospital staff during a pandemic', 'Okafor, C', '2021'),
+]
+references = [
+    # same DOI, mangled title
+    citation('Statin therapy and cardio vascular mortality', 'Smith J', '2015', 'https://doi.org/10.1000/STATIN.2'),
+    # near-duplicate title without DOI: the older adults record wins over the younger adults one
+    citation('Statin therapy and cardiovascular mortality in older adults.', 'Smith J', '2015'),
+    # near-duplicate title whose DOI conflicts with both statin records
+    citation('Statin therapy and cardiovascular mortality in older adults', 'Smith J', '2015', '10.1000/other'),
+    # wrong year, still found through surname and title prefix
+    citation('Exercise and blood pressure: a randomized trial', 'Garcia M', '2017'),
+    citation('Screening for colorectal cancer in primary care settings', 'Kim H', '2012'),
+    citation('A study nobody in the records wrote', 'Novak, P', '2020'),
+]
+
+
+def all_pairs(reference, threshold=0.6):
+    # the match of a reference found by scoring it against every record
+    matcher = deduplicate.CitationMatcher([], threshold)
+    words, surname, year, prefix = matcher._features(reference)
+    doi = deduplicate.normalize_doi(reference.doi)
+    best, best_score = None, 0.0
+    for record in records:
+        record_doi = deduplicate.normalize_doi(record.doi)
+        if doi and record_doi:
+            if doi != record_doi:
+                continue
+            return record, 1.0
+        record_words, record_surname, record_year, _ = matcher._features(record)
+        score = (0.7 * 2 * len(words & record_words) / (len(words) + len(record_words)) +
+                 0.15 * (surname != '' and surname == record_surname) + 0.15 * (year != '' and year == record_year))
+        if score > best_score:
+            best, best_score = record, score
+    return (best, best_score) if best_score >= threshold else (None, best_score)
+
+
+def test_blocked_matcher_finds_the_matches_of_all_pairs_scoring():
+    matcher = deduplicate.CitationMatcher(records)
+    matches = [matcher.match(x) for x in references]
+    assert [x[0] for x in matches] == [all_pairs(x)[0] for x in references]
+    assert [x[0] for x in matches] == [records[1], records[0], None, records[2], records[4], None]
+    assert matches[0][1] == 1.0
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os, threading, time
+import refchaser.benchmark as benchmark
+import refchaser.bibparser as bibparser
+import refchaser.downloader as downloader
+
+
+def citations(n):
+    return [bibparser.Citation(title='Article %d' % x, doi='10.1000/test.%d' % x) for x in range(n)]
+
+
+class HangingBackend:
+    """
+    Backend whose first attempt at each DOI hangs until release is set, then writes a broken file; later attempts
+    write a valid PDF.
+    """
+    mirrors = ['mirror']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.release = threading.Event()
+
+    def fetch(self, citation, save_to, mirror=None, timeout=None):
+        with self.lock:
+            attempt = self.attempts[citation.doi] = self.attempts.get(citation.doi, 0) + 1
+        file_path = os.path.join(save_to, downloader.pdf_file_name(citation.doi))
+        with open(file_path, 'wb') as write_pdf:
+            if attempt == 1:
+                self.release.wait()
+                write_pdf.write(b'%PDF-1.5 truncated')
+            else:
+                write_pdf.write(benchmark.synthetic_pdf(citation.doi))
+        return file_path
+
+    def close(self):
+        pass
+
+
+def test_attempts_given_up_never_install_their_files(tmp_path):
+    backend = HangingBackend()
+    downloads = downloader.Downloader(backend, workers=2, per_host=2, timeout=0.3, min_timeout=0.3, backoff=0.01)
+    # the hung attempts finish while the retries are running
+    threading.Timer(0.5, backend.release.set).start()
+    results = list(downloads.run(citations(4), str(tmp_path)))
+    time.sleep(0.2)
+    assert sorted(x.error for x in results) == [''] * 4
+    assert all(x.attempts == 2 for x in results)
+    pdf_files = sorted(x for x in os.listdir(str(tmp_path)) if x.endswith('.pdf'))
+    assert pdf_files == sorted(downloader.pdf_file_name(x.doi) for x in citations(4))
+    for name in pdf_files:
+        with open(os.path.join(str(tmp_path), name), 'rb') as read_pdf:
+            assert read_pdf.read().startswith(b'%PDF-1.5\n')
+    assert not [x for x in os.listdir(str(tmp_path)) if x.startswith('.refchaser_attempt_')]
+
+
+def test_downloads_go_on_when_every_thread_is_stuck(tmp_path):
+    backend = HangingBackend()
+    downloads = downloader.Downloader(backend, workers=1, per_host=1, timeout=0.2, min_timeout=0.2, backoff=0.01,
+                                      max_abandoned=0)
+    try:
+        results = list(downloads.run(citations(3), str(tmp_path)))
+    finally:
+        backend.release.set()
+    assert [x.error for x in results] == [''] * 3
+
+
+def test_failed_downloads_fail_over_to_another_mirror(tmp_path):
+    with benchmark.FakeMirror(latency=0.01, failure_rate=1.0) as broken, benchmark.FakeMirror(latency=0.01) as mirror:
+        backend = downloader.HTTPBackend([broken.url_template, mirror.url_template])
+        downloads = downloader.Downloader(backend, workers=4, per_host=2, timeout=10, backoff=0.01,
+                                          breaker=lambda: downloader.CircuitBreaker(min_calls=1000))
+        results = list(downloads.run(citations(10), str(tmp_path)))
+    assert [x.error for x in results] == [''] * 10
+    assert set(x.host for x in results) == {backend.mirrors[1]}
+    assert all(x.attempts in (1, 2) for x in results)
+    assert mirror.requests == 10
+
+
+def test_downloads_are_given_up_after_retries_rounds(tmp_path):
+    with benchmark.FakeMirror(latency=0.01, failure_rate=1.0) as broken:
+        backend = downloader.HTTPBackend(broken.url_template)
+        downloads = downloader.Downloader(backend, workers=4, per_host=4, timeout=10, retries=3, backoff=0.01,
+                                          breaker=lambda: downloader.CircuitBreaker(min_calls=1000))
+        results = list(downloads.run(citations(5), str(tmp_path)))
+    assert all(x.path is None and x.error for x in results)
+    assert [x.attempts for x in results] == [3] * 5
+    assert broken.requests == 15
+
+
+def test_articles_a_mirror_does_not_have_are_not_retried(tmp_path):
+    with benchmark.FakeMirror(latency=0.01, not_found_rate=1.0) as mirror:
+        downloads = downloader.Downloader(downloader.HTTPBackend(mirror.url_template), workers=2, timeout=10,
+                                          retries=3, backoff=0.01)
+        results = list(downloads.run(citations(4), str(tmp_path)))
+    assert [x.attempts for x in results] == [1] * 4
+    assert all(x.path is None for x in results)
+    assert mirror.requests == 4
+
+
+def test_open_breaker_keeps_downloads_off_a_failing_mirror(tmp_path):
+    with benchmark.FakeMirror(latency=0.01, failure_rate=1.0) as broken, benchmark.FakeMirror(latency=0.01) as mirror:
+        backend = downloader.HTTPBackend([broken.url_template, mirror.url_template])
+        downloads = downloader.Downloader(backend, workers=2, per_host=1, timeout=10, backoff=0.01,
+                                          breaker=lambda: downloader.CircuitBreaker(min_calls=4, cooldown=600))
+        results = list(downloads.run(citations(30), str(tmp_path)))
+    assert [x.error for x in results] == [''] * 30
+    assert downloads.breakers[backend.mirrors[0]].is_open()
+    assert not downloads.breakers[backend.mirrors[1]].is_open()
+    # the breaker opens after min_calls failures, give or take the one download in flight
+    assert broken.requests <= 5
+
+
+def test_circuit_breaker_cooldown_doubles_with_each_failed_trial():
+    breaker = downloader.CircuitBreaker(threshold=0.5, window=4, min_calls=4, cooldown=10)
+    for now, success in enumerate([True, False, True, False]):
+        assert breaker.allow(now)
+        breaker.record(success, now)
+    assert breaker.is_open() and not breaker.allow(5)
+    # one trial after the cooldown, which fails
+    assert breaker.allow(13) and not breaker.allow(13)
+    breaker.record(False, 13)
+    assert not breaker.allow(30) and breaker.allow(33)
+    breaker.record(True, 33)
+    assert not breaker.is_open() and breaker.allow(34)
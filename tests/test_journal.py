@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import refchaser.bibparser as bibparser
+import refchaser.downloader as downloader
+import refchaser.journal as journal
+
+
+def test_rerun_skips_done_citations_and_resumes_the_rest(tmp_path):
+    citations = [bibparser.Citation(title='Article %d' % x, doi='10.1000/journal.%d' % x) for x in range(4)]
+    download_journal = journal.DownloadJournal(str(tmp_path))
+    assert download_journal.register(citations, 'batch') == citations
+    pdf_file = tmp_path / 'article0.pdf'
+    pdf_file.write_bytes(b'%PDF-1.5\n')
+    download_journal.record(downloader.DownloadResult(citations[0], str(pdf_file), attempts=1, size=9))
+    download_journal.record(downloader.DownloadResult(citations[1], error='not found', attempts=3))
+    download_journal.close()
+
+    # interrupted here; the next run opens the same journal
+    download_journal = journal.DownloadJournal(str(tmp_path))
+    assert download_journal.register(citations, 'batch') == citations[1:]
+    assert download_journal.counts('batch') == {'pending': 2, 'done': 1, 'failed': 1}
+    assert download_journal.failures('batch') == [('Article 1', '10.1000/journal.1', 3, 'not found')]
+
+    # a file deleted since it was downloaded is downloaded again
+    pdf_file.unlink()
+    assert download_journal.register(citations, 'batch') == citations
+    download_journal.close()
+
+
+def test_citations_without_doi_or_title_are_not_taken_for_each_other(tmp_path):
+    citations = [
+        bibparser.Citation(title='...', databaseID='WOS:000001'),
+        bibparser.Citation(title='', databaseID='WOS:000002'),
+        bibparser.Citation(authors=['Smith, J.'], year='2001', journal='Nature'),
+        bibparser.Citation(authors=['Smith, J.'], year='2002', journal='Nature'),
+        bibparser.Citation(),
+        bibparser.Citation(title='!!'),
+    ]
+    keys = [journal.citation_key(x) for x in citations]
+    assert len(set(keys[:4])) == 4 and keys[4] is None and keys[5] is None
+
+    download_journal = journal.DownloadJournal(str(tmp_path))
+    assert download_journal.register(citations) == citations
+    for n, citation in enumerate(citations):
+        pdf_file = tmp_path / ('article%d.pdf' % n)
+        pdf_file.write_bytes(b'%PDF-1.5\n')
+        download_journal.record(downloader.DownloadResult(citation, str(pdf_file), attempts=1))
+    # the citations that cannot be told apart are not journaled, so they are never skipped
+    assert download_journal.register(citations) == citations[4:]
+    assert download_journal.counts()['done'] == 4
+    download_journal.close()
+
+
+def test_report_counts_the_duplicates_removed(tmp_path):
+    citations = [bibparser.Citation(title='Article %d' % x, doi='10.1000/journal.%d' % x) for x in range(3)]
+    download_journal = journal.DownloadJournal(str(tmp_path))
+    download_journal.register(citations, 'batch')
+    report_path = tmp_path / 'batch_report.txt'
+    download_journal.write_report(str(report_path), 'batch', duplicates=2)
+    download_journal.close()
+    lines = report_path.read_text(encoding='utf-8').splitlines()
+    assert lines[0] == 'Total number of articles identified from bibliographic file: 5'
+    assert lines[1] == 'Number of duplicates of articles in other files removed: 2'
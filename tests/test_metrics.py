@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import json, threading
+import refchaser.metrics as metrics
+
+
+def test_recording_does_nothing_while_metrics_are_off():
+    metrics.disable()
+    metrics.count('files')
+    metrics.observe('parse_seconds', 0.1)
+    with metrics.timer('parse_seconds'):
+        pass
+    assert metrics.registry is None and metrics.finish() is None
+
+
+def test_counters_are_exact_under_many_threads():
+    metrics.enable()
+    try:
+        def record():
+            for _ in range(1000):
+                metrics.count('download_attempts', mirror='a', outcome='ok')
+                metrics.observe('download_attempt_seconds', 0.02, mirror='a')
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = metrics.registry.summary()
+    finally:
+        metrics.disable()
+    assert [(x['name'], x['labels'], x['value']) for x in summary['counters']] == [
+        ('download_attempts', {'mirror': 'a', 'outcome': 'ok'}, 8000)]
+    assert summary['histograms'][0]['count'] == 8000
+
+
+def test_summary_and_prometheus_files(tmp_path):
+    metrics.enable(info={'mode': 'A'})
+    metrics.count('files', 3, format='ris')
+    metrics.count('files', 1, format='bib')
+    for seconds in (0.002, 0.02, 0.02, 0.2, 7):
+        metrics.observe('parse_seconds', seconds, format='ris')
+    summary = metrics.finish(str(tmp_path))
+    assert metrics.registry is None
+
+    with open(str(tmp_path / metrics.summary_name), 'r', encoding='utf-8') as read_str:
+        written = json.load(read_str)
+    assert written['info'] == {'mode': 'A'}
+    assert [(x['name'], x['labels'], x['value']) for x in written['counters']] == [
+        ('files', {'format': 'bib'}, 1), ('files', {'format': 'ris'}, 3)]
+    assert summary['counters'][1]['value'] == 3
+    histogram = written['histograms'][0]
+    assert (histogram['count'], histogram['max']) == (5, 7)
+    assert (histogram['p50'], histogram['p95']) == (0.025, 7)
+    assert histogram['buckets']['0.025'] == 3 and histogram['buckets']['+Inf'] == 5
+
+    lines = (tmp_path / metrics.prometheus_name).read_text(encoding='utf-8').splitlines()
+    assert 'refchaser_run_info{mode="A"} 1' in lines
+    assert 'refchaser_files_total{format="bib"} 1' in lines and 'refchaser_files_total{format="ris"} 3' in lines
+    assert 'refchaser_parse_seconds_bucket{format="ris",le="0.025"} 3' in lines
+    assert 'refchaser_parse_seconds_count{format="ris"} 5' in lines
+    assert lines.count('# TYPE refchaser_files_total counter') == 1
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os
+import refchaser.benchmark as benchmark
+import refchaser.pdfcheck as pdfcheck
+
+
+def test_valid_truncated_and_non_pdf_files(tmp_path):
+    pdf = benchmark.synthetic_pdf('10.1000/check.1', pages=3)
+    files = {
+        'valid.pdf': pdf,
+        'empty.pdf': b'',
+        'captcha.pdf': b'<!DOCTYPE html>\n<html><body>Are you a robot?</body></html>' + b' ' * 2000,
+        'text.pdf': b'Not a PDF at all\n' * 200,
+        'small.pdf': b'%PDF-1.5\n%%EOF\n',
+        'truncated.pdf': pdf[:len(pdf) - 100],
+        'no_xref.pdf': pdf.replace(b'startxref', b'startXref'),
+        'bad_xref.pdf': pdf[:pdf.rindex(b'startxref')] + b'startxref\n99999999\n%%EOF\n',
+        'no_pages.pdf': pdf.replace(b'/Type /Page /', b'/Type /Leaf /'),
+    }
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+    checked = {name: pdfcheck.check_pdf(str(tmp_path / name)) for name in files}
+    assert checked == {
+        'valid.pdf': (None, 3),
+        'empty.pdf': ('empty', 0),
+        'captcha.pdf': ('html', 0),
+        'text.pdf': ('not_pdf', 0),
+        'small.pdf': ('too_small', None),
+        'truncated.pdf': ('truncated', None),
+        'no_xref.pdf': ('no_xref', None),
+        'bad_xref.pdf': ('bad_xref', None),
+        'no_pages.pdf': ('no_pages', 0),
+    }
+    assert pdfcheck.check_pdf(str(tmp_path / 'valid.pdf'), max_size=1000) == ('too_large', None)
+
+
+def test_pages_are_counted_once_whatever_the_chunk_boundaries(tmp_path, monkeypatch):
+    # page objects and the /Pages tree written close together, so they straddle chunk boundaries
+    body = b''.join(b'%d 0 obj << /Type /Page >> endobj %d 0 obj << /Type\n/Pages >> endobj\n' % (x, x) for x in range(40))
+    pdf = b'%PDF-1.5\n' + body + b'%' + b'x' * 1024 + b'\nstartxref\n9\n%%EOF\n'
+    pdf_file = tmp_path / 'pages.pdf'
+    pdf_file.write_bytes(pdf)
+    for chunk_size in list(range(1, 80)) + [1024 * 1024]:
+        monkeypatch.setattr(pdfcheck, 'chunk_size', chunk_size)
+        assert pdfcheck.check_pdf(str(pdf_file)) == (None, 40), chunk_size
+
+
+def test_screen_leaves_the_files_it_is_given_in_place(tmp_path):
+    (tmp_path / 'valid.pdf').write_bytes(benchmark.synthetic_pdf('10.1000/check.2'))
+    (tmp_path / 'captcha.pdf').write_bytes(b'<html>captcha</html>')
+    pdf_files = [str(tmp_path / 'valid.pdf'), str(tmp_path / 'captcha.pdf')]
+    valid, invalid = pdfcheck.screen(pdf_files)
+    assert valid == pdf_files[:1] and invalid == [(pdf_files[1], 'html')]
+    assert os.path.exists(pdf_files[1])
+    assert os.path.exists(str(tmp_path / 'quarantine' / 'captcha.pdf.html'))
+    with open(str(tmp_path / 'quarantine' / 'quarantine.txt'), 'r', encoding='utf-8') as log:
+        assert log.read().split('\t')[1:3] == ['captcha.pdf', 'html']
+
+    valid, invalid = pdfcheck.screen(pdf_files, quarantine_dir=str(tmp_path / 'moved'), move=True)
+    assert invalid == [(pdf_files[1], 'html')]
+    assert not os.path.exists(pdf_files[1])
+    assert sorted(os.listdir(str(tmp_path / 'moved'))) == ['captcha.pdf.html', 'quarantine.txt']
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import os
+import refchaser.benchmark as benchmark
+import refchaser.downloader as downloader
+import refchaser.pdfstore as pdfstore
+
+
+def download(folder, doi):
+    folder.mkdir(exist_ok=True)
+    pdf_file = folder / downloader.pdf_file_name(doi)
+    pdf_file.write_bytes(benchmark.synthetic_pdf(doi))
+    return str(pdf_file)
+
+
+def test_projects_share_stored_pdfs_through_hard_links(tmp_path):
+    store = pdfstore.PDFStore(str(tmp_path / 'store'))
+    pdf_file = download(tmp_path / 'project1', '10.1000/store.1')
+    entry_path = store.put('https://doi.org/10.1000/STORE.1', pdf_file)
+    assert os.path.samefile(entry_path, pdf_file)
+    store.save()
+
+    store = pdfstore.PDFStore(str(tmp_path / 'store'))
+    assert store.link_to('10.1000/store.2', str(tmp_path / 'project2')) is None
+    linked = store.link_to('10.1000/store.1', str(tmp_path / 'project2'))
+    assert os.path.basename(linked) == os.path.basename(pdf_file)
+    assert os.path.samefile(linked, pdf_file) and os.stat(linked).st_nlink == 3
+    assert store.hit_rate() == 0.5 and store.total == os.path.getsize(pdf_file)
+
+
+def test_the_same_bytes_are_stored_once(tmp_path):
+    store = pdfstore.PDFStore(str(tmp_path / 'store'))
+    pdf_file = download(tmp_path / 'project', '10.1000/store.1')
+    assert store.put('10.1000/store.1', pdf_file) == store.put('10.1000/store.1-copy', pdf_file)
+    assert len(store.index['entries']) == 1 and store.total == os.path.getsize(pdf_file)
+
+
+def test_least_recently_used_pdfs_are_evicted(tmp_path):
+    pdf_files = [download(tmp_path / 'project', '10.1000/store.%d' % x) for x in range(3)]
+    size = os.path.getsize(pdf_files[0])
+    store = pdfstore.PDFStore(str(tmp_path / 'store'), max_bytes=2 * size + size // 2)
+    store.put('10.1000/store.0', pdf_files[0])
+    store.put('10.1000/store.1', pdf_files[1])
+    store.index['entries'][store.index['dois']['10.1000/store.0']]['last_used'] += 60
+    store.put('10.1000/store.2', pdf_files[2])
+    assert store.get('10.1000/store.1') is None
+    assert store.get('10.1000/store.0') is not None and store.get('10.1000/store.2') is not None
+    assert store.total == 2 * size and len(os.listdir(str(tmp_path / 'store'))) == 2
+    # the copies in the project folder are kept
+    assert all(os.path.exists(x) for x in pdf_files)
+
+
+def test_pdfs_changed_through_a_link_are_dropped(tmp_path):
+    store = pdfstore.PDFStore(str(tmp_path / 'store'))
+    pdf_file = download(tmp_path / 'project', '10.1000/store.1')
+    store.put('10.1000/store.1', pdf_file)
+    with open(pdf_file, 'ab') as annotate:
+        annotate.write(b'% an annotation\n')
+    assert store.get('10.1000/store.1') is None
+    assert store.total == 0 and not store.index['dois']
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import refchaser.benchmark as benchmark
+import refchaser.bibparser as bibparser
+import refchaser.citationcache as citationcache
+import refchaser.downloader as downloader
+import refchaser.pipeline as pipeline
+import refchaser.refchaser as refchaser
+
+
+class BrokenJatsCache(citationcache.JatsCache):
+    """
+    JatsCache failing on its broken_at-th lookup.
+    """
+
+    def __init__(self, cache_dir, broken_at=None):
+        super().__init__(cache_dir)
+        self.broken_at = broken_at
+        self.lookups = 0
+
+    def get(self, pdf_file):
+        self.lookups += 1
+        if self.lookups == self.broken_at:
+            raise OSError('cache disk gone')
+        return super().get(pdf_file)
+
+
+def make_pipeline(tmp_path, broken_at=None):
+    """
+    Returns a Pipeline with queues of 2 items over 20 PDFs already downloaded, whose CERMINE outputs are all cached,
+    so it runs without java and every stage has to wait on its queue.
+    """
+    save_pdf_to, save_to = tmp_path / 'full_texts', tmp_path / 'results'
+    save_pdf_to.mkdir()
+    cache = BrokenJatsCache(str(tmp_path / 'jats_cache'), broken_at)
+    for n in range(20):
+        pdf_file = str(save_pdf_to / ('article%02d.pdf' % n))
+        with open(pdf_file, 'wb') as write_pdf:
+            write_pdf.write(benchmark.synthetic_pdf('10.1000/pipeline.%d' % n))
+        jats_file = str(tmp_path / 'article.cermxml')
+        with open(jats_file, 'w', encoding='utf-8') as write_str:
+            write_str.write(benchmark.synthetic_jats(references=5, seed=n, paragraphs=1))
+        cache.put(pdf_file, jats_file)
+    bib_path = str(tmp_path / 'search.ris')
+    with open(bib_path, 'w', encoding='utf-8') as write_str:
+        bibparser.write_citations([bibparser.Citation(title='An article without DOI')], write_str, 'ris')
+    return pipeline.Pipeline(bib_path, str(save_pdf_to), str(save_to), 'WOS', 'WOS', queue_size=2, cache=cache,
+                             backend=downloader.HTTPBackend('http://127.0.0.1:9/{doi}'), store=False, resume=False)
+
+
+def run_in_thread(run):
+    # a stage left waiting on its queue would hang the test instead of failing it
+    outcome = []
+    threads = threading.active_count()
+
+    def target():
+        try:
+            outcome.append(run())
+        except Exception as error:
+            outcome.append(error)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'the pipeline hung'
+    assert threading.active_count() == threads, 'stages were left waiting'
+    return outcome[0]
+
+
+def test_pipeline_runs_every_stage(tmp_path):
+    articles = run_in_thread(make_pipeline(tmp_path).run)
+    assert len(articles) == 20
+    assert all(len(x.ref_list) == 5 for x in articles)
+
+
+def test_failed_extraction_stops_every_stage(tmp_path, monkeypatch):
+    calls = []
+
+    def failing_extract(JATS):
+        calls.append(JATS)
+        if len(calls) == 3:
+            raise ValueError('extraction failed')
+        return extract(JATS)
+
+    extract = refchaser.timed_extract
+    monkeypatch.setattr(refchaser, 'timed_extract', failing_extract)
+    error = run_in_thread(make_pipeline(tmp_path).run)
+    assert isinstance(error, ValueError) and str(error) == 'extraction failed'
+
+
+def test_failed_cermine_stage_stops_every_stage(tmp_path):
+    run = make_pipeline(tmp_path, broken_at=4)
+    error = run_in_thread(run.run)
+    assert isinstance(error, OSError) and str(error) == 'cache disk gone'
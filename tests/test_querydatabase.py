@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import re
+import refchaser.bibparser as bibparser
+import refchaser.querydatabase as querydatabase
+import refchaser.refchaser as refchaser
+
+titles = [
+    'The "hot hand" fallacy in basketball shooting',
+    'Hot hand effects in professional darts players',
+    'A fallacy in basketball statistics revisited',
+    'Cognitive illusions of "streaks" among gamblers',
+]
+
+
+def make_index():
+    index = querydatabase.LocalIndex()
+    for title in titles:
+        index.add(bibparser.Citation(title=title))
+    return index
+
+
+def test_titles_with_double_quotes_are_searched_as_one_phrase():
+    index = make_index()
+    for database in ('WOS', 'PubMed', 'EMBASE', 'Scopus', 'GS'):
+        query = refchaser.join_query(refchaser.quote_terms([titles[0], titles[3]]), database)
+        assert query.count('"') == 4
+        assert index.search(query) == [0, 3]
+
+
+def test_phrases_and_operators():
+    index = make_index()
+    assert index.search('TI=("hot hand")') == [0, 1]
+    assert index.search('"in basketball"') == [0, 2]
+    assert index.search('fallacy AND basketball NOT "hot hand"') == [2]
+    assert index.search('("hand fallacy"[Title]) OR (gambl*[Title])') == [0, 3]
+    assert index.search('TI=()') == []
+
+
+def test_title_chunks_stay_within_the_limits_and_keep_every_title(tmp_path):
+    chaser = refchaser.RefChaser(str(tmp_path), cache=False, lazy=True)
+    chunk_titles = ['Title number %d of a long list of references %s' % (x, 'about trials ' * (x % 7)) for x in range(300)]
+    for database, max_chars, max_terms in (('WOS', 2000, 600), ('PubMed', 4000, 25), ('GS', 256, 32)):
+        queries = chaser.combine_title_chunks(chunk_titles, database, max_chars=max_chars, max_terms=max_terms)
+        assert len(queries) > 1
+        assert all(len(x) <= max_chars for x in queries)
+        terms = [re.findall(r'"([^"]*)"', x) for x in queries]
+        assert all(len(x) <= max_terms for x in terms)
+        assert sorted(sum(terms, [])) == sorted(x.strip() for x in chunk_titles)
+
+    # every title is found by exactly one query
+    index = querydatabase.LocalIndex()
+    for title in chunk_titles:
+        index.add(bibparser.Citation(title=title))
+    hits = [index.search(x) for x in chaser.combine_title_chunks(chunk_titles, 'WOS', max_chars=2000)]
+    assert sorted(sum(hits, [])) == list(range(len(chunk_titles)))
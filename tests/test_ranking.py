@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import refchaser.bibparser as bibparser
+import refchaser.ranking as ranking
+
+
+def record(title, abstract=''):
+    return bibparser.Citation(title=title, abstract=abstract)
+
+
+corpus = [
+    record('Gardening tips for small balconies', 'Tomatoes and herbs grow well in pots.'),
+    record('Statin therapy and cardiovascular mortality', 'Statin therapy lowered cardiovascular mortality in adults.'),
+    record('Exercise and blood pressure', 'Aerobic exercise lowered blood pressure in adults.'),
+    record('Statin adherence in primary care', 'Adherence to statin therapy was poor.'),
+    record('Railway timetables of the nineteenth century'),
+]
+seeds = [record('Statin therapy for the prevention of cardiovascular mortality',
+                'A trial of statin therapy on cardiovascular mortality.')]
+
+
+def test_bm25_ranks_records_sharing_terms_with_the_seeds_first(tmp_path):
+    ranker = ranking.Ranker(ranking.Vocabulary(None), cache=False)
+    ranker.add(corpus[:3])
+    ranker.add(corpus[3:])
+    ranked = ranker.rank(seeds, 'bm25')
+    assert [i for i, score in ranked] == [1, 3, 0, 2, 4]
+    assert ranked[0][1] > ranked[1][1] > 0
+    assert ranked[2][1] == ranked[3][1] == ranked[4][1] == 0
+
+    # the same ranking from term matrices saved and mapped back from the cache
+    vocabulary = ranking.Vocabulary(str(tmp_path / 'vocabulary.txt'))
+    cache = ranking.TermMatrixCache(vocabulary, str(tmp_path / 'cache'))
+    corpus_path = str(tmp_path / 'corpus.ris')
+    with open(corpus_path, 'w', encoding='utf-8') as write_str:
+        bibparser.write_citations(corpus, write_str, 'ris')
+    for cached in (False, True):
+        ranker = ranking.Ranker(vocabulary, cache=cache)
+        ranker.add_file(corpus_path)
+        assert (ranker.matrix.parts[0][1].columns is not None) == cached
+        assert ranker.rank(seeds, 'bm25') == ranked
+    assert [i for i, score in ranker.rank(seeds, 'cosine')][:2] == [1, 3]
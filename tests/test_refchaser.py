@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import refchaser.benchmark as benchmark
+import refchaser.citationcache as citationcache
+import refchaser.refchaser as refchaser
+
+
+def test_extract_jats_reads_every_reference_of_a_document_broken_by_an_entity(tmp_path):
+    text = benchmark.synthetic_jats(references=30, seed=1, paragraphs=2)
+    expected = refchaser.extract_jats(text)
+    assert len(expected.ref_list) == 30
+
+    # an entity CERMINE copied from the PDF but XML does not define, in the 11th reference
+    at = text.index('<article-title>', text.index('<ref id="ref10">')) + len('<article-title>')
+    broken = text[:at] + 'Caf&eacute; workers&nbsp;' + text[at:]
+    JATS_file = tmp_path / 'broken.cermxml'
+    JATS_file.write_text(broken, encoding='utf-8')
+    article, seconds, problems = refchaser.timed_extract(str(JATS_file))
+    assert article.title == expected.title and article.doi == expected.doi
+    assert len(article.ref_list) == 30
+    assert [x.title for x in article.ref_list[11:]] == [x.title for x in expected.ref_list[11:]]
+    assert article.ref_list[10].title.startswith('Caf&eacute; workers&nbsp;')
+    assert len(problems) == 1 and problems[0].startswith('broken.cermxml (malformed JATS')
+
+    failures = []
+    refchaser.record_extraction((article, seconds, problems), failures)
+    assert failures == problems
+
+
+def test_extract_jats_keeps_the_references_of_a_truncated_document():
+    text = benchmark.synthetic_jats(references=30, seed=2, paragraphs=2)
+    truncated = text[:text.index('<ref id="ref20">') + 40]
+    errors = []
+    article = refchaser.extract_jats(truncated, errors)
+    assert len(article.ref_list) == 20
+    assert errors and '20 references read' in errors[0]
+
+
+class CountingJatsCache(citationcache.JatsCache):
+    def __init__(self, cache_dir):
+        super().__init__(cache_dir)
+        self.lookups = 0
+
+    def get(self, pdf_file):
+        self.lookups += 1
+        return super().get(pdf_file)
+
+
+def cached_pdfs(tmp_path, n):
+    """
+    Returns a folder of n PDFs and a JatsCache holding their CERMINE outputs, so RefChaser runs without java.
+    """
+    pdf_path = tmp_path / 'pdfs'
+    pdf_path.mkdir()
+    cache = CountingJatsCache(str(tmp_path / 'jats_cache'))
+    for x in range(n):
+        pdf_file = str(pdf_path / ('article%02d.pdf' % x))
+        with open(pdf_file, 'wb') as write_pdf:
+            write_pdf.write(benchmark.synthetic_pdf('10.1000/lazy.%d' % x))
+        jats_file = tmp_path / 'article.cermxml'
+        jats_file.write_text(benchmark.synthetic_jats(references=3 + x, seed=x, paragraphs=1), encoding='utf-8')
+        cache.put(pdf_file, str(jats_file))
+    return str(pdf_path), cache
+
+
+def test_lazy_articles_match_an_eager_run(tmp_path):
+    pdf_path, cache = cached_pdfs(tmp_path, 6)
+    eager = refchaser.RefChaser(pdf_path, cache=cache)
+    expected = [(x.title, len(x.ref_list)) for x in eager.result_list]
+    assert sorted(x[1] for x in expected) == list(range(3, 9))
+    for workers in (1, 2):
+        chaser = refchaser.RefChaser(pdf_path, cache=cache, lazy=True, workers=workers)
+        assert chaser.result_list == []
+        articles = chaser.articles()
+        first = next(articles)
+        assert chaser.result_list == [first]
+        assert [(x.title, len(x.ref_list)) for x in [first] + list(articles)] == expected
+        # a complete run is read back rather than parsed again
+        lookups = cache.lookups
+        assert [x.title for x in chaser.iter_articles()] == [x[0] for x in expected]
+        assert cache.lookups == lookups and chaser.failures == []